@@ -1,4 +1,4 @@
 
-__all__ = ['bob','fpmatch','utils']
+__all__ = ['bob','buildserver','cache','cacheserver','depfile','fpmatch','jobserver','memprofile','progress','remotecache','scheduler','signatures','snapshot','usage','utils']
 
 from bob import Rule
\ No newline at end of file
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""Timing benchmarks for the buildbit package. Run as a script to print the
+timings of every benchmark (or of those named on the command line):
+    python benchmarks.py [name ...]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import StringIO
+import bob
+import fpmatch
+
+
+def timed(func,*args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+def bench_shared_fanout(n=10000):
+    """one shared meta rule (i.e. a code generator) that produces n targets"""
+    reload(bob)
+    bob.Rule('gen/*.py','schema.txt',shared=True)
+    wild = timed(lambda: [bob.Rule.get('gen/m%d.py' %i) for i in xrange(n)])
+    bob.Rule(['%.h','%.cpp','%_proxy.cpp'],'%.idl',shared=True)
+    pattern = timed(lambda: [bob.Rule.get('%s/m%d%s' %(d,i,ext)) for i in xrange(n//10)
+                             for d in 'abcdefghij' for ext in ('.h','.cpp','_proxy.cpp')])
+    reload(bob)
+    return [('WildSharedRule, %d targets' %n,wild),
+            ('PatternSharedRule, %d rules of 3 targets' %n,pattern)]
+
+def bench_fan_in(n=50000):
+    """staleness checks of one rule (i.e. an archive) with n prerequisites"""
+    reload(bob)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        reqs = [os.path.join(tmpdir,'%d.txt' %i) for i in xrange(n)]
+        for req in reqs:
+            open(req,'w').close()
+        target = os.path.join(tmpdir,'archive')
+        open(target,'w').close()
+        os.utime(target,(time.time()+10,)*2)
+        rule = bob.Rule(target,reqs)
+        stat = timed(lambda: rule.get_mtimes(reqs))
+        cached = timed(lambda: rule.updated_only)
+        bob.ExplicitRule.reset_cache()
+        calc = timed(lambda: bob.Rule.calc_build(target))
+    finally:
+        shutil.rmtree(tmpdir)
+        reload(bob)
+    return [('stat %d prerequisites' %n,stat),
+            ('updated_only (mtimes cached)',cached),
+            ('calc_build (mtimes cached)',calc)]
+
+def bench_definitions(n=5000):
+    """defining n pattern rules and n wild rules and then looking up a few targets"""
+    reload(bob)
+    def define():
+        for i in xrange(n):
+            bob.Rule('gen%d/%%.o' %i,'gen%d/%%.c' %i)
+            bob.Rule('out%d/*.txt' %i,'data%d.csv' %i)
+    definition = timed(define)
+    lookup = timed(lambda: [bob.Rule.get('gen%d/a.o' %i) for i in xrange(0,n,n//10)])
+    again = timed(lambda: [bob.Rule.get('out%d/b.txt' %i) for i in xrange(0,n,n//10)])
+    reload(bob)
+    return [('define %d rules' %(2*n),definition),
+            ('first 10 lookups',lookup),
+            ('next 10 lookups',again)]
+
+def bench_table(n=100000):
+    """defining n explicit rules from a manifest one at a time and with Rule.from_table"""
+    reload(bob)
+    targets = ['obj/m%d.o' %i for i in xrange(n)]
+    reqs = [['src/m%d.c' %i,'include/common.h'] for i in xrange(n)]
+    single = timed(lambda: [bob.Rule(target,req) for target,req in zip(targets,reqs)])
+    reload(bob)
+    table = timed(lambda: bob.Rule.from_table(targets,reqs))
+    reload(bob)
+    return [('Rule() x %d' %n,single),
+            ('Rule.from_table',table)]
+
+def bench_classify(n=100000):
+    """classifying n distinct globs (has_magic, strip_specials and count_patterns)"""
+    paths = ['src/module%d/sub[_]dir/file%d_%%.[ch]' %(i,i) for i in xrange(n)]
+    def classify():
+        for path in paths:
+            fpmatch.has_magic(path),fpmatch.strip_specials(path),fpmatch.count_patterns(path)
+    fpmatch._classified.clear()
+    first = timed(classify)
+    again = timed(classify)
+    fpmatch._classified.clear()
+    return [('first pass',first),
+            ('second pass (memoized)',again)]
+
+def bench_invalidate(n=20000):
+    """calc_build of n up to date objects after one source file changed"""
+    reload(bob)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        objs = []
+        for i in xrange(n):
+            src,obj = os.path.join(tmpdir,'%d.c' %i),os.path.join(tmpdir,'%d.o' %i)
+            open(src,'w').close()
+            open(obj,'w').close()
+            os.utime(obj,(time.time()+10,)*2)
+            bob.Rule(obj,src)
+            objs.append(obj)
+        bob.Rule('All',objs,PHONY=True)
+        first = timed(lambda: bob.Rule.calc_build('All'))
+        changed = os.path.join(tmpdir,'0.c')
+        os.utime(changed,(time.time()+20,)*2)
+        invalidate = timed(lambda: bob.Rule.invalidate([changed]))
+        incremental = timed(lambda: bob.Rule.calc_build('All'))
+        bob.BaseRule.reset_cache()
+        bob.ExplicitTargetRule.reset_cache()
+        reset = timed(lambda: bob.Rule.calc_build('All'))
+    finally:
+        shutil.rmtree(tmpdir)
+        reload(bob)
+    return [('first calc_build',first),
+            ('Rule.invalidate (builds the reverse index)',invalidate),
+            ('calc_build after invalidate',incremental),
+            ('calc_build after resetting the caches',reset)]
+
+def bench_progress(n=100000):
+    """progress events for a build of n rules (first and last tenth timed separately)"""
+    from progress import Progress
+    reload(bob)
+    rules = [bob.ExplicitRule('%d.o' %i,'%d.c' %i,register=False) for i in xrange(n)]
+    out = StringIO.StringIO()
+    progress = Progress(jobs=8,mode='json',stream=out)
+    def events(rules):
+        for rule in rules:
+            progress.started(rule)
+            progress.finished(rule)
+    add = timed(lambda: [progress.add(rule) for rule in rules])
+    tenth = n//10
+    first = timed(events,rules[:tenth])
+    events(rules[tenth:-tenth])
+    last = timed(events,rules[-tenth:])
+    line = Progress(jobs=8,stream=out,interval=0)
+    for rule in rules: line.add(rule)
+    def lines(rules):
+        for rule in rules:
+            line.started(rule)
+            line.finished(rule)
+    status = timed(lines,rules[:tenth])
+    reload(bob)
+    return [('add',add),('json events, first tenth',first),('json events, last tenth',last),
+            ('status lines, a tenth',status)]
+
+def bench_batch(n=2000):
+    """building n objects from a shell recipe pattern rule, one call each vs batches"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for i in xrange(n):
+            open(os.path.join(tmpdir,'%d.c' %i),'w').close()
+        objs = [os.path.join(tmpdir,'%d.o' %i) for i in xrange(n)]
+        results = []
+        for batch in None,100:
+            reload(bob)
+            for obj in objs:
+                if os.path.exists(obj): os.remove(obj)
+            bob.Rule(os.path.join(tmpdir,'%.o'),os.path.join(tmpdir,'%.c'),func='touch {targets}',batch=batch)
+            buildseq = bob.Rule.calc_build(objs)
+            results.append(('Rule.build, batch=%s' %batch,timed(bob.Rule.build,buildseq)))
+    finally:
+        shutil.rmtree(tmpdir)
+        reload(bob)
+    return results
+
+benchmarks = [bench_shared_fanout,bench_fan_in,bench_definitions,bench_table,bench_classify,bench_invalidate,bench_progress,bench_batch]
+
+
+def main(names=None):
+    for bench in benchmarks:
+        if names and bench.__name__ not in names: continue
+        print '%s: %s' %(bench.__name__,bench.__doc__)
+        for label,seconds in bench():
+            print '    %-50s %8.3fs' %(label,seconds)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
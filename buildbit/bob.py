@@ -11,13 +11,21 @@ import warnings
 import glob
 import itertools
 import inspect
+import re
 from types import StringTypes
 from collections import Iterable
 import subprocess
+import collections
+from array import array
 #from sys import maxint
 
 import fpmatch
+import depfile
 from utils import *
+from scheduler import Scheduler
+from jobserver import JobServer
+#the optional subsystems (cache, remotecache, signatures, usage, progress,
+#memprofile, snapshot and buildserver) are imported when they're used
 
 # Choose cached_property implementation
 #cached_property = reify # very cool and efficient but can't reset
@@ -44,10 +52,30 @@ class BaseRule(object):
     #   self.targets = checkseq(targets) # sequence of paths (strings)
     #   if func: self.func = func
     
+    #optional keyword arguments accepted by all of the rule classes (see Rule for
+    #their descriptions). They are set as instance attributes and the class attributes
+    #of the same names provide the defaults.
+    rule_options = ('depfile','restat','pool','weight','batch')
+    depfile = None
+    restat = False
+    pool = None
+    weight = 1
+    batch = None
+    
     @classmethod
     def get(self):
         raise NotImplementedError
     
+    def _check_options(self,options):
+        for name in options:
+            if name not in self.rule_options:
+                raise TypeError("%s got an unexpected rule option %r" %(self.__class__.__name__,name))
+        return options
+    
+    def _set_options(self,options):
+        for name,value in self._check_options(options).iteritems():
+            setattr(self,name,value)
+    
     @classmethod
     def reset_cache(cls):
         cls.get_mtime.cache = {}
@@ -68,9 +96,32 @@ class BaseRule(object):
         raise NotImplementedError
     
     @staticmethod
-    @memoize
     def get_mtime(fpath):
-        return os.path.getmtime(fpath)
+        """os.path.getmtime cached in get_mtime.cache (a path:mtime dict)"""
+        cache = BaseRule.get_mtime.cache
+        mtime = cache.get(fpath)
+        if mtime is None:
+            mtime = cache[fpath] = os.path.getmtime(fpath)
+        return mtime
+    
+    @staticmethod
+    def get_mtimes(fpaths):
+        """modification times of a whole list of files (i.e. a rule's prerequisites)
+        as an array('d') with NaN for the missing files. Shares get_mtime's cache."""
+        cache = BaseRule.get_mtime.cache
+        stat,nan = os.stat,float('nan')
+        mtimes = array('d',itertools.repeat(nan,len(fpaths)))
+        for i,fpath in enumerate(fpaths):
+            mtime = cache.get(fpath)
+            if mtime is None:
+                try:
+                    mtime = cache[fpath] = stat(fpath).st_mtime
+                except OSError:
+                    continue
+            mtimes[i] = mtime
+        return mtimes
+
+BaseRule.get_mtime.cache = {}
 
 # Explicit/Shared rules
 #-------------------------------------------------------------------------------
@@ -87,6 +138,12 @@ class ExplicitRule(BaseRule):
     This class can also be used as a decorater around the desired build function.
     """
     rules = {} #target:rule dict
+    _unindexed = [] # rules created since the reverse index was last updated (see ReverseIndex)
+    artifact_cache = None # ArtifactCache shared by all rules (see Rule.use_cache)
+    signature_log = None # SignatureLog shared by all rules (see Rule.use_signatures)
+    usage_log = None # usage.UsageLog shared by all rules (see Rule.use_usage_log)
+    _rewritten = {} # target: modification time before this build, of the targets rewritten unchanged (see restat)
+    cacheable = True # set to False for rules that should always run their recipe
     
     @classmethod
     def get(cls,target,default=None):
@@ -95,11 +152,11 @@ class ExplicitRule(BaseRule):
     
     @classmethod
     def reset_cache(cls):
-        for method in cls._oldest_target, cls.updated_only:
+        for method in cls._oldest_target, cls.updated_only, cls.depfile_reqs:
             method.reset_cache()
         #cls.calc_build.cache = {}
     
-    def __init__(self,targets,reqs,order_only=None,func=None,PHONY=False,register=True):
+    def __init__(self,targets,reqs,order_only=None,func=None,PHONY=False,register=True,**options):
         """targets - list of targets
         reqs - seq of prerequisites
         order_only - seq of order only prerequisites
@@ -109,6 +166,7 @@ class ExplicitRule(BaseRule):
         PHONY - rule that should always be run (and probably won't 
             create a file with the name of the target)
         register - add new rule to class registry (normally this should be true)
+        options - see BaseRule.rule_options
         """
         self.targets = checkseq(targets)
         self.PHONY = PHONY
@@ -116,6 +174,7 @@ class ExplicitRule(BaseRule):
         self.reqs = dedup(self.allreqs)
         self.order_only = checkseq(order_only)
         if func: self.func = func
+        self._set_options(options)
         #self.updated_only = self.updated_only()
         
         #Add self to class level registry
@@ -124,27 +183,89 @@ class ExplicitRule(BaseRule):
                 if target in self.rules:
                     warnings.warn('ExplicitRules takes the last defined rule for each target. Overwriting the rule for %r' %target,stacklevel=2)
                 self.rules[target] = self
+            self._unindexed.append(self)
     
     def build(self):
-        """run recipe"""
+        """run recipe (or restore the targets from the artifact cache). Returns False
+        if the rule has the restat option and its targets were left unchanged."""
+        if not self.restat or self.PHONY:
+            self.run_recipe()
+            return True
+        before = self._target_state()
+        self.run_recipe()
+        after = self._target_state()
+        if None in before or None in after:
+            return True
+        if self.restat == 'hash':
+            if any(old[1] != new[1] for old,new in zip(before,after)):
+                return True
+            #the targets keep their new modification times, so that the rule is up to date
+            #from now on, and the dependent rules compare themselves with the old ones (see _cut_off)
+            self._rewritten.update((target,old[0]) for target,old,new in zip(self.targets,before,after) if old[0] != new[0])
+            return False
+        return before != after
+    
+    def _add_target(self,target):
+        """adds a target requested from a shared meta rule. The targets are kept in
+        an OrderedSet so that a rule shared by many targets grows in constant time."""
+        if not isinstance(self.targets,OrderedSet):
+            self.targets = OrderedSet(self.targets)
+        self.targets.add(target)
+    
+    def _target_state(self):
+        """modification times (and digests for restat='hash') of the targets"""
+        state = []
+        for target in self.targets:
+            try:
+                mtime = os.path.getmtime(target)
+            except OSError:
+                state.append(None)
+                continue
+            if self.restat == 'hash' and os.path.isfile(target):
+                from cache import file_digest
+                digest = file_digest(target)
+            else:
+                digest = None
+            state.append((mtime,digest))
+        return state
+    
+    def run_recipe(self):
+        """run recipe (or restore the targets from the artifact cache)"""
         if hasattr(self,'func'):
-            if isinstance(self.func,StringTypes):
-                cmd = self.cmd_action(self.func)
-                subprocess.check_call(cmd,shell=True)
-            elif isinstance(self.func,list):
+            cache = self.artifact_cache if (self.cacheable and not self.PHONY) else None
+            key = cache.key(self) if cache else None
+            #the depfile is cached with the targets so that a restored rule is up to date
+            outputs = list(self.targets) + ([self.depfile] if self.depfile else [])
+            if key and cache.fetch(key,outputs):
+                if self.signature_log: self.signature_log.record(self)
+                return
+            
+            usage_log = self.usage_log
+            if isinstance(self.func,(StringTypes,list)):
                 cmd = self.cmd_action(self.func)
-                subprocess.check_call(cmd,shell=False)
+                shell = isinstance(self.func,StringTypes)
+                if usage_log:
+                    import usage
+                    usage_log.record(self,usage.check_call(cmd,shell=shell))
+                else:
+                    subprocess.check_call(cmd,shell=shell)
             elif callable(self.func):
                 func_argspec = inspect.getargspec(self.func)
                 func_args = func_argspec[0]
-                if len(func_args)==1:
-                    self.func(self)
-                elif len(func_args)==0:
-                    self.func()
-                else:
+                if len(func_args) > 1:
                     raise AssertionError("Unable to use a rule function that takes more than one argument. rule: %r" %self.targets)
+                args = (self,) if func_args else ()
+                if usage_log:
+                    import usage
+                    usage_log.record(self,usage.call(self.func,*args))
+                else:
+                    self.func(*args)
             else:
                 warnings.warn("ExplicitRule %r doesn't have a recognised type of build function attached." %self,stacklevel=2)
+                return
+            
+            if cache: cache.store_rule(self,outputs)
+            if self.signature_log: self.signature_log.record(self)
     
     def cmd_action(self,cmd):
         """expands the command line string using the rule's attributes"""
@@ -173,84 +294,161 @@ class ExplicitRule(BaseRule):
     
     @cached_property
     def _oldest_target(self):
-        exists = os.path.exists
         ancient_epoch = 0 #unix time
-        return min((self.get_mtime(target) if exists(target) else ancient_epoch) for target in self.targets )
+        return min((mtime if mtime == mtime else ancient_epoch) for mtime in self.get_mtimes(self.targets)) #NaN: missing
     
     @cached_property
     def updated_only(self):
         """makes a list of the reqs which are newer than any of the targets"""
-        oldest_target = self._oldest_target
-        updated_reqs = [req for req in self.reqs if not os.path.exists(req) or self.get_mtime(req) > oldest_target]
-        return updated_reqs
+        reqs = self.reqs
+        return [reqs[i] for i in newer_indices(self.get_mtimes(reqs),self._oldest_target)]
+    
+    @cached_property
+    def depfile_reqs(self):
+        """the extra prerequisites listed in the rule's depfile by the last run of
+        its recipe. None if the rule has a depfile that hasn't been written yet."""
+        if not self.depfile:
+            return []
+        return depfile.read_deps(self.depfile)
     
     #@memoize 
-    def calc_build(self,_seen=None):
+    def calc_build(self,_seen=None,_results=None):
         """decides if it needs to be built by recursively asking it's prerequisites
-        the same question.
+        the same question. Returns the build sequence (an OrderedSet), see iter_build."""
+        return OrderedSet(self.iter_build(_seen,_results))
+    
+    def iter_build(self,_seen=None,_results=None):
+        """generator version of calc_build. Each rule that needs to be built is yielded
+        as soon as all of its prerequisites have been resolved, so that rules can be
+        run while the rest of the graph is still being resolved.
         _seen is an internal variable (a set) for optimising the search. I'll be relying 
         on the set being a mutable container in order to not have to pass it explicitly 
-        back up the call stack."""
-        #There is an oportunity to optimise calculations to occur only once for rules that are called multiple
-        #times by using a shared (global) buildseq + _already_seen set, or by passing those structures into
-        #the calc_build method call.
-        #i.e. if (self in buildseq) or (self in _already_seen): return buildseq
-        #Or we can memoize this method
-        
+        back up the call stack.
+        _results is an internal variable (a rule:needs building dict) shared by the whole
+        traversal so that each rule is only resolved once, however many rules (or
+        goals) depend upon it."""
         #updated_only should be calculated during build calculation time (rather than build time) for consistancy.
         self.updated_only #force evaluation of lazy property
         
-        buildseq = OrderedSet()
         _seen = set() if not _seen else _seen
         _seen.add(self) # this will also solve any circular dependency issues!
+        _results = {} if _results is None else _results
+        
+        needed = False
+        for reqrule in self._iter_reqrules(_seen):
+            if reqrule not in _results:
+                for rule in reqrule.iter_build(_results=_results):
+                    yield rule
+            needed = needed or _results[reqrule]
         
+        depfile_reqs = self.depfile_reqs
+        if not needed:
+            if self.PHONY or any([not os.path.exists(target) for target in self.targets]):
+                needed = True
+            elif depfile_reqs is None or self._depfile_updated():
+                needed = True
+            elif self.signature_log and self.signature_log.changed(self):
+                needed = True #the recipe has been edited
+            else:
+                oldest_target = self._oldest_target
+                
+                #Since none of the prerequisites have rules that need to update, we can assume
+                #that all prerequisites should be real files (phony rules always update which
+                #should skip this section of code). Hence non-existing files imply an malformed build
+                #file.
+                mtimes = self.get_mtimes(self.reqs)
+                for i in newer_indices(mtimes,oldest_target):
+                    if mtimes[i] != mtimes[i]: #NaN
+                        raise AssertionError("A non file prerequisite was found (%r) for targets %r in wrong code path" %(self.reqs[i],self.targets))
+                    needed = True
+        
+        _results[self] = needed
+        if needed:
+            yield self
+    
+    def _iter_reqrules(self,_seen):
+        """the rules of the prerequisites (looked up lazily for iter_build)"""
         for req in self.order_only:
             if not os.path.exists(req):
                 reqrule = Rule.get(req,None) #super(ExplicitRule,self).get(req,None)
                 if reqrule:
                     if reqrule not in _seen:
-                        buildseq.update(reqrule.calc_build())
+                        yield reqrule
                     else:
-                        warnings.warn('rule for %r has already been processed' %req,stacklevel=2)
+                        warnings.warn('rule for %r has already been processed' %req,stacklevel=3)
                 else:
-                    warnings.warn('%r has an order_only prerequisite with no rule' %self,stacklevel=2)
+                    warnings.warn('%r has an order_only prerequisite with no rule' %self,stacklevel=3)
         
+        plain_reqs = []
         for req in self.reqs:
             reqrule = Rule.get(req,None) #super(ExplicitRule,self).get(req,None)
             if reqrule:
                 if reqrule not in _seen:
-                    buildseq.update(reqrule.calc_build())
+                    yield reqrule
                 else:
-                    warnings.warn('rule for %r has already been processed' %req,stacklevel=2)
-            else: #perform checks
-                try:
-                    self.get_mtime(req) #get_mtime is cached to reduce number of file accesses
-                except OSError as e:
-                    raise AssertionError("No rule or file found for %r for targets: %r" %(req,self.targets))
-            
-        if len(buildseq)==0:
-            if self.PHONY or any([not os.path.exists(target) for target in self.targets]):
-                buildseq.add(self)
+                    warnings.warn('rule for %r has already been processed' %req,stacklevel=3)
             else:
-                oldest_target = self._oldest_target
-                
-                #Since none of the prerequisites have rules that need to update, we can assume
-                #that all prerequisites should be real files (phony rules always update which
-                #should skip this section of code). Hence non-existing files imply an malformed build
-                #file.
-                for req in self.reqs:
-                    try: 
-                        req_mtime = self.get_mtime(req)
-                        if req_mtime > oldest_target:
-                            buildseq.add(self)
-                            break
-                            
-                    except OSError as e: 
-                        raise AssertionError("A non file prerequisite was found (%r) for targets %r in wrong code path" %(req,self.targets))
-        else:
-            buildseq.add(self)
+                plain_reqs.append(req)
+        #perform checks (get_mtimes is cached to reduce number of file accesses)
+        for mtime,req in itertools.izip(self.get_mtimes(plain_reqs),plain_reqs):
+            if mtime != mtime: #NaN
+                raise AssertionError("No rule or file found for %r for targets: %r" %(req,self.targets))
         
+        #prerequisites discovered by the recipe itself (i.e. included headers). Unlike
+        #ordinary prerequisites, missing files just mean that the rule is out of date.
+        for req in self.depfile_reqs or ():
+            reqrule = Rule.get(req,None)
+            if reqrule and reqrule not in _seen:
+                yield reqrule
+    
+    def calc_changed_build(self,affected,_seen=None):
+        """a sparse version of calc_build for when the changed files are already known.
+        Only the prerequisites that are in affected (the targets given by
+        Rule.dependents) are followed and no modification times are checked: every
+        rule reached lies downstream of a changed file so it is assumed to be out of
+        date. Affected order only prerequisites are still built first."""
+        buildseq = OrderedSet()
+        _seen = set() if _seen is None else _seen
+        _seen.add(self)
+        for req in itertools.chain(self.order_only,self.reqs,self.depfile_reqs or ()):
+            if req not in affected: continue
+            reqrule = Rule.get(req,None)
+            if reqrule is not None and reqrule not in _seen:
+                buildseq.update(reqrule.calc_changed_build(affected,_seen))
+        buildseq.add(self)
         return buildseq
+    
+    def _cut_off(self,done,unchanged):
+        """decides at build time whether the rule can be skipped. This is the case
+        when every prerequisite rule that has been processed during this build left
+        its targets unchanged (see the restat option) and the rule is now up to date.
+        done - the rules processed so far, unchanged - those that changed nothing."""
+        reqrules = [Rule.get(req,None) for req in itertools.chain(self.reqs,self.order_only,self.depfile_reqs or ())]
+        reqrules = [reqrule for reqrule in reqrules if reqrule in done]
+        if not reqrules or any(reqrule not in unchanged for reqrule in reqrules):
+            return False
+        if self.PHONY or self.depfile_reqs is None:
+            return False
+        if self.signature_log and self.signature_log.changed(self):
+            return False
+        #the modification times are re-read rather than taken from get_mtime's cache
+        try:
+            oldest_target = min(os.path.getmtime(target) for target in self.targets)
+            newer = [req for req in itertools.chain(self.reqs,self.depfile_reqs) if os.path.getmtime(req) > oldest_target]
+        except OSError:
+            return False
+        rewritten = self._rewritten
+        if any(rewritten.get(req,float('inf')) > oldest_target for req in newer):
+            return False
+        if newer: #only newer for having been rewritten unchanged, so the targets are touched to stay up to date
+            for target in self.targets:
+                rewritten[target] = os.path.getmtime(target)
+                os.utime(target,None)
+        return True
+    
+    def _depfile_updated(self):
+        """are any of the depfile's prerequisites missing or newer than the targets?"""
+        return bool(newer_indices(self.get_mtimes(self.depfile_reqs),self._oldest_target))
 
 
 class ExplicitTargetRule(ExplicitRule):
@@ -265,7 +463,7 @@ class ExplicitTargetRule(ExplicitRule):
         for method in cls.allreqs, cls.reqs, cls.order_only:
             method.reset_cache()
     
-    def __init__(self,targets,reqs,order_only=None,func=None,PHONY=False,register=True):
+    def __init__(self,targets,reqs,order_only=None,func=None,PHONY=False,register=True,**options):
         """targets - list of targets
         reqs - seq of prerequisites
         order_only - seq of order only prerequisites
@@ -275,12 +473,14 @@ class ExplicitTargetRule(ExplicitRule):
         PHONY - rule that should always be run (and probably won't 
             create a file with the name of the target)
         register - add new rule to class registry (normally this should be true)
+        options - see BaseRule.rule_options
         """
         self.targets = checkseq(targets)
         self.PHONY = PHONY
         self._allreqs = checkseq(reqs)
         self._order_only = checkseq(order_only)
         if func: self.func = func
+        self._set_options(options)
         #self.updated_only = self.updated_only()
         
         #Add self to class level registry
@@ -289,6 +489,7 @@ class ExplicitTargetRule(ExplicitRule):
                 if target in self.rules:
                     warnings.warn('ExplicitRules takes the last defined rule for each target. Overwriting the rule for %r' %target,stacklevel=2)
                 self.rules[target] = self
+            self._unindexed.append(self)
     
     #delay expansion because we can only do it after all of the build rules have been defined
     
@@ -309,6 +510,8 @@ class ExplicitTargetRule(ExplicitRule):
         """Uses the glob module to search the file system and an altered glob module - fpmatch
         to search the meta rules.
         """
+        if Rule._dir_mtimes is not None and fpmatch.has_magic(fpath):
+            Rule._watch(fpath)
         matches = glob.glob(fpath)
         if fpmatch.has_magic(fpath): 
             matches += fpmatch.filter(self.rules.iterkeys(),fpath)
@@ -330,14 +533,58 @@ class MetaRule(BaseRule):
     build order). 
     """
     # define these in each subclass. - Doing it this way allows us to define the search order hierarchy.
-    #rules = {} # compiled regular expression of target: meta_rule
+    #rules = {} # wildcard target pattern: meta_rule
     #_instantiated_rules = {} # cache of instantiated explicit rules
     #_pattern_rankings = {} # registry of the 'lengths' of the wildcard targets.
+    #_index = fpmatch.PatternIndex() # the patterns by their literal prefixes and suffixes
+    #_unregistered = [] # meta rules defined since the registry was last used
+    _regexes = {} # pattern: compiled regular expression (shared by all subclasses)
+    
+    #Defining a rule only queues it in _unregistered. Its wildcard targets are added to
+    #the registry the next time that the registry is used (see registry()) and the
+    #patterns are only compiled once a target that could match them is looked up.
     
     @classmethod
     def reset_cache(cls):
         raise NotImplementedError
     
+    @classmethod
+    def registry(cls):
+        """the pattern:meta_rule registry, after registering any new rules"""
+        if cls._unregistered:
+            for metarule in cls._unregistered:
+                for pattern in metarule.wild_targets:
+                    cls._register(pattern,metarule)
+            del cls._unregistered[:]
+        return cls.rules
+    
+    @classmethod
+    def _register(cls,pattern,metarule):
+        if pattern not in cls.rules:
+            cls._index.add(pattern)
+        cls.rules[pattern] = metarule
+    
+    @classmethod
+    def _clear_registry(cls):
+        cls.rules.clear()
+        cls._index.clear()
+        cls._pattern_rankings.clear()
+        del cls._unregistered[:]
+    
+    @staticmethod
+    def _regex(pattern):
+        regex = MetaRule._regexes.get(pattern)
+        if regex is None:
+            regex = MetaRule._regexes[pattern] = fpmatch.precompile(pattern)
+        return regex
+    
+    @classmethod
+    def _rank(cls,pattern):
+        rank = cls._pattern_rankings.get(pattern)
+        if rank is None:
+            rank = cls._pattern_rankings[pattern] = len(fpmatch.strip_specials(pattern))
+        return rank
+    
     @classmethod
     def get(cls,target,default=None,extratargetpath=''):
         """get the best matched rule for the target from the registry of metarules
@@ -346,56 +593,72 @@ class MetaRule(BaseRule):
         extratargetpath - used by PatternRule.
         """
         #optimisation
-        rule = cls._instantiated_rules.get(target,None)
+        fulltarget = os.path.join(extratargetpath,target)
+        rule = cls._instantiated_rules.get(fulltarget,None)
         if rule: 
             return rule
         #else search metarules
-        matches = [regex for regex in cls.rules.keys() if regex.match(target)]
-        #choose best
-        if len(matches) == 1:
-            match = matches[0]
-        elif len(matches) > 1:
-            # find longest matching pattern (explicit part only) using _pattern_rankings dict
-            i = argmax([cls._pattern_rankings[regex] for regex in matches])
-            match = matches[i]
-        else:
-            match = None
+        match = cls._best_match(target)
         #create the desired explicit rule
         if match:
             metarule = cls.rules[match]
-            fulltarget = os.path.join(extratargetpath,target)
-            newrule = metarule.individuate(fulltarget,match)
+            newrule = metarule.individuate(fulltarget,cls._regex(match))
             cls._instantiated_rules[fulltarget] = newrule #cache the individuated rule
             return newrule
         else:
             return default
     
-    def __init__(self,targets,reqs,order_only=None,func=None,PHONY=False):
+    @classmethod
+    def _best_match(cls,target):
+        """the registered pattern that matches the target best (or None)"""
+        registry = cls.registry()
+        if not registry:
+            return None
+        matches = [pattern for pattern in cls._index.candidates(target) if cls._regex(pattern).match(target)]
+        #choose best
+        if len(matches) == 1:
+            return matches[0]
+        elif len(matches) > 1:
+            # find longest matching pattern (explicit part only) using _pattern_rankings dict
+            i = argmax([cls._rank(pattern) for pattern in matches])
+            return matches[i]
+        return None
+    
+    @classmethod
+    def find(cls,target):
+        """the meta rule that get would individuate for the target, without
+        individuating it (or None)"""
+        match = cls._best_match(target)
+        return cls.rules[match] if match else None
+    
+    def __init__(self,targets,reqs,order_only=None,func=None,PHONY=False,**options):
         """targets - list of targets
         reqs - seq of prerequisites
         order_only - seq of order only prerequisites
         func - a function that should take one or no arguments. Will be
             passed this class instance when run in order to have access
             to its attributes.
+        options - see BaseRule.rule_options. They are passed on to the explicit rules.
         """
         self.targets = targets = checkseq(targets)
         self.PHONY = PHONY
         self.allreqs = reqs = checkseq(reqs)
         self.order_only = order_only = checkseq(order_only)
+        self.options = self._check_options(options)
         
         self.explicit_rules = [] #each meta_rule remembers its explicit rules. 
         self._func = func
         
-        #Add self to registry of rules
-        wild_targets = fpmatch.only_wild_paths(targets)
-        self.re_targets = [fpmatch.precompile(pattern) for pattern in wild_targets]
-        for regex in self.re_targets:
-            self.rules[regex] = self
-        
-        #calculate pattern lengths
-        rankings = [len(fpmatch.strip_specials(pattern)) for pattern in wild_targets]
-        for regex,rank in zip(self.re_targets,rankings):
-            self._pattern_rankings[regex] = rank
+        #Add self to registry of rules (on first use, see MetaRule.registry)
+        self._unregistered.append(self)
+    
+    @reify
+    def wild_targets(self):
+        return fpmatch.only_wild_paths(self.targets)
+    
+    @property
+    def re_targets(self):
+        return [self._regex(pattern) for pattern in self.wild_targets]
     
     def individuate(self,target,regex):
         """updates the explicit rule for the target. Will raise Error
@@ -428,15 +691,17 @@ class WildRule(MetaRule):
     """A meta rule that can specialise to an explicit rule. It takes wildcards and
     in the target and req lists. Multiple targets lead to individualised explicit 
     rules."""
-    rules = {} # compiled regular expression of target: meta_rule
+    rules = {} # wildcard target pattern: meta_rule
     _instantiated_rules = {} # cache of instantiated explicit rules
     _pattern_rankings = {} # registry of the 'lengths' of the wildcard targets.
+    _index = fpmatch.PatternIndex() # the patterns by their literal prefixes and suffixes
+    _unregistered = [] # rules waiting to be added to the registry
     
     @classmethod
     def reset_cache(cls):
         cls._instantiated_rules = {}
     
-    def __init__(self,targets,reqs,order_only=None,func=None,PHONY=False):
+    def __init__(self,targets,reqs,order_only=None,func=None,PHONY=False,**options):
         """targets - list of targets
         reqs - seq of prerequisites
         order_only - seq of order only prerequisites
@@ -444,7 +709,7 @@ class WildRule(MetaRule):
             passed this class instance when run in order to have access
             to its attributes.
         """
-        super(WildRule,self).__init__(targets,reqs,order_only,func,PHONY)
+        super(WildRule,self).__init__(targets,reqs,order_only,func,PHONY,**options)
         #Check parameters
         pass
         
@@ -452,8 +717,10 @@ class WildRule(MetaRule):
         explicit_targets = fpmatch.only_explicit_paths(targets)
         #saving references to explicit rules to allow us to have late-binding of the build func
         self.explicit_rules = [
-            ExplicitTargetRule(targets=target,reqs=reqs,order_only=order_only,func=self.func,PHONY=self.PHONY)
+            ExplicitTargetRule(targets=target,reqs=reqs,order_only=order_only,func=self.func,PHONY=self.PHONY,**options)
             for target in explicit_targets]
+        for rule in self.explicit_rules:
+            rule.metarule = self #batched along with the rules for the wildcard targets
     
     def individuate(self,target,regex):
         """creates an explicit rule for the target. Will raise an error
@@ -462,9 +729,11 @@ class WildRule(MetaRule):
         
         #expanding wildcards in reqs        
         newrule = ExplicitTargetRule(targets=target,reqs=self.allreqs,order_only=self.order_only,
-                                func=self.func,PHONY=self.PHONY,register=False)
+                                func=self.func,PHONY=self.PHONY,register=False,**self.options)
         #we set register to false as we do not want this rule to be added to the
         #ExplicitRule registry as that would make the build order dependent.
+        newrule.metarule = self #for grouping the rules into batches (see the batch option)
+        ExplicitRule._unindexed.append(newrule)
         return newrule
 
 
@@ -477,6 +746,8 @@ class PatternRule(MetaRule):
     rules = {}
     _instantiated_rules = {} # cache of instantiated explicit rules
     _pattern_rankings = {} # registry of the 'lengths' of the wildcard targets.
+    _index = fpmatch.PatternIndex() # the patterns by their literal prefixes and suffixes
+    _unregistered = [] # rules waiting to be added to the registry
 
     @classmethod
     def reset_cache(cls):
@@ -493,12 +764,16 @@ class PatternRule(MetaRule):
             targetpath = os.path.dirname(target)
             newrule = super(PatternRule,cls).get(targetname,default,extratargetpath=targetpath)
         return newrule
+    
+    @classmethod
+    def find(cls,target):
+        return super(PatternRule,cls).find(target) or super(PatternRule,cls).find(os.path.basename(target))
 
 
-    def __init__(self,targets,reqs,order_only=None,func=None,PHONY=False):
+    def __init__(self,targets,reqs,order_only=None,func=None,PHONY=False,**options):
         """Note: All targets must have at least the same number of % wildcards as the prerequisite
-        with the highest number of them."""
-        super(PatternRule,self).__init__(targets,reqs,order_only,func,PHONY)
+        with the highest number of them. A depfile option may also contain % wildcards."""
+        super(PatternRule,self).__init__(targets,reqs,order_only,func,PHONY,**options)
         #Check parameters - PatternRules shouldn't have any entries in self.explicit_rules
         assert all(fpmatch.has_pattern(target) for target in self.targets)
         #counting number of % (excluding sets)
@@ -531,21 +806,27 @@ class PatternRule(MetaRule):
             stems = res.groups()
             ireqs = [os.path.join(extratargetpath,subst_patterns(req,stems)) for req in self.allreqs]
             iorder_only = [os.path.join(extratargetpath,subst_patterns(req,stems)) for req in self.order_only]
+        
+        ioptions = dict(self.options)
+        if ioptions.get('depfile'):
+            ioptions['depfile'] = os.path.join(extratargetpath,subst_patterns(ioptions['depfile'],stems))
             
-        return stems, extratargetpath, target, ireqs, iorder_only
+        return stems, extratargetpath, target, ireqs, iorder_only, ioptions
         
     def individuate(self,target,regex):
         """creates an explicit rule for the target. Will raise an error
         if the target is incompatible with the metarule"""
         
-        stems, extratargetpath, target, ireqs, iorder_only = self._individuate(target,regex)
+        stems, extratargetpath, target, ireqs, iorder_only, ioptions = self._individuate(target,regex)
         
         newrule = ExplicitTargetRule(targets=target,reqs=ireqs,order_only=iorder_only,
-                                func=self.func,PHONY=self.PHONY,register=False)
+                                func=self.func,PHONY=self.PHONY,register=False,**ioptions)
         #we set register to false as we do not want this rule to be added to the
         #ExplicitRule registry as that would make the build order dependent.
         newrule.stems = stems #useful attribute
         newrule.extratargetpath = extratargetpath #useful attribute
+        newrule.metarule = self #for grouping the rules into batches (see the batch option)
+        ExplicitRule._unindexed.append(newrule)
         return newrule
 
 
@@ -559,15 +840,17 @@ class WildSharedRule(MetaRule):
     many different targets ask for it to run. The targets attribute will be 
     updated to contain each target that requests it.
     """
-    rules = {} # compiled regular expression of target: meta_rule
+    rules = {} # wildcard target pattern: meta_rule
     _instantiated_rules = {} # cache of instantiated explicit rules
     _pattern_rankings = {} # registry of the 'lengths' of the wildcard targets.
+    _index = fpmatch.PatternIndex() # the patterns by their literal prefixes and suffixes
+    _unregistered = [] # rules waiting to be added to the registry
     
     @classmethod
     def reset_cache(cls):
         cls._instantiated_rules = {}
     
-    def __init__(self,targets,reqs,order_only=None,func=None,PHONY=False):
+    def __init__(self,targets,reqs,order_only=None,func=None,PHONY=False,**options):
         """targets - list of targets
         reqs - seq of prerequisites
         order_only - seq of order only prerequisites
@@ -575,7 +858,7 @@ class WildSharedRule(MetaRule):
             passed this class instance when run in order to have access
             to its attributes
         """
-        super(WildSharedRule,self).__init__(targets,reqs,order_only,func,PHONY)
+        super(WildSharedRule,self).__init__(targets,reqs,order_only,func,PHONY,**options)
         #check parameters
         pass
         
@@ -583,7 +866,7 @@ class WildSharedRule(MetaRule):
         explicit_targets = fpmatch.only_explicit_paths(targets)
         self.explicit_rules = [ExplicitTargetRule(targets=explicit_targets,
                                         reqs=reqs,order_only=order_only,
-                                        func=self.func,PHONY=self.PHONY)]
+                                        func=self.func,PHONY=self.PHONY,**options)]
         #only one rule is defined but we store it in the explicitrules list for
         #compatibility with the parent object's func getter/setter descriptors.
         
@@ -597,7 +880,7 @@ class WildSharedRule(MetaRule):
         
         #Adding new target to explicit rule's target attribute.
         erule = self.explicit_rules[0]
-        erule.targets = dedup(list(erule.targets) + [target])
+        erule._add_target(target)
         
         #Nb. This requested target isn't added to the ExplicitRule rule registry since 
         # that would make the build calculation order dependent/non-deterministic. 
@@ -629,6 +912,8 @@ class PatternSharedRule(PatternRule):
     rules = {}
     _instantiated_rules = {} # cache of instantiated explicit rules
     _pattern_rankings = {} # registry of the 'lengths' of the wildcard targets.
+    _index = fpmatch.PatternIndex() # the patterns by their literal prefixes and suffixes
+    _unregistered = [] # rules waiting to be added to the registry
 
     @classmethod
     def reset_cache(cls):
@@ -637,31 +922,203 @@ class PatternSharedRule(PatternRule):
     def individuate(self,target,regex):
         """creates an explicit rule for the target. Will raise an error
         if the target is incompatible with the metarule"""
-        stems, extratargetpath, target, ireqs, iorder_only = self._individuate(target,regex)
+        stems, extratargetpath, target, ireqs, iorder_only, ioptions = self._individuate(target,regex)
         
         #search instantiated rules for this pattern rule for one with matching stems and basename
-        erules = [rule for rule in self.explicit_rules if rule.stems == stems and rule.extratargetpath == extratargetpath]        
-        if len(erules) > 1: 
-            raise AssertionError("PatternRule instance's explicit_rule list is corrupted by duplicates")
-        if erules:
-            erule = erules[0]
+        index = self._erule_index()
+        erule = index.get((stems,extratargetpath))
+        if erule:
             #Adding new target to explicit rule's target attribute.
-            erule.targets = dedup(list(erule.targets) + [target])
+            erule._add_target(target)
             #note that mutating erule's attribute doesn't change object's hash (see WildSharedRule comments)
         else:
             erule = ExplicitTargetRule(targets=target,reqs=ireqs,order_only=iorder_only,
-                                    func=self.func,PHONY=self.PHONY,register=False)
+                                    func=self.func,PHONY=self.PHONY,register=False,**ioptions)
             #we set register to false as we do not want this rule to be added to the
             #ExplicitRule registry as that would make the build order dependent.
             erule.stems = stems #useful attribute & necessary for finding already instantiated rules.
             erule.extratargetpath = extratargetpath #useful attribute & necessary for finding matching instantiated pattern rules.
+            erule.metarule = self #for grouping the rules into batches (see the batch option)
             self.explicit_rules.append(erule)
+            index[(stems,extratargetpath)] = erule
+            ExplicitRule._unindexed.append(erule)
         return erule
+    
+    def _erule_index(self):
+        """the explicit rules keyed by (stems, extratargetpath). Built on first use
+        (rules loaded from a snapshot only have the explicit_rules list)."""
+        index = self.__dict__.get('_erules_by_stems')
+        if index is None:
+            index = self._erules_by_stems = dict(((tuple(rule.stems),rule.extratargetpath),rule) for rule in self.explicit_rules)
+        return index
+
+
+## reverse dependencies
+##-----------------------------------------------------------------------------------------
+
+class ReverseIndex(object):
+    """An index from paths to the rules that list them as prerequisites (including
+    depfile prerequisites). Order only prerequisites are indexed separately, as a
+    change to them doesn't make their dependents out of date. It is used by
+    Rule.dependents and Rule.invalidate.
+    
+    Explicit rules are indexed by their prerequisites as written, so wildcard
+    prerequisites are matched against the queried paths rather than expanded by
+    searching the file system. The targets of meta rules that haven't been
+    individuated for them yet are found without individuating them: the stems of
+    a pattern rule are recovered by matching the path against its prerequisite
+    patterns, and a wild rule's targets are looked for amongst the indexed
+    prerequisites (the paths that other rules ask for).
+    """
+    def __init__(self,metaclasses):
+        self.metaclasses = metaclasses
+        self.index = {} # path: [rules]
+        self.wild = [] # [(compiled wildcard prerequisite, rule)]
+        self.order_only_index = {} # as index and wild but for the order only prerequisites
+        self.order_only_wild = []
+        self.indexed = set()
+        self.depfile_indexed = {} # rule: depfile prerequisites that it is indexed by
+        self._metamatchers = (None,None) # (number of meta rules, matchers)
+        self.update(Rule._resolved_rules())
+    
+    def update(self,rules=()):
+        """indexes the given rules and any rules created since the last update"""
+        pending = ExplicitRule._unindexed + list(rules) #definition order first
+        del ExplicitRule._unindexed[:]
+        for rule in pending:
+            if isinstance(rule,ExplicitRule) and rule not in self.indexed:
+                self.add(rule)
+    
+    def add(self,rule):
+        self.indexed.add(rule)
+        if isinstance(rule,ExplicitTargetRule):
+            reqs,order_only = rule._allreqs,rule._order_only #unexpanded
+        else:
+            reqs,order_only = rule.allreqs,rule.order_only
+        depfile_reqs = self.depfile_indexed[rule] = list(rule.depfile_reqs or ())
+        for req in itertools.chain(reqs,depfile_reqs):
+            self._add_req(req,rule,self.index,self.wild)
+        for req in order_only:
+            self._add_req(req,rule,self.order_only_index,self.order_only_wild)
+    
+    @staticmethod
+    def _add_req(req,rule,index,wild):
+        if fpmatch.has_magic(req):
+            wild.append((fpmatch.precompile(req),rule))
+        else:
+            index.setdefault(fpmatch.strip_specials(req),[]).append(rule)
+    
+    def reindex_depfile(self,rule):
+        """replaces the rule's entries for its old depfile prerequisites with the
+        current ones (i.e. after the depfile was rewritten)"""
+        if rule not in self.indexed:
+            return
+        for req in self.depfile_indexed.pop(rule):
+            if fpmatch.has_magic(req):
+                pattern = fpmatch.precompile(req).pattern
+                i = next(i for i,(regex,r) in enumerate(self.wild) if r is rule and regex.pattern == pattern)
+                del self.wild[i]
+            else:
+                self.index[fpmatch.strip_specials(req)].remove(rule)
+        depfile_reqs = self.depfile_indexed[rule] = list(rule.depfile_reqs or ())
+        for req in depfile_reqs:
+            self._add_req(req,rule,self.index,self.wild)
+    
+    def metamatchers(self):
+        """[(compiled reverse prerequisite pattern, metarule)] for the pattern rules.
+        The first group of the pattern catches any extratargetpath."""
+        count = sum(len(subcls.registry()) for subcls in self.metaclasses)
+        if self._metamatchers[0] != count: #meta rules have been defined since
+            matchers = []
+            for subcls in self.metaclasses:
+                for metarule in dedup(subcls.registry().values()):
+                    if not isinstance(metarule,PatternRule): continue
+                    for req in metarule.allreqs:
+                        if fpmatch.count_patterns(req) == 0: continue
+                        regex = fpmatch.translate_unanchored(os.path.normcase(req))
+                        matchers.append((re.compile('(?ms)(?:(.*)/)?'+regex+'\Z'),metarule))
+            self._metamatchers = (count,matchers)
+        return self._metamatchers[1]
+    
+    def meta_targets(self,path):
+        """targets that meta rules would depend upon path for, once individuated.
+        Targets that already have a rule are left out (see direct)."""
+        for regex,metarule in self.metamatchers():
+            res = regex.match(path)
+            if not res: continue
+            extratargetpath,stems = res.group(1),res.groups()[1:]
+            for target in metarule.targets:
+                if fpmatch.count_patterns(target) != len(stems) or fpmatch.has_magic(target.replace('%','')):
+                    continue
+                for stem in stems:
+                    target = target.replace('%',stem,1)
+                target = os.path.join(extratargetpath,target) if extratargetpath else target
+                if Rule.find_metarule(target) is metarule:
+                    yield target
+        for subcls in self.metaclasses:
+            for metarule in dedup(subcls.registry().values()):
+                if isinstance(metarule,PatternRule): continue
+                if any(fpmatch.fnmatch(path,req) for req in metarule.allreqs):
+                    requested = itertools.chain(self.index,self.order_only_index)
+                    for target in sorted(target for target in requested if metarule.ismatch(target)):
+                        if Rule.find_metarule(target) is metarule:
+                            yield target
+    
+    def direct(self,path,order_only=False):
+        """the existing rules that list path as a prerequisite. order_only - include
+        the rules that list it as an order only prerequisite."""
+        if ExplicitRule._unindexed:
+            self.update()
+        rules = list(self.index.get(path,()))
+        rules += [rule for regex,rule in self.wild if regex.match(path)]
+        if order_only:
+            rules += self.order_only_index.get(path,())
+            rules += [rule for regex,rule in self.order_only_wild if regex.match(path)]
+        return dedup(rules)
 
 
 ## build system user interface
 ##-----------------------------------------------------------------------------------------
 
+class RuleBatch(ExplicitRule):
+    """several explicit rules of a meta rule with the batch option that are run by
+    a single call of their recipe. Its targets, reqs, order_only and updated_only
+    are those of its rules put together, stems is the list of their stems and
+    members holds the rules themselves. Batches aren't stored in the artifact
+    cache and their resource usage is recorded against their first target."""
+    cacheable = False
+    
+    def __init__(self,members):
+        first = members[0]
+        super(RuleBatch,self).__init__([target for rule in members for target in rule.targets],
+                                       [req for rule in members for req in rule.allreqs],
+                                       dedup(req for rule in members for req in rule.order_only),
+                                       func=getattr(first,'func',None),PHONY=first.PHONY,register=False,
+                                       restat=first.restat,pool=first.pool,weight=first.weight)
+        self.members = members
+        self.stems = [getattr(rule,'stems',()) for rule in members]
+        self.signature_log = None #the signatures are the members' (see build)
+    
+    @property
+    def updated_only(self):
+        return dedup(req for rule in self.members for req in rule.updated_only)
+    
+    @property
+    def depfile_reqs(self):
+        reqs = [rule.depfile_reqs for rule in self.members]
+        return None if any(req is None for req in reqs) else dedup(itertools.chain(*reqs))
+    
+    def build(self):
+        res = super(RuleBatch,self).build()
+        if ExplicitRule.signature_log:
+            for rule in self.members:
+                ExplicitRule.signature_log.record(rule)
+        return res
+    
+    def _cut_off(self,done,unchanged):
+        return all(rule._cut_off(done,unchanged) for rule in self.members)
+
+
 class ManyRules(list):
     """subclass of list type for holding several rule instances, that can also be
     used as a decorator"""
@@ -702,8 +1159,33 @@ class Rule(BaseRule):
     targets and reqs may contain glob patterns (see fnmatch and glob modules).
     They may also contain the '%' wildcard for defining pattern rules (like
     make).
+    
+    options:
+        depfile - path of a Makefile syntax dependency file that the recipe writes
+            (i.e. with gcc -MD -MF). The prerequisites that it lists are used as
+            extra prerequisites for the rule by later builds. May contain the '%'
+            wildcard in pattern rules.
+        restat - after the recipe has run, check whether it actually changed the
+            targets. If it didn't then the rules that depend upon them are skipped
+            unless they are out of date for other reasons. True compares the targets'
+            modification times; 'hash' compares their contents too (the targets of
+            the rules that are skipped because of a rewritten but unchanged target
+            are touched, so that they're still up to date next time).
+        pool - name of the resource pool (see Rule.pools) that the recipe uses
+            when building in parallel (it still takes a job slot too).
+        weight - number of units of the pool (or of the job slots if there is no
+            pool) that the recipe takes, i.e. the memory a link step needs in GB.
+        batch - for pattern and wild rules (that aren't shared): the maximum number
+            of their explicit rules that are built by a single call of the recipe.
+            The rules that need building are put together into a RuleBatch, so the
+            recipe gets all of their targets, reqs and stems at once.
     """
     searchorder = [ExplicitRule,WildSharedRule,WildRule,PatternSharedRule,PatternRule]
+    _reverse_index = None # ReverseIndex, created by the first call of dependents()
+    _snapshot_size = None # number of resolved rules when the snapshot was last saved/loaded
+    _snapshot_args = None # (path,scripts) that Rule.main saves the snapshot with (see Rule.use_snapshot)
+    pools = {} # resource pool name:capacity used by parallel builds (see Rule.build)
+    _dir_mtimes = None # directory: mtime of the directories that wildcard expansions depend upon (see refresh_cache)
         
     @classmethod
     def get(cls,target,default=None):
@@ -717,35 +1199,444 @@ class Rule(BaseRule):
         return rule 
         #AssertionError("No target found for %r" %target)
     
+    @classmethod
+    def find_metarule(cls,target):
+        """the meta rule that get would individuate for the target, without
+        individuating it. None if the target already has a rule or no meta rule
+        matches it."""
+        if ExplicitRule.get(target):
+            return None
+        for subcls in cls.searchorder[1:]:
+            if target in subcls._instantiated_rules:
+                return None
+            metarule = subcls.find(target)
+            if metarule:
+                return metarule
+        return None
+    
     @classmethod
     def allrules(cls):
         """returns all of the defined rules (Explicit and Meta), this is mostly for
         debugging and inspection purposes"""
         rules = []
         for subcls in cls.searchorder:
-            rules+=subcls.rules.values()
+            rules+=subcls.rules.values() if subcls is ExplicitRule else subcls.registry().values()
         return dedup(rules)
     
     @classmethod
-    def calc_build(cls,target):
-        """calculate the build order to get system up to date"""    
-        toprule = cls.get(target)
-        if not toprule: raise AssertionError("No rule or file found for %r" %(target))
-        build_order = toprule.calc_build()
-        return build_order
+    def calc_build(cls,targets,changed=None):
+        """calculate the build order to get system up to date (an OrderedSet)
+        targets - a target or list of targets. The build orders of several targets
+            are calculated in one traversal (so shared prerequisites are only
+            checked once) and merged without duplicates.
+        changed - optional list of the files that have changed since the last build.
+            Only the rules downstream of these files are visited and everything
+            else is trusted to be up to date (without checking the file system)."""
+        return OrderedSet(cls.iter_build(targets,changed))
+    
+    @classmethod
+    def iter_build(cls,targets,changed=None):
+        """generator version of calc_build which yields the rules in build order as
+        soon as they are known to need building. Passing it straight to Rule.build
+        overlaps resolving the rest of the graph with running the recipes."""
+        toprules = []
+        for target in checkseq(targets):
+            toprule = cls.get(target)
+            if not toprule: raise AssertionError("No rule or file found for %r" %(target))
+            toprules.append(toprule)
+        
+        if changed is not None:
+            affected = cls.dependents(changed)
+            seen = set()
+            for target,toprule in zip(checkseq(targets),toprules):
+                if target in affected and toprule not in seen:
+                    for rule in toprule.calc_changed_build(affected,seen):
+                        yield rule
+            return
+        results = {}
+        for toprule in toprules:
+            if toprule not in results:
+                for rule in toprule.iter_build(_results=results):
+                    yield rule
     
     @classmethod
     def reset_cache(cls):
         """resets the memoize/cached_property/instantiated_rules caches"""
         for obj in [BaseRule,ExplicitTargetRule] + cls.searchorder:
             obj.reset_cache()
+        cls._reverse_index = None
+        #drop the individuated rules but keep the defined ones for indexing in definition order
+        registry = ExplicitRule.rules
+        ExplicitRule._unindexed[:] = [rule for rule in ExplicitRule._unindexed
+                                      if rule.targets and registry.get(rule.targets[0]) is rule]
+    
+    @classmethod
+    def refresh_cache(cls):
+        """checks the files in the stat cache for changes since they were stat'ed,
+        i.e. between the builds of a long running build server (see buildserver).
+        Changed files are dropped from the stat cache and the caches that depend
+        upon modification times are reset. A change to a directory (a file was
+        created, deleted or renamed) resets the wildcard expansions that depend
+        upon its listing, as does a directory that wasn't seen before. The
+        depfiles that were read are checked too. Returns the changed files."""
+        cache = BaseRule.get_mtime.cache
+        fpaths = list(cache)
+        changed = []
+        stat = os.stat
+        for fpath in fpaths:
+            try:
+                mtime = stat(fpath).st_mtime
+            except OSError:
+                mtime = None
+            if mtime != cache[fpath]:
+                changed.append(fpath)
+                del cache[fpath]
+        seen = set(changed)
+        for rule,deps in ExplicitRule.depfile_reqs.cache.items():
+            if rule.depfile and rule.depfile not in seen and not depfile.unchanged(rule.depfile,deps):
+                seen.add(rule.depfile)
+                changed.append(rule.depfile)
+        from snapshot import pattern_dirs
+        expanded = set(ExplicitTargetRule.allreqs.cache).union(ExplicitTargetRule.order_only.cache)
+        watchers = {} # directory: the expanded rules whose wildcards depend upon its listing
+        for rule in expanded:
+            for pattern in fpmatch.only_wild_paths(itertools.chain(rule._allreqs,rule._order_only)):
+                for dirname in pattern_dirs(pattern):
+                    watchers.setdefault(dirname,[]).append(rule)
+        stale = set()
+        old_mtimes = cls._dir_mtimes or {}
+        cls._dir_mtimes = {} #from now on the expansions record their directories (see _watch)
+        for dirname,rules in watchers.iteritems():
+            mtime = cls._dir_mtimes[dirname] = cls._mtime(dirname)
+            if mtime != old_mtimes.get(dirname,-1):
+                stale.update(rules) #unknown files may have been created or deleted
+        for rule in stale:
+            for method in ExplicitTargetRule.allreqs, ExplicitTargetRule.reqs, ExplicitTargetRule.order_only, ExplicitRule.updated_only:
+                method.cache.pop(rule,None)
+        cls.invalidate(changed)
+        return changed
     
     @staticmethod
-    def build(buildorder):
+    def _mtime(fpath):
+        try:
+            return os.stat(fpath).st_mtime
+        except OSError:
+            return None
+    
+    @classmethod
+    def _watch(cls,pattern):
+        """records the modification times of the directories that the expansion of
+        the wildcard pattern depends upon (unless they're known already), so that
+        refresh_cache can tell when they change"""
+        from snapshot import pattern_dirs
+        for dirname in pattern_dirs(pattern):
+            if dirname not in cls._dir_mtimes:
+                cls._dir_mtimes[dirname] = cls._mtime(dirname)
+    
+    @classmethod
+    def invalidate(cls,paths):
+        """forgets what is cached about the files at paths, i.e. after they were
+        changed, created or deleted while the rules stay loaded. Unlike reset_cache,
+        only the cached values that depend upon the paths are dropped:
+            - their stat cache entries
+            - _oldest_target and updated_only of the rules that build them
+            - updated_only of the rules that list them as prerequisites (found with
+              the reverse index, see dependents) and the wildcard expansions that
+              they match
+            - depfile_reqs of the rules whose depfiles they are
+        so that the next calc_build is incremental. The individuated rules are kept
+        as the choice of meta rule for a target doesn't depend upon the file system
+        (only their wildcard expansions do)."""
+        paths = set(checkseq(paths))
+        if not paths:
+            return
+        stat_cache = BaseRule.get_mtime.cache
+        oldest_target,updated_only = ExplicitRule._oldest_target.cache,ExplicitRule.updated_only.cache
+        for path in paths:
+            stat_cache.pop(path,None)
+            for subcls in cls.searchorder:
+                rule = subcls.rules.get(path) if subcls is ExplicitRule else subcls._instantiated_rules.get(path)
+                if rule is not None:
+                    oldest_target.pop(rule,None)
+                    updated_only.pop(rule,None)
+        
+        depfile_reqs = ExplicitRule.depfile_reqs.cache
+        rewritten = [rule for rule in depfile_reqs if rule.depfile in paths]
+        for rule in rewritten:
+            del depfile_reqs[rule]
+        
+        if not updated_only and not ExplicitTargetRule.allreqs.cache and cls._reverse_index is None:
+            return #nothing else has been cached yet
+        if cls._reverse_index is None:
+            cls._reverse_index = ReverseIndex(cls.searchorder[1:])
+        index = cls._reverse_index
+        index.update()
+        for rule in rewritten:
+            index.reindex_depfile(rule)
+        expansions = ExplicitTargetRule.allreqs, ExplicitTargetRule.reqs, ExplicitTargetRule.order_only
+        for path in paths:
+            for rule in index.direct(path,order_only=True):
+                updated_only.pop(rule,None)
+                if rule in ExplicitTargetRule.allreqs.cache and any(fpmatch.has_magic(req) and fpmatch.fnmatch(path,req)
+                                                                   for req in itertools.chain(rule._allreqs,rule._order_only)):
+                    for method in expansions:
+                        method.cache.pop(rule,None)
+    
+    @classmethod
+    def dependents(cls,paths,transitive=True):
+        """returns the targets that depend upon any of the paths (as an OrderedSet).
+        transitive - include the targets that depend upon those targets too, i.e.
+            everything that is affected by a change to the paths.
+        Order only prerequisites aren't followed, as a change to them doesn't make
+        their dependents out of date. The rules are left as they are: meta rules
+        aren't individuated for the targets that they would build (Rule.get gets
+        their rules) and the file system isn't searched, so a wild rule's targets
+        are only found when another rule asks for them. The reverse index that
+        answers this is built on first use and then kept up to date as new rules
+        are defined or individuated."""
+        if cls._reverse_index is None:
+            cls._reverse_index = ReverseIndex(cls.searchorder[1:])
+        index = cls._reverse_index
+        index.update()
+        
+        found = OrderedSet()
+        queue = collections.deque(checkseq(paths))
+        queued = set(queue)
+        while queue:
+            path = queue.popleft()
+            targets = [target for rule in index.direct(path) for target in rule.targets]
+            targets += index.meta_targets(path)
+            for target in targets:
+                if target in found: continue
+                found.add(target)
+                if transitive and target not in queued:
+                    queued.add(target)
+                    queue.append(target)
+        return found
+    
+    @staticmethod
+    def build(buildorder,jobs=1,pools=None,max_load=None,jobserver=None,progress=None):
+        """runs the rules in the build order. Rules whose prerequisite rules all
+        left their targets unchanged (see the restat option) are checked again
+        and skipped if they have become up to date.
+        jobs - number of recipes to run in parallel
+        pools - resource pool name:capacity dict (default: Rule.pools). A rule
+            only starts when its weight fits into what is left of its pool.
+        max_load - don't start new recipes while the load average is above this.
+        jobserver - a jobserver.JobServer that limits the jobs of this and any
+            nested builds (see Rule.main).
+        progress - a progress.Progress that is told as rules start and finish.
+        Rules with the batch option are run in batches (see Rule._batched).
+        A KeyError is raised for a rule in a pool that isn't in pools, before any
+        rules run unless the build order is an iterator (i.e. from iter_build)."""
+        done = set()
+        unchanged = set()
+        ExplicitRule._rewritten.clear()
+        pools = Rule.pools if pools is None else pools
+        if jobs != 1 and not isinstance(buildorder,collections.Iterator):
+            for rule in buildorder:
+                if rule.pool is not None and rule.pool not in pools:
+                    raise KeyError('unknown resource pool %r (for %s)' %(rule.pool,rule.targets[0]))
+        def members(task):
+            return task.members if isinstance(task,RuleBatch) else (task,)
+        buildorder = Rule._batched(buildorder)
+        if jobs == 1:
+            for task in buildorder:
+                if progress: progress.started(task)
+                if unchanged and task._cut_off(done,unchanged):
+                    unchanged.update(members(task))
+                    if progress: progress.finished(task,ran=False)
+                    done.update(members(task))
+                    continue
+                if task.build() is False:
+                    unchanged.update(members(task))
+                if progress: progress.finished(task)
+                done.update(members(task))
+            if progress: progress.resolved()
+            return
+        
+        batches = {} # rule: the batch that it is built in
+        def deps(task):
+            reqs = itertools.chain(task.order_only,task.reqs,task.depfile_reqs or ())
+            return dedup(batches.get(r,r) for r in (Rule.get(req,None) for req in reqs) if r in done and r is not task)
+        def resources(task):
+            if task.pool is None:
+                return {None:task.weight}
+            return {None:1,task.pool:task.weight}
+        def run(task):
+            if progress: progress.started(task)
+            ran = not (unchanged and task._cut_off(done,unchanged))
+            if not ran or task.build() is False:
+                unchanged.update(members(task))
+            if progress: progress.finished(task,ran)
+        def tasks():
+            #here done holds every rule taken from the build order so far. That is
+            #enough for _cut_off since a task's prerequisites finish before it starts.
+            for task in buildorder:
+                if progress: progress.add(task)
+                yield task
+                done.update(members(task))
+                if isinstance(task,RuleBatch):
+                    batches.update((rule,task) for rule in task.members)
+            if progress: progress.resolved()
+        Scheduler(jobs,pools,max_load,jobserver).run(tasks(),deps,run,resources)
+    
+    @staticmethod
+    def _batched(buildorder):
+        """the build order with the rules of each meta rule with the batch option
+        grouped into RuleBatches of up to batch rules. A group is held back until it
+        is full (or the build order ends) and so are the rules that depend upon the
+        rules that are held back, which are let through once those have been."""
+        groups = {} # metarule: [rules held back for its next batch]
+        held = set() # rules in the groups or waiting for held rules
+        waiters = {} # held rule: [rules waiting for it]
+        needs = {} # waiting rule: number of held rules that it is waiting for
+        ready = collections.deque() # rules (or full groups) to go through
+        def through():
+            while ready:
+                task = ready.popleft()
+                if isinstance(task,list): #a full group
+                    rules = task
+                    yield rules[0] if len(rules) == 1 else RuleBatch(rules)
+                else:
+                    reqs = itertools.chain(task.order_only,task.reqs,task.depfile_reqs or ())
+                    blockers = dedup(r for r in (Rule.get(req,None) for req in reqs) if r in held) if held else ()
+                    if blockers:
+                        held.add(task)
+                        needs[task] = len(blockers)
+                        for rule in blockers:
+                            waiters.setdefault(rule,[]).append(task)
+                        continue
+                    metarule = getattr(task,'metarule',None)
+                    if task.batch and metarule is not None:
+                        group = groups.setdefault(metarule,[])
+                        group.append(task)
+                        held.add(task)
+                        if len(group) >= task.batch:
+                            ready.appendleft(groups.pop(metarule))
+                        continue
+                    rules = [task]
+                    yield task
+                for rule in rules: #let through the rules that were waiting for these
+                    held.discard(rule)
+                    for waiter in waiters.pop(rule,()):
+                        needs[waiter] -= 1
+                        if not needs[waiter]:
+                            del needs[waiter]
+                            held.discard(waiter)
+                            ready.append(waiter)
         for task in buildorder:
-            task.build()
+            ready.append(task)
+            for task in through(): yield task
+        while groups: #first the groups that none of the waiting rules would join
+            joining = set(getattr(rule,'metarule',None) for rule in needs if rule.batch)
+            metarule = next((metarule for metarule in groups if metarule not in joining),next(iter(groups)))
+            ready.append(groups.pop(metarule))
+            for task in through(): yield task
+    
+    @staticmethod
+    def shard(buildorder,index,count,costs=None):
+        """returns the part of the build order (an OrderedSet) that shard index (out of
+        count, starting from 0) should build, so that a build can be split across
+        several machines without any coordination between them.
+        
+        Each rule that nothing else in the build order depends upon is a unit of
+        work together with all of its prerequisite rules. Units are assigned to the
+        least loaded shard, largest first, so the result only depends upon the build
+        order. Prerequisites shared by units in different shards are built by each of
+        those shards. PHONY rules without a recipe are only aggregates so they are
+        replaced by their prerequisites.
+        costs - optional target:cost dict (i.e. seconds taken by earlier builds).
+            Rules of unknown cost count as the average known cost or else as 1."""
+        order = list(buildorder)
+        position = dict((rule,i) for i,rule in enumerate(order))
+        deps = {}
+        for rule in order:
+            reqs = itertools.chain(rule.order_only,rule.reqs,rule.depfile_reqs or ())
+            deps[rule] = dedup(r for r in (Rule.get(req,None) for req in reqs) if r in position and r is not rule)
+        
+        costs = costs or {}
+        known = [costs[rule.targets[0]] for rule in order if rule.targets[0] in costs]
+        default = float(sum(known))/len(known) if known else 1.0
+        cost = dict((rule,costs.get(rule.targets[0],default)) for rule in order)
+        
+        required = set(r for rule in order for r in deps[rule])
+        units = []
+        pending = [rule for rule in order if rule not in required]
+        while pending:
+            rule = pending.pop(0)
+            if rule.PHONY and not hasattr(rule,'func') and deps[rule]:
+                pending.extend(r for r in deps[rule] if r not in units and r not in pending)
+            elif rule not in units:
+                units.append(rule)
+        
+        def closure(unit):
+            found = set()
+            stack = [unit]
+            while stack:
+                rule = stack.pop()
+                if rule not in found:
+                    found.add(rule)
+                    stack.extend(deps[rule])
+            return found
+        closures = dict((unit,closure(unit)) for unit in units)
+        units.sort(key=lambda unit: (-sum(cost[rule] for rule in closures[unit]),position[unit]))
+        
+        shards = [set() for i in range(count)]
+        loads = [0.0]*count
+        for unit in units:
+            i = min(range(count),key=lambda i: (loads[i],i))
+            loads[i] += sum(cost[rule] for rule in closures[unit] - shards[i])
+            shards[i].update(closures[unit])
+        return OrderedSet(rule for rule in order if rule in shards[index])
+    
+    @staticmethod
+    def use_signatures(path='.buildbit-signatures'):
+        """rebuild the rules whose recipes have changed since their targets were
+        built, keeping the recipes' signatures in the file at path (see the
+        signatures module). Returns the SignatureLog."""
+        from signatures import SignatureLog
+        if ExplicitRule.signature_log:
+            ExplicitRule.signature_log.close()
+        ExplicitRule.signature_log = SignatureLog(path)
+        return ExplicitRule.signature_log
+    
+    @staticmethod
+    def use_usage_log(path='.buildbit-usage'):
+        """measure the resources used by each recipe (wall and CPU time, max RSS
+        and block I/O), keeping them in the file at path (see the usage module).
+        Returns the UsageLog."""
+        import usage
+        if ExplicitRule.usage_log:
+            ExplicitRule.usage_log.close()
+        ExplicitRule.usage_log = usage.UsageLog(path)
+        return ExplicitRule.usage_log
+    
+    @staticmethod
+    def use_snapshot(path='.buildbit-snapshot',scripts=None):
+        """loads the snapshot at path (see Rule.load_snapshot) and has Rule.main
+        save it again after the builds that resolve more of the rules. It must be
+        called before the rule definitions, which are skipped when it returns True:
+            if not rule.use_snapshot():
+                rule(...) #rule definitions
+        """
+        Rule._snapshot_args = path,scripts
+        return Rule.load_snapshot(path,scripts)
+    
+    @staticmethod
+    def use_cache(cachedir,maxsize=1<<30,restore=('reflink','copy'),remote=None):
+        """use an artifact cache in cachedir to store and restore the outputs of
+        the rules' recipes (see cache.ArtifactCache). remote - url of a shared
+        cache server (see remotecache.RemoteCache) which is used in addition to
+        the local cache. Returns the cache instance."""
+        from cache import ArtifactCache
+        if remote:
+            from remotecache import RemoteCache
+            remote = RemoteCache(remote)
+        ExplicitRule.artifact_cache = ArtifactCache(cachedir,maxsize,restore,remote)
+        return ExplicitRule.artifact_cache
             
-    def __new__(cls,targets,reqs,order_only=None,func=None,PHONY=False,shared=False):
+    def __new__(cls,targets,reqs,order_only=None,func=None,PHONY=False,shared=False,**options):
         """selects and creates the appropriate rule class to use. All rule instances
         can also be used as decorators around build recipe functions (in this case
         leave func=None).
@@ -758,6 +1649,7 @@ class Rule(BaseRule):
             PHONY - a phony rule always runs irrespective of file modification times
             shared - shared rules run their build function a single time for all of
                 their targets.
+            options - see the class docstring.
         targets and reqs may contain glob patterns (see fnmatch and glob modules).
         They may also contain the '%' wildcard for defining pattern rules (like
         make).
@@ -766,60 +1658,350 @@ class Rule(BaseRule):
         reqs = checkseq(reqs)
         order_only = checkseq(order_only)
         
-        if shared:
-            if not any(fpmatch.has_magic(target) for target in targets):
-                targets = [fpmatch.strip_specials(target) for target in targets]
-                if not any(fpmatch.has_magic(req) for req in itertools.chain(reqs,order_only)):
-                    reqs = [fpmatch.strip_specials(req) for req in reqs]
-                    newrule = ExplicitRule(targets,reqs,order_only,func,PHONY)
+        rule_cls,targets,reqs = cls._classify(targets,reqs,order_only,shared)
+        if issubclass(rule_cls,MetaRule) or shared or len(targets)<=1:
+            return rule_cls(targets,reqs,order_only,func,PHONY,**options)
+        else: #or maybe use WildRule??
+            return ManyRules(rule_cls(target,reqs,order_only,func,PHONY,**options) for target in targets)
+    
+    @staticmethod
+    def _classify(targets,reqs,order_only,shared):
+        """the rule class for the targets and prerequisites (see Rule.__new__) along
+        with the targets and reqs, which lose their escapes if the rule is explicit.
+        Multiple targets of explicit rules that aren't shared need a rule each."""
+        if not fpmatch.has_meta('\0'.join(itertools.chain(targets,reqs,order_only))):
+            return ExplicitRule,targets,reqs
+        if not any(fpmatch.has_magic(target) for target in targets):
+            targets = [fpmatch.strip_specials(target) for target in targets]
+            if not any(fpmatch.has_magic(req) for req in itertools.chain(reqs,order_only)):
+                return ExplicitRule,targets,[fpmatch.strip_specials(req) for req in reqs]
+            return ExplicitTargetRule,targets,reqs
+        if any(fpmatch.has_pattern(target) for target in targets):
+            #in fact all targets should have a pattern wildcard but error checking will occur in class.
+            return (PatternSharedRule if shared else PatternRule),targets,reqs
+        return (WildSharedRule if shared else WildRule),targets,reqs #wildcard targets
+
+    @classmethod
+    def from_table(cls,targets,reqs=None,order_only=None,funcs=None,PHONY=False,shared=False,**options):
+        """defines many rules at once, i.e. from a generated manifest. Each argument
+        is a column with an entry per rule (just like the arguments of Rule()):
+            targets - iterable of targets (or sequences of targets)
+            reqs, order_only, funcs - iterables of the same length or None
+        PHONY, shared and options apply to every rule. Rows without any special
+        characters skip the pattern classification and all of the explicit rules
+        are registered together, with a single warning listing any targets whose
+        rules were overwritten. Returns the list of new rules."""
+        targets = [checkseq(row) for row in targets]
+        reqs = [checkseq(row) for row in reqs] if reqs is not None else [()]*len(targets)
+        order_only = [checkseq(row) for row in order_only] if order_only is not None else [()]*len(targets)
+        funcs = list(funcs) if funcs is not None else [None]*len(targets)
+        if not len(targets) == len(reqs) == len(order_only) == len(funcs):
+            raise ValueError('from_table columns have different lengths')
+        
+        newrules = []
+        explicit = [] # rules still to be registered
+        for row_targets,row_reqs,row_order_only,func in itertools.izip(targets,reqs,order_only,funcs):
+            erule_cls,row_targets,row_reqs = cls._classify(row_targets,row_reqs,row_order_only,shared)
+            if issubclass(erule_cls,MetaRule): #meta rules don't go in the explicit registry
+                newrules.append(erule_cls(row_targets,row_reqs,row_order_only,func,PHONY,**options))
+                continue
+            if shared or len(row_targets) <= 1:
+                rules = [erule_cls(row_targets,row_reqs,row_order_only,func,PHONY,register=False,**options)]
+                newrules += rules
+            else:
+                rules = [erule_cls(target,row_reqs,row_order_only,func,PHONY,register=False,**options) for target in row_targets]
+                newrules.append(ManyRules(rules))
+            explicit += rules
+        
+        registry = ExplicitRule.rules
+        overwritten = []
+        for rule in explicit:
+            for target in rule.targets:
+                if target in registry:
+                    overwritten.append(target)
+                registry[target] = rule
+        ExplicitRule._unindexed += explicit
+        if overwritten:
+            warnings.warn('ExplicitRules takes the last defined rule for each target. Overwrote the rules for %d targets: %s'
+                          %(len(overwritten),', '.join(repr(target) for target in overwritten[:10])+(', ...' if len(overwritten) > 10 else '')),stacklevel=2)
+        return newrules
+
+    @classmethod
+    def _resolved_rules(cls):
+        """every rule instance held in the registries and caches"""
+        rules = cls.allrules()
+        for subcls in cls.searchorder[1:]:
+            for metarule in subcls.registry().values():
+                rules += metarule.explicit_rules
+            rules += subcls._instantiated_rules.values()
+        return dedup(rules)
+    
+    @classmethod
+    def _resolved_count(cls):
+        """a measure of how much of the rule graph has been resolved"""
+        return len(cls._resolved_rules()) + len(ExplicitTargetRule.allreqs.cache)
+    
+    @classmethod
+    def save_snapshot(cls,path,scripts=None):
+        """saves the rule registries together with the individuated rules and
+        wildcard expansions that have been resolved so far (see snapshot module).
+        scripts - the build script files that define the rules (default: the
+            __main__ script). The snapshot is invalidated when they change.
+        Returns False if the snapshot couldn't be made (i.e. a recipe function
+        can't be referenced by its module and name)."""
+        import snapshot
+        scripts = snapshot.default_scripts() if scripts is None else scripts
+        rules = cls._resolved_rules()
+        ids = dict((rule,i) for i,rule in enumerate(rules))
+        table = snapshot.StringTable()
+        expanded_reqs = ExplicitTargetRule.allreqs.cache
+        expanded_order_only = ExplicitTargetRule.order_only.cache
+        patterns = []
+        records = []
+        try:
+            for rule in rules:
+                expanded = None
+                erules = []
+                if isinstance(rule,MetaRule):
+                    reqs,order_only,func = rule.allreqs,rule.order_only,rule._func
+                    erules = [ids[erule] for erule in rule.explicit_rules]
+                elif isinstance(rule,ExplicitTargetRule):
+                    reqs,order_only,func = rule._allreqs,rule._order_only,getattr(rule,'func',None)
+                    if rule in expanded_reqs and rule in expanded_order_only:
+                        expanded = (table.addseq(expanded_reqs[rule]),table.addseq(expanded_order_only[rule]))
+                        patterns += fpmatch.only_wild_paths(itertools.chain(reqs,order_only))
                 else:
-                    newrule = ExplicitTargetRule(targets,reqs,order_only,func,PHONY)
-            elif any(fpmatch.has_pattern(target) for target in targets):
-                #in fact all targets should have a pattern wildcard but error checking will occur in class.
-                newrule = PatternSharedRule(targets,reqs,order_only,func,PHONY)
-            else: #wildcard targets
-                newrule = WildSharedRule(targets,reqs,order_only,func,PHONY)
-        else:
-            if not any(fpmatch.has_magic(target) for target in targets):
-                targets = [fpmatch.strip_specials(target) for target in targets]
-                if not any(fpmatch.has_magic(req) for req in itertools.chain(reqs,order_only)):
-                    reqs = [fpmatch.strip_specials(req) for req in reqs]
-                    if len(targets)<=1:
-                        newrule = ExplicitRule(targets,reqs,order_only,func,PHONY)
-                    else:
-                        newrule = ManyRules(ExplicitRule(target,reqs,order_only,func,PHONY) for target in targets)
-                    #or maybe use WildRule??
+                    reqs,order_only,func = rule.allreqs,rule.order_only,getattr(rule,'func',None)
+                attrs = {}
+                attrs.update((name,rule.__dict__[name]) for name in rule.rule_options if name in rule.__dict__)
+                if isinstance(rule,MetaRule): attrs['options'] = rule.options
+                if hasattr(rule,'stems'): attrs['stems'] = tuple(rule.stems)
+                if hasattr(rule,'extratargetpath'): attrs['extratargetpath'] = rule.extratargetpath
+                if getattr(rule,'metarule',None) in ids: attrs['metarule'] = ids[rule.metarule]
+                records.append((rule.__class__.__name__,table.addseq(rule.targets),table.addseq(reqs),
+                                table.addseq(order_only),expanded,rule.PHONY,snapshot.func_ref(func),attrs,erules))
+        except snapshot.SnapshotError as e:
+            warnings.warn('Unable to save a snapshot of the rules: %s' %e,stacklevel=2)
+            return False
+        explicit = [(table.add(target),ids[rule]) for target,rule in ExplicitRule.rules.iteritems()]
+        metaregistries = [[(table.add(pattern),ids[rule]) for pattern,rule in subcls.registry().iteritems()]
+                          for subcls in cls.searchorder[1:]]
+        instantiated = [[(table.add(target),ids[rule]) for target,rule in subcls._instantiated_rules.iteritems()]
+                        for subcls in cls.searchorder[1:]]
+        body = (table.strings,records,explicit,metaregistries,instantiated)
+        snapshot.save(path,snapshot.make_header(scripts,patterns),body)
+        cls._snapshot_size = cls._resolved_count()
+        return True
+    
+    @classmethod
+    def load_snapshot(cls,path,scripts=None):
+        """replaces the rule registries with the contents of a snapshot saved
+        by save_snapshot. Returns False (and leaves the registries alone) if
+        there is no snapshot or it is out of date.
+        
+        A build script can skip defining its rules altogether when a snapshot
+        loads, as long as the recipe functions are defined beforehand:
+            if not rule.load_snapshot('build.snapshot'):
+                rule(...) #rule definitions
+        """
+        import snapshot
+        scripts = snapshot.default_scripts() if scripts is None else scripts
+        body = snapshot.load(path,scripts)
+        if body is None:
+            return False
+        strings,records,explicit,metaregistries,instantiated = body
+        getseq = snapshot.StringTable(strings).getseq
+        try:
+            funcs = [snapshot.resolve_func(record[6]) for record in records]
+        except snapshot.SnapshotError as e:
+            warnings.warn('Unable to load the snapshot %r: %s' %(path,e),stacklevel=2)
+            return False
+        
+        classes = dict((subcls.__name__,subcls) for subcls in [ExplicitTargetRule]+cls.searchorder)
+        rules = [object.__new__(classes[record[0]]) for record in records]
+        for rule,record,func in zip(rules,records,funcs):
+            name,targets,reqs,order_only,expanded,PHONY,fref,attrs,erules = record
+            rule.targets = getseq(targets)
+            rule.PHONY = PHONY
+            if isinstance(rule,MetaRule):
+                rule.allreqs = getseq(reqs)
+                rule.order_only = getseq(order_only)
+                rule.explicit_rules = [rules[i] for i in erules]
+                rule._func = func
+            else:
+                if isinstance(rule,ExplicitTargetRule):
+                    rule._allreqs = getseq(reqs)
+                    rule._order_only = getseq(order_only)
+                    if expanded:
+                        allreqs = ExplicitTargetRule.allreqs.cache[rule] = getseq(expanded[0])
+                        ExplicitTargetRule.reqs.cache[rule] = dedup(allreqs)
+                        ExplicitTargetRule.order_only.cache[rule] = getseq(expanded[1])
                 else:
-                    if len(targets)<=1:
-                        newrule = ExplicitTargetRule(targets,reqs,order_only,func,PHONY)
-                    else:
-                        newrule = ManyRules(ExplicitTargetRule(target,reqs,order_only,func,PHONY) for target in targets)
-                    #or maybe use WildRule??
-            elif any(fpmatch.has_pattern(target) for target in targets): 
-                #in fact all targets should have a pattern wildcard but error checking will occur in class.
-                newrule = PatternRule(targets,reqs,order_only,func,PHONY)
-            else: #wildcard targets
-                newrule = WildRule(targets,reqs,order_only,func,PHONY)
+                    rule.allreqs = getseq(reqs)
+                    rule.reqs = dedup(rule.allreqs)
+                    rule.order_only = getseq(order_only)
+                if func is not None: rule.func = func
+            for key,value in attrs.iteritems():
+                setattr(rule,key,value)
+            if 'metarule' in attrs:
+                rule.metarule = rules[attrs['metarule']]
         
-        return newrule
-
+        ExplicitRule.rules.clear()
+        ExplicitRule.rules.update((strings[target],rules[i]) for target,i in explicit)
+        for subcls,registry,cached in zip(cls.searchorder[1:],metaregistries,instantiated):
+            subcls._clear_registry()
+            for pattern,i in registry:
+                subcls._register(strings[pattern],rules[i])
+            subcls._instantiated_rules = dict((strings[target],rules[i]) for target,i in cached)
+        cls._snapshot_size = cls._resolved_count()
+        cls._reverse_index = None
+        del ExplicitRule._unindexed[:]
+        return True
+    
     @staticmethod
-    def main():
-        """command line interface for buildbit system"""
+    def _argparser():
+        """the command line options of Rule.main (also used by the build server)"""
         import argparse
 
         parser = argparse.ArgumentParser(description='The buildbit build system (a python version of make)')
-        parser.add_argument('target',default='All',help='select build target')
+        parser.add_argument('targets',nargs='*',default=['All'],metavar='target',help='select build targets (default: All)')
         parser.add_argument('-n','--dry-run',dest='dryrun',action='store_true',help='only print build sequence')
-        args = parser.parse_args()
+        parser.add_argument('--cache',dest='cachedir',help='artifact cache directory')
+        parser.add_argument('--cache-size',dest='cachesize',type=int,default=1024,help='artifact cache size limit in MB')
+        parser.add_argument('--remote-cache',dest='remotecache',metavar='URL',help='shared artifact cache server')
+        parser.add_argument('--signatures',metavar='FILE',help='rebuild the targets whose recipes have changed, keeping their signatures in FILE')
+        parser.add_argument('--changed',nargs='+',metavar='FILE',help='only rebuild what depends upon these files')
+        def shard(text):
+            try:
+                index,count = [int(n) for n in text.split('/')]
+            except ValueError:
+                raise argparse.ArgumentTypeError('expected i/N, not %r' %text)
+            if not 1 <= index <= count:
+                raise argparse.ArgumentTypeError('shard %d is not between 1 and %d' %(index,count))
+            return index-1,count
+        parser.add_argument('--shard',type=shard,metavar='i/N',help='only build shard i of N of the build sequence, balanced by the --timings of earlier builds (every shard must see the same file)')
+        parser.add_argument('-j','--jobs',type=int,help='number of recipes to run in parallel (default: 1 or as many as the parent make allows)')
+        parser.add_argument('-l','--load-average',dest='maxload',type=float,help="don't start new recipes while the load average is above this")
+        def pool(text):
+            name,sep,capacity = text.partition('=')
+            if not sep or not capacity.isdigit():
+                raise argparse.ArgumentTypeError('expected NAME=CAPACITY, not %r' %text)
+            return name,int(capacity)
+        parser.add_argument('--pool',type=pool,action='append',default=[],metavar='NAME=CAPACITY',help='set the capacity of a resource pool')
+        parser.add_argument('--progress',choices=('line','json'),help='report progress and an ETA on stderr as a status line or as json events')
+        parser.add_argument('--timings',metavar='FILE',default='.buildbit-timings',help='how long each rule took (recorded with --progress), for the ETA and to balance the shards (default: %(default)s)')
+        parser.add_argument('--report',type=int,nargs='?',const=10,metavar='N',help="measure the recipes' resource usage and list the top N (default: 10) slowest and most memory-hungry")
+        parser.add_argument('--report-file',dest='reportfile',metavar='FILE',help="measure the recipes' resource usage and export it to FILE (.csv or .json)")
+        parser.add_argument('--mem-profile',dest='memprofile',action='store_true',help='report the memory used by the rule definitions and the graph resolution (see memprofile). The whole graph is then resolved before any recipe runs, rather than while they run')
+        parser.add_argument('--serve',metavar='SOCKET',help='stay resident and serve build requests from buildserver.py clients on this unix socket')
+        return parser
+    
+    @staticmethod
+    def main(argv=None):
+        """command line interface for buildbit system"""
+        parser = Rule._argparser()
+        args = parser.parse_args(argv)
+        if args.serve:
+            def build(argv):
+                built = []
+                try:
+                    Rule._run(parser.parse_args(argv),built)
+                finally: #the recipes changed their targets and depfiles
+                    Rule.invalidate([path for rule in built for path in itertools.chain(rule.targets,[rule.depfile] if rule.depfile else ())])
+            from buildserver import BuildServer
+            import snapshot
+            server = BuildServer(args.serve,build,Rule.refresh_cache,snapshot.default_scripts())
+            print 'Serving builds at %r' %args.serve
+            server.serve()
+        else:
+            Rule._run(args)
+    
+    @staticmethod
+    def _run(args,announced=None):
+        """builds the targets given by the parsed command line options. The build
+        sequence is appended to announced as it is run."""
+        pools = dict(Rule.pools) #a build server's later requests don't get this one's pools
+        pools.update(args.pool)
         
-        print 'Building target:', args.target
-        buildseq = Rule.calc_build(args.target)
-        if args.dryrun:
-            print 'Build sequence:'
-            for item in buildseq: print item
+        #take job slots from the parent make's jobserver or else provide one to the recipes
+        jobserver = JobServer.from_environ()
+        makeflags = os.environ.get('MAKEFLAGS')
+        if jobserver:
+            jobs = args.jobs or jobserver.jobs or 1024 #the jobserver's tokens are the real limit
         else:
+            jobs = args.jobs or 1
+            if jobs > 1:
+                jobserver = JobServer.create(jobs)
+                jobserver.export()
+        try:
+            profile = None
+            if args.memprofile:
+                from memprofile import MemoryProfile
+                profile = MemoryProfile()
+                profile.measure('rule definitions') #everything that the build script did before main
+            
+            if args.remotecache and not args.cachedir:
+                args.cachedir = '.buildbit-cache'
+            if args.cachedir:
+                Rule.use_cache(args.cachedir,maxsize=args.cachesize<<20,remote=args.remotecache)
+            if args.signatures and not (ExplicitRule.signature_log and ExplicitRule.signature_log.path == args.signatures):
+                Rule.use_signatures(args.signatures)
+            measure = (args.report is not None or args.reportfile) and not args.dryrun
+            if measure and not ExplicitRule.usage_log:
+                Rule.use_usage_log()
+            
+            print 'Building target:', ' '.join(args.targets)
+            announced = [] if announced is None else announced
+            def announce(buildseq):
+                for item in buildseq:
+                    print item
+                    announced.append(item)
+                    yield item
             print 'Build sequence:'
-            for item in buildseq: print item
-            Rule.build(buildseq)
+            buildseq = Rule.iter_build(args.targets,changed=args.changed)
+            if args.shard:
+                from progress import Timings
+                costs = Timings(args.timings).durations
+                buildseq = Rule.shard(buildseq,*args.shard,costs=costs) #needs the whole build sequence
+            if profile: #sizing the resolved graph means resolving it before building (see --mem-profile's help)
+                with profile.phase('graph resolution',lambda: buildseq):
+                    buildseq = OrderedSet(buildseq)
+            buildseq = announce(buildseq)
+            if args.dryrun:
+                for item in buildseq: pass
+            elif args.progress:
+                from progress import Progress, Timings
+                progress = Progress(Timings(args.timings),jobs,args.progress)
+                def counted(buildseq):
+                    #the total grows while the graph is still being resolved
+                    for item in buildseq:
+                        progress.add(item)
+                        yield item
+                    progress.resolved()
+                try:
+                    Rule.build(counted(buildseq),jobs=jobs,pools=pools,max_load=args.maxload,jobserver=jobserver,progress=progress)
+                finally:
+                    progress.close()
+            else:
+                #recipes start running while the graph is still being resolved
+                Rule.build(buildseq,jobs=jobs,pools=pools,max_load=args.maxload,jobserver=jobserver)
+            if Rule._snapshot_args and Rule._snapshot_size != Rule._resolved_count():
+                Rule.save_snapshot(*Rule._snapshot_args)
+            if args.cachedir and not args.dryrun:
+                print ExplicitRule.artifact_cache.report()
+            if profile:
+                print profile.report()
+            if measure:
+                built = [rule.targets[0] for rule in announced]
+                if args.report is not None:
+                    print ExplicitRule.usage_log.report(args.report,built)
+                if args.reportfile:
+                    ExplicitRule.usage_log.export(args.reportfile,built)
+        finally:
+            if jobserver and jobserver.owner: #put back the environment for the next build (see buildserver)
+                jobserver.close()
+                if makeflags is None:
+                    os.environ.pop('MAKEFLAGS',None)
+                else:
+                    os.environ['MAKEFLAGS'] = makeflags
 
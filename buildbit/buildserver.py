@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+"""A resident build server and its thin client. Part of the Buildbit package.
+
+Starting python, importing the build script, defining the rules and statting
+the tree all happen before a build can even begin. A build script run with
+    python build.py --serve SOCKET
+stays resident instead (see Rule.main) and keeps the rule registries, the
+individuated rules and the stat cache warm between builds. Builds are then
+requested with the client in this module, which only uses the standard library
+so it starts quickly:
+    python buildserver.py SOCKET [build options and targets]
+The client streams back the build's output (including the recipes' output)
+and exits with its status. Builds run in the server's working directory and
+environment, not the client's.
+
+Builds run one at a time. A request for exactly the same build as one that is
+queued or running is attached to it instead of building again. Before each
+build (and after it, while the server is idle) the files in the stat cache are
+checked for changes (see Rule.refresh_cache). When the build scripts change,
+the server restarts itself and the clients resend their requests.
+
+Protocol: the client sends a json line {"argv": [...]}. The server replies with
+frames of a kind byte, a 4 byte big-endian length and the data:
+    'o' - output, 'x' - exit status (as text), 'r' - restarting, try again.
+"""
+import os
+import sys
+import json
+import time
+import errno
+import Queue
+import socket
+import struct
+import threading
+import traceback
+import SocketServer
+
+_header = struct.Struct('>cI')
+
+
+def send_frame(sock,kind,data=''):
+    sock.sendall(_header.pack(kind,len(data))+data)
+
+def recv_frame(fobj):
+    """reads a frame from the file object. Returns (None, '') at the end."""
+    header = fobj.read(_header.size)
+    if len(header) < _header.size:
+        return None,''
+    kind,length = _header.unpack(header)
+    return kind,fobj.read(length)
+
+
+class BuildJob(object):
+    """a requested build and its output so far, shared by all of the requests
+    for the same build"""
+    def __init__(self,argv):
+        self.argv = argv
+        self.output = []
+        self.status = None
+        self.restart = False
+        self.done = False
+        self.cond = threading.Condition()
+
+    def write(self,data):
+        with self.cond:
+            self.output.append(data)
+            self.cond.notify_all()
+
+    def finish(self,status=0,restart=False):
+        with self.cond:
+            self.status = status
+            self.restart = restart
+            self.done = True
+            self.cond.notify_all()
+
+    def stream(self):
+        """yields the frames of the output (from the beginning) as it arrives and
+        then the exit status"""
+        i = 0
+        while True:
+            with self.cond:
+                while i == len(self.output) and not self.done:
+                    self.cond.wait()
+                chunks = self.output[i:]
+                i += len(chunks)
+                done = self.done
+            for chunk in chunks:
+                yield 'o',chunk
+            if done and i == len(self.output):
+                break
+        yield ('r','') if self.restart else ('x',str(self.status))
+
+
+class BuildRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return #i.e. a probe for a running server
+        try:
+            argv = json.loads(line)['argv']
+            if not isinstance(argv,list): raise TypeError
+            argv = [str(arg) for arg in argv]
+        except (ValueError,KeyError,TypeError):
+            send_frame(self.request,'o','bad build request\n')
+            send_frame(self.request,'x','2')
+            return
+        job = self.server.submit(argv)
+        try:
+            for kind,data in job.stream():
+                send_frame(self.request,kind,data)
+        except socket.error:
+            pass #the client went away but the build carries on
+
+
+class BuildServer(SocketServer.ThreadingMixIn,SocketServer.UnixStreamServer):
+    """serves build requests on the unix socket at path.
+    build(argv) - runs a build given its command line arguments
+    refresh() - invalidates the caches for the files that changed
+    scripts - the build scripts. The server restarts when they change."""
+    daemon_threads = True
+
+    def __init__(self,path,build,refresh,scripts=(),handler=BuildRequestHandler):
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                os.unlink(path) #left behind by a server that didn't shut down cleanly
+            else:
+                raise socket.error(errno.EADDRINUSE,'a build server is already running at %r' %path)
+            finally:
+                probe.close()
+        SocketServer.UnixStreamServer.__init__(self,path,handler)
+        self.path = path
+        self.build = build
+        self.refresh = refresh
+        self.scripts = dict((fpath,self._mtime(fpath)) for fpath in scripts)
+        self.jobs = {} # argv tuple: queued or running BuildJob
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.restart_requested = False
+        builder = threading.Thread(target=self._builder)
+        builder.daemon = True
+        builder.start()
+
+    @staticmethod
+    def _mtime(fpath):
+        try:
+            return os.path.getmtime(fpath)
+        except OSError:
+            return None
+
+    def submit(self,argv):
+        """queues a build, or returns the queued or running job for the same build"""
+        with self.lock:
+            job = self.jobs.get(tuple(argv))
+            if job is None:
+                job = self.jobs[tuple(argv)] = BuildJob(argv)
+                self.queue.put(job)
+            return job
+
+    def _builder(self):
+        while True:
+            job = self.queue.get()
+            if any(self._mtime(fpath) != mtime for fpath,mtime in self.scripts.iteritems()):
+                self._restart()
+                return
+            self.refresh() #changes made since the last build
+            status = self._run(job)
+            with self.lock:
+                del self.jobs[tuple(job.argv)] #later requests need a new build
+            job.finish(status)
+            self.refresh() #the build's own changes, while nobody is waiting
+
+    def _run(self,job):
+        """runs the job's build with its output (and the recipes' output) going to
+        the job. Returns the exit status."""
+        sys.stdout.flush(); sys.stderr.flush()
+        rfd,wfd = os.pipe()
+        saved = os.dup(1),os.dup(2)
+        pump = threading.Thread(target=self._pump,args=(rfd,job))
+        pump.start()
+        os.dup2(wfd,1)
+        os.dup2(wfd,2)
+        os.close(wfd)
+        status = 0
+        try:
+            self.build(job.argv)
+        except SystemExit as e: #i.e. from argparse
+            if e.code is None or isinstance(e.code,int):
+                status = e.code or 0
+            else:
+                print >>sys.stderr, e.code
+                status = 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout.flush(); sys.stderr.flush()
+            os.dup2(saved[0],1)
+            os.dup2(saved[1],2)
+            os.close(saved[0]); os.close(saved[1])
+            pump.join()
+        return status
+
+    @staticmethod
+    def _pump(rfd,job):
+        while True:
+            data = os.read(rfd,1<<16)
+            if not data: break
+            job.write(data)
+        os.close(rfd)
+
+    def _restart(self):
+        """tells the waiting clients to try again and stops serving (see serve)"""
+        self.restart_requested = True
+        with self.lock:
+            jobs = self.jobs.values()
+            self.jobs.clear()
+        for job in jobs:
+            job.finish(restart=True)
+        threading.Thread(target=self.shutdown).start()
+
+    def serve(self):
+        """serves until interrupted. Restarts the process if the build scripts
+        have changed."""
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server_close()
+        if self.restart_requested:
+            print 'Build scripts changed, restarting'
+            sys.stdout.flush()
+            os.execv(sys.executable,[sys.executable]+sys.argv)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def request(path,argv,out=None,timeout=30):
+    """asks the build server at path to run a build with the command line
+    arguments argv. Writes its output to out (default: stdout) and returns the
+    exit status. Waits up to timeout seconds for a restarting server."""
+    out = sys.stdout if out is None else out
+    deadline = time.time() + timeout
+    restarting = False
+    while True:
+        sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        try:
+            try:
+                sock.connect(path)
+            except socket.error:
+                if not restarting or time.time() > deadline: raise
+                time.sleep(0.1)
+                continue
+            sock.sendall(json.dumps({'argv':list(argv)})+'\n')
+            fobj = sock.makefile('rb',0)
+            kind,data = recv_frame(fobj)
+            while kind == 'o':
+                out.write(data)
+                out.flush()
+                kind,data = recv_frame(fobj)
+            if kind == 'x':
+                return int(data)
+            if kind is None and not restarting:
+                raise socket.error('the build server closed the connection')
+            restarting = True #or the connection was to the old server as it shut down
+            if time.time() > deadline:
+                raise socket.error('the build server did not restart')
+        finally:
+            sock.close()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-h','--help'):
+        print 'usage: python buildserver.py SOCKET [build options and targets]'
+        print 'asks the build server (started with: python build.py --serve SOCKET) to run a build'
+        return 0 if argv else 2
+    try:
+        return request(argv[0],argv[1:])
+    except socket.error as e:
+        print >>sys.stderr, 'unable to reach the build server at %r: %s' %(argv[0],e)
+        return 2
+
+if __name__=="__main__":
+    sys.exit(main())
@@ -0,0 +1,412 @@
+"""A local content-addressed artifact cache. Part of the Buildbit package.
+
+The outputs of a rule are stored under a key made from a digest of the rule's
+recipe, the contents of its prerequisites (including those listed in its
+depfile) and the names of its targets. When an entry exists for a rule's key,
+its targets (and depfile) are restored from the cache instead of running the
+recipe.
+
+The prerequisites in a depfile are only known once the recipe has run, so a
+rule with a depfile is looked up in two steps. The list of its depfile's
+prerequisites is stored under a key of its recipe, prerequisites and targets,
+and that list gives the contents for the rule's key. A clean checkout without
+any depfiles can then still be restored from the cache.
+
+Cache directory layout:
+    objects/ab/abcdef...  - file contents, named by their sha1 digest
+    actions/12/123456...  - json manifests of [target, digest, mode] for a key
+                            (or the list of a depfile's prerequisites)
+"""
+import os
+import os.path
+import re
+import stat
+import errno
+import shutil
+import hashlib
+import json
+import tempfile
+import warnings
+import threading
+from types import StringTypes
+
+from utils import dedup
+import depfile
+
+
+def _file_sha1(fpath):
+    """sha1 of a file's contents (directories are digested by their listing)"""
+    h = hashlib.sha1()
+    if os.path.isdir(fpath):
+        h.update('dir\0' + '\0'.join(sorted(os.listdir(fpath))))
+    else:
+        with open(fpath,'rb') as fobj:
+            for block in iter(lambda: fobj.read(1<<16), ''):
+                h.update(block)
+    return h.hexdigest()
+
+_digests = {} # fpath: (mtime, size, digest)
+_valid_digest = re.compile('^[0-9a-f]{40}$')
+
+def file_digest(fpath):
+    """sha1 of a file's contents. Digests are remembered until the file's
+    modification time or size changes."""
+    st = os.stat(fpath)
+    entry = _digests.get(fpath)
+    if entry and entry[0] == st.st_mtime and entry[1] == st.st_size:
+        return entry[2]
+    digest = _file_sha1(fpath)
+    _digests[fpath] = (st.st_mtime, st.st_size, digest)
+    return digest
+
+def recipe_identity(func):
+    """a string identifying a recipe. Command strings are used as they are,
+    python functions are identified by their name and compiled code."""
+    if isinstance(func,StringTypes):
+        return 'cmd\0' + func
+    elif isinstance(func,list):
+        return 'cmdseq\0' + '\0'.join(func)
+    code = getattr(func,'__code__',None)
+    if code is None and callable(func):
+        code = getattr(getattr(func,'__call__',None),'__code__',None)
+    if code is None:
+        return 'obj\0' + repr(func)
+    name = '%s.%s' %(getattr(func,'__module__',''),getattr(func,'__name__',''))
+    return 'func\0%s\0%s\0%r' %(name,code.co_code,code.co_consts)
+
+
+def _reflink(src,dst):
+    """copy-on-write clone of src (linux FICLONE ioctl)"""
+    import fcntl
+    FICLONE = 0x40049409
+    with open(src,'rb') as fsrc:
+        with open(dst,'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(),FICLONE,fsrc.fileno())
+            except IOError as e:
+                raise OSError(e.errno,e.strerror)
+
+
+def _remove(path):
+    """removes path unless it's already gone (i.e. evicted by another build
+    sharing the cache)"""
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT: raise
+
+
+def _valid_manifest(manifest,targets):
+    """checks a manifest from a remote cache, whose digests become file paths"""
+    try:
+        return ([target for target,digest,mode in manifest] == list(targets) and
+                all(isinstance(digest,basestring) and _valid_digest.match(digest) and isinstance(mode,int)
+                    for target,digest,mode in manifest))
+    except (TypeError,ValueError):
+        return False
+
+
+class ArtifactCache(object):
+    """A size bounded cache of rule outputs. The least recently used objects
+    are evicted once the cache grows beyond maxsize bytes.
+
+    restore - sequence of methods to try in order when restoring a target from
+        the cache: 'hardlink', 'reflink' or 'copy'. Hardlinks are fastest but
+        share their contents with the cache, so a recipe that later rewrites
+        the target in place would corrupt the cached copy.
+    remote - optional shared backend (see remotecache.RemoteCache). It is
+        consulted on local misses and receives a copy of every stored entry.
+    The cache can be shared by the threads of a parallel build.
+    """
+    restore_methods = ('hardlink','reflink','copy')
+
+    def __init__(self,cachedir,maxsize=1<<30,restore=('reflink','copy'),remote=None):
+        for method in restore:
+            if method not in self.restore_methods:
+                raise AssertionError("unknown restore method %r" %method)
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.restore = restore
+        self.remote = remote
+        self.objdir = os.path.join(cachedir,'objects')
+        self.actiondir = os.path.join(cachedir,'actions')
+        self.stats = {'hits':0,'misses':0,'remote_hits':0,'stores':0,'evictions':0}
+        self._size = None #total size of the objects, calculated on first use
+        self.lock = threading.Lock() #guards the cache directory, stats and size
+
+    def key(self,rule,deps=None):
+        """digest of the rule's recipe, the contents of its prerequisites (and
+        of those in its depfile) and the names of its targets.
+        deps - the prerequisites listed in the rule's depfile (default: those in
+            rule.depfile_reqs or, when the depfile hasn't been written yet, the
+            list stored with the rule's outputs by store_rule)
+        Returns None if the key can't be made, i.e. a prerequisite is missing."""
+        base = self._base_key(rule)
+        if base is None or not rule.depfile:
+            return base
+        if deps is None:
+            deps = rule.depfile_reqs
+        if deps is None:
+            deps = self._read_deps(base)
+            if deps is None:
+                return None
+        h = hashlib.sha1(base)
+        try:
+            for req in deps:
+                h.update('\0depfile req\0%s\0%s' %(req,file_digest(req)))
+        except (OSError,IOError):
+            return None
+        return h.hexdigest()
+
+    def _base_key(self,rule):
+        """the key without the depfile's prerequisites"""
+        h = hashlib.sha1()
+        h.update(recipe_identity(rule.func))
+        try:
+            for req in rule.allreqs:
+                h.update('\0req\0%s\0%s' %(req,file_digest(req)))
+        except (OSError,IOError):
+            return None
+        for target in rule.targets:
+            h.update('\0target\0' + target)
+        return h.hexdigest()
+
+    @staticmethod
+    def _deps_key(base):
+        return hashlib.sha1('depfile reqs\0' + base).hexdigest()
+
+    def _read_deps(self,base):
+        """the list of depfile prerequisites stored for a rule's base key or None"""
+        dkey = self._deps_key(base)
+        with self.lock:
+            deps = self._read_action(dkey)
+        if deps is None and self.remote:
+            try:
+                deps = self.remote.get_action(dkey)
+            except (EnvironmentError,ValueError) as e:
+                warnings.warn('remote artifact cache lookup failed: %s' %e)
+        if not (isinstance(deps,list) and all(isinstance(req,basestring) for req in deps)):
+            return None
+        return deps
+
+    def _path(self,basedir,digest):
+        return os.path.join(basedir,digest[:2],digest[2:])
+
+    def _read_action(self,key):
+        """returns the manifest stored for key or None"""
+        apath = self._path(self.actiondir,key)
+        try:
+            with open(apath) as fobj:
+                manifest = json.load(fobj)
+        except (IOError,ValueError):
+            return None
+        os.utime(apath,None)
+        return manifest
+
+    def _write(self,path,writer):
+        """atomically creates path by calling writer on a temporary file path"""
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try: os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname): raise
+        fd,tmp = tempfile.mkstemp(dir=dirname,prefix='.tmp')
+        os.close(fd)
+        try:
+            writer(tmp)
+            os.rename(tmp,path)
+        except:
+            os.remove(tmp)
+            raise
+
+    def _restore_file(self,src,dst):
+        dirname = os.path.dirname(dst)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        for method in self.restore:
+            if os.path.lexists(dst):
+                os.remove(dst)
+            try:
+                if method == 'hardlink':
+                    os.link(src,dst)
+                elif method == 'reflink':
+                    _reflink(src,dst)
+                else:
+                    shutil.copyfile(src,dst)
+                break
+            except (OSError,IOError):
+                continue
+        else:
+            raise OSError("Unable to restore %r from the artifact cache" %dst)
+        os.utime(dst,None) #restored targets must be newer than their prerequisites
+
+    def _restore_action(self,key,targets):
+        """restores the targets from the local cache. Returns True on success."""
+        manifest = self._read_action(key)
+        if manifest is None or [entry[0] for entry in manifest] != list(targets):
+            return False
+        blobs = [self._path(self.objdir,digest) for target,digest,mode in manifest]
+        if not all(os.path.isfile(blob) for blob in blobs):
+            #objects have been evicted since the manifest was written
+            _remove(self._path(self.actiondir,key))
+            return False
+        for (target,digest,mode),blob in zip(manifest,blobs):
+            os.utime(blob,None) #mark as recently used
+            self._restore_file(blob,target)
+            os.chmod(target,mode)
+        return True
+
+    def _download_action(self,key,targets):
+        """copies the remote entry for key into the local cache"""
+        manifest = self.remote.get_action(key)
+        if not _valid_manifest(manifest,targets):
+            return False
+        missing = dedup((digest,self._path(self.objdir,digest)) for target,digest,mode in manifest
+                        if not os.path.isfile(self._path(self.objdir,digest)))
+        if not self.remote.get_blobs(missing):
+            return False
+        with self.lock:
+            for digest,blob in missing:
+                self._add_size(os.path.getsize(blob))
+            self._write_action(key,manifest)
+        return True
+
+    def fetch(self,key,targets):
+        """restores the targets stored under key. Returns True on a cache hit."""
+        with self.lock:
+            hit = self._restore_action(key,targets)
+        remote_hit = False
+        if not hit and self.remote:
+            try:
+                if self._download_action(key,targets):
+                    with self.lock:
+                        hit = remote_hit = self._restore_action(key,targets)
+            except EnvironmentError as e:
+                warnings.warn('remote artifact cache lookup failed: %s' %e)
+        with self.lock:
+            self.stats['hits' if hit else 'misses'] += 1
+            if remote_hit:
+                self.stats['remote_hits'] += 1
+                self._evict()
+        return hit
+
+    def store(self,key,targets):
+        """copies the targets into the cache under key. Targets that are not
+        regular files can't be cached. Returns True if the targets were stored."""
+        if not all(os.path.isfile(target) for target in targets):
+            return False
+        manifest = []
+        with self.lock:
+            for target in targets:
+                digest = file_digest(target)
+                blob = self._path(self.objdir,digest)
+                if os.path.isfile(blob):
+                    os.utime(blob,None)
+                else:
+                    self._write(blob,lambda tmp: shutil.copyfile(target,tmp))
+                    self._add_size(os.path.getsize(blob))
+                manifest.append([target,digest,stat.S_IMODE(os.stat(target).st_mode)])
+            self._write_action(key,manifest)
+            self.stats['stores'] += 1
+        if self.remote:
+            try:
+                self.remote.put_blobs(dedup((digest,self._path(self.objdir,digest)) for target,digest,mode in manifest))
+                self.remote.put_action(key,manifest)
+            except EnvironmentError as e:
+                warnings.warn('remote artifact cache upload failed: %s' %e)
+        self.evict()
+        return True
+
+    def store_rule(self,rule,outputs):
+        """stores the outputs of a rule whose recipe has just run. The
+        prerequisites in its newly written depfile are recorded so that key can
+        find them before the depfile exists. Returns True if the outputs were
+        stored."""
+        deps = None
+        if rule.depfile:
+            deps = depfile.read_deps(rule.depfile)
+            if deps is None:
+                return False
+        key = self.key(rule,deps)
+        if key is None or not self.store(key,outputs):
+            return False
+        if rule.depfile:
+            dkey = self._deps_key(self._base_key(rule))
+            with self.lock:
+                self._write_action(dkey,deps)
+            if self.remote:
+                try:
+                    self.remote.put_action(dkey,deps)
+                except EnvironmentError as e:
+                    warnings.warn('remote artifact cache upload failed: %s' %e)
+        return True
+
+    def _write_action(self,key,manifest):
+        def write_manifest(tmp):
+            with open(tmp,'w') as fobj:
+                json.dump(manifest,fobj)
+        self._write(self._path(self.actiondir,key),write_manifest)
+
+    def _walk(self,basedir):
+        """yields (path, stat) of every entry stored below basedir"""
+        if not os.path.isdir(basedir):
+            return
+        for sub in os.listdir(basedir):
+            subdir = os.path.join(basedir,sub)
+            for name in os.listdir(subdir):
+                if name.startswith('.tmp'): continue
+                path = os.path.join(subdir,name)
+                try:
+                    yield path, os.stat(path)
+                except OSError:
+                    pass
+
+    def size(self):
+        """total size in bytes of the cached objects"""
+        with self.lock:
+            return self._total_size()
+
+    def _total_size(self):
+        if self._size is None:
+            self._size = sum(st.st_size for path,st in self._walk(self.objdir))
+        return self._size
+
+    def _add_size(self,nbytes):
+        if self._size is not None:
+            self._size += nbytes
+
+    def evict(self):
+        """removes the least recently used objects until the cache fits within
+        maxsize. Manifests which are no more recent than the evicted objects are
+        removed too since they will refer to missing objects."""
+        with self.lock:
+            self._evict()
+
+    def _evict(self):
+        if self._total_size() <= self.maxsize:
+            return
+        entries = sorted(self._walk(self.objdir),key=lambda entry: entry[1].st_mtime)
+        cutoff = None
+        for path,st in entries:
+            if self._size <= self.maxsize:
+                break
+            _remove(path)
+            self._size -= st.st_size
+            self.stats['evictions'] += 1
+            cutoff = st.st_mtime
+        if cutoff is not None:
+            for path,st in self._walk(self.actiondir):
+                if st.st_mtime <= cutoff:
+                    _remove(path)
+
+    def hit_rate(self):
+        with self.lock:
+            hits,lookups = self.stats['hits'],self.stats['hits'] + self.stats['misses']
+        return float(hits)/lookups if lookups else 0.0
+
+    def report(self):
+        """a one line summary of the cache statistics"""
+        return ('artifact cache: %(hits)d hits (%(remote_hits)d remote), %(misses)d misses' %self.stats +
+                ' (%.1f%% hit rate), %d stored, %d evicted, %.1f MB used' %(
+                100*self.hit_rate(),self.stats['stores'],self.stats['evictions'],
+                self.size()/float(1<<20)))
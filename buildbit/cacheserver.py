@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""A reference remote artifact cache server for buildbit (standard library only).
+
+Serves the protocol used by remotecache.RemoteCache from a directory:
+    GET/HEAD/PUT /cas/<sha1>  - file contents, checked against their digest on upload
+    GET/PUT      /ac/<key>    - action results
+
+usage: python cacheserver.py [--host HOST] [--port PORT] directory
+"""
+import os
+import os.path
+import re
+import hashlib
+import tempfile
+import BaseHTTPServer
+import SocketServer
+
+_valid_name = re.compile('^[0-9a-f]{40}$')
+
+
+class CacheRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' #keep connections alive between requests
+    quiet = True
+
+    def _fpath(self):
+        """maps the request path onto the storage directory or returns None"""
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] not in ('ac','cas') or not _valid_name.match(parts[1]):
+            return None, None, None
+        kind,name = parts
+        return kind, name, os.path.join(self.server.directory,kind,name[:2],name[2:])
+
+    def _reply(self,status,data=''):
+        self.send_response(status)
+        self.send_header('Content-Length',str(len(data)))
+        self.end_headers()
+        if data and self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def do_GET(self):
+        kind,name,fpath = self._fpath()
+        if fpath is None:
+            return self._reply(400)
+        try:
+            with open(fpath,'rb') as fobj:
+                data = fobj.read()
+        except IOError:
+            return self._reply(404)
+        self._reply(200,data)
+
+    do_HEAD = do_GET
+
+    def do_PUT(self):
+        kind,name,fpath = self._fpath()
+        length = int(self.headers.getheader('Content-Length') or 0)
+        data = self.rfile.read(length)
+        if fpath is None:
+            return self._reply(400)
+        if kind == 'cas' and hashlib.sha1(data).hexdigest() != name:
+            return self._reply(400,'digest mismatch')
+        dirname = os.path.dirname(fpath)
+        if not os.path.isdir(dirname):
+            try: os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname): raise
+        fd,tmp = tempfile.mkstemp(dir=dirname,prefix='.tmp')
+        with os.fdopen(fd,'wb') as fobj:
+            fobj.write(data)
+        os.rename(tmp,fpath)
+        self._reply(200)
+
+    def log_message(self,format,*args):
+        if not self.quiet:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self,format,*args)
+
+
+class CacheServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+    """threaded http server storing the cache entries in directory"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self,directory,address=('127.0.0.1',0),handler=CacheRequestHandler):
+        self.directory = directory
+        BaseHTTPServer.HTTPServer.__init__(self,address,handler)
+
+    @property
+    def url(self):
+        host,port = self.server_address[:2]
+        return 'http://%s:%d/' %(host,port)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='reference remote artifact cache server for buildbit')
+    parser.add_argument('directory',help='storage directory')
+    parser.add_argument('--host',default='127.0.0.1',help='address to listen on')
+    parser.add_argument('--port',type=int,default=8080,help='port to listen on')
+    parser.add_argument('-v','--verbose',action='store_true',help='log requests')
+    args = parser.parse_args()
+
+    CacheRequestHandler.quiet = not args.verbose
+    server = CacheServer(args.directory,(args.host,args.port))
+    print 'Serving buildbit cache from %r at %s' %(args.directory,server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__=="__main__":
+    main()
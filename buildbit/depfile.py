@@ -0,0 +1,84 @@
+"""Reading Makefile syntax dependency files (as written by gcc -MD/-MMD). Part
+of the Buildbit package.
+
+A depfile looks like:
+    foo.o: foo.c foo.h \\
+     include/bar\\ baz.h
+    foo.h:
+where the second entry is a phony target as written by gcc's -MP flag. Spaces
+in paths are escaped with a backslash, '#' as '\\#' and '$' as '$$'.
+
+Parsed files are cached and only re-parsed when their modification time or
+size changes.
+"""
+import os
+
+_cache = {} # path: (mtime, size, deps)
+
+
+def _words(line):
+    """splits a line into words, unescaping spaces, '#' and '$'"""
+    words = []
+    word = []
+    i, n = 0, len(line)
+    while i < n:
+        c = line[i]
+        if c == '\\' and i+1 < n and line[i+1] in ' \t#':
+            word.append(line[i+1])
+            i += 2
+            continue
+        if c == '$' and i+1 < n and line[i+1] == '$':
+            word.append('$')
+            i += 2
+            continue
+        if c in ' \t':
+            if word: words.append(''.join(word))
+            word = []
+        else:
+            word.append(c)
+        i += 1
+    if word: words.append(''.join(word))
+    return words
+
+def parse(text):
+    """parses the contents of a depfile into a list of (targets, deps) entries"""
+    text = text.replace('\\\r\n',' ').replace('\\\n',' ')
+    entries = []
+    for line in text.splitlines():
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        words = _words(line)
+        for i,word in enumerate(words):
+            if word.endswith(':'):
+                targets = words[:i] + ([word[:-1]] if word != ':' else [])
+                entries.append((targets,words[i+1:]))
+                break
+        else:
+            raise ValueError('no targets found in depfile line %r' %line)
+    return entries
+
+def read_deps(path):
+    """returns the prerequisites listed in the depfile at path (without duplicates
+    and in order) or None if the depfile doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    entry = _cache.get(path)
+    if entry and entry[0] == st.st_mtime and entry[1] == st.st_size:
+        return entry[2]
+    with open(path) as fobj:
+        entries = parse(fobj.read())
+    seen = set()
+    deps = [dep for targets,reqs in entries for dep in reqs if not (dep in seen or seen.add(dep))]
+    _cache[path] = (st.st_mtime,st.st_size,deps)
+    return deps
+
+def unchanged(path,deps):
+    """is the depfile at path still as it was when read_deps returned deps?"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return deps is None
+    entry = _cache.get(path)
+    return entry is not None and entry[2] is deps and entry[0] == st.st_mtime and entry[1] == st.st_size
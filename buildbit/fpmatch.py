@@ -5,13 +5,20 @@ Copyright (C) 2015  Robert Steed
 
 import re
 import os.path
+import posixpath
 import imp
+import collections
 
 def translate(pat):
     """Translate a shell PATTERN to a regular expression.
 
     There is no way to quote meta-characters.
     """
+    return translate_unanchored(pat) + '\Z(?ms)'
+
+def translate_unanchored(pat):
+    """translate without the end anchor and flags, for use inside a larger
+    regular expression"""
     i, n = 0, len(pat)
     res = ''
     wildcard = '[^/]*' if os.path.sep is '/' else '[^/'+re.escape(os.path.sep)+']*'
@@ -47,7 +54,7 @@ def translate(pat):
                 res = '%s[%s]' % (res, stuff)
         else:
             res = res + re.escape(c)
-    return res + '\Z(?ms)'
+    return res
 
 
 # Bring in fnmatches other functions
@@ -55,10 +62,90 @@ _fpmatch = imp.load_module('_fpmatch', *imp.find_module('fnmatch'))
 _fpmatch.translate = translate #monkey patch!
 from _fpmatch import *
 
+
+class PatternCache(object):
+    """A least recently used cache of compiled glob patterns. Unlike fnmatch's
+    cache, which is emptied whenever it grows past 100 patterns, this only drops
+    the least recently used patterns once it is full."""
+    def __init__(self,maxsize=1024):
+        self.maxsize = maxsize
+        self.clear()
+
+    def clear(self):
+        self.regexes = collections.OrderedDict() # pattern: regex, most recently used last
+        self.hits = self.misses = self.evictions = 0
+
+    def resize(self,maxsize):
+        self.maxsize = maxsize
+        while len(self.regexes) > maxsize:
+            self.regexes.popitem(last=False)
+            self.evictions += 1
+
+    def get(self,pat):
+        """the compiled regular expression for the (already normcase'd) pattern"""
+        try:
+            regex = self.regexes.pop(pat)
+            self.hits += 1
+        except KeyError:
+            regex = re.compile(translate(pat))
+            self.misses += 1
+            if len(self.regexes) >= self.maxsize:
+                self.regexes.popitem(last=False)
+                self.evictions += 1
+        self.regexes[pat] = regex
+        return regex
+
+    def stats(self):
+        return {'size':len(self.regexes),'maxsize':self.maxsize,'hits':self.hits,
+                'misses':self.misses,'evictions':self.evictions}
+
+cache = PatternCache()
+
 def precompile(pat):
     """pre-compile the glob pattern into a compiled regular expression"""
-    regex = translate(os.path.normcase(pat))
-    return re.compile(regex)
+    return cache.get(os.path.normcase(pat))
+
+def fnmatch(name,pat):
+    """Test whether FILENAME matches PATTERN (after case-normalizing both if the
+    operating system requires it)"""
+    return cache.get(os.path.normcase(pat)).match(os.path.normcase(name)) is not None
+
+def fnmatchcase(name,pat):
+    """Test whether FILENAME matches PATTERN, including case."""
+    return cache.get(pat).match(name) is not None
+
+def filter(names,pat):
+    """Return the subset of the list NAMES that match PAT"""
+    match = cache.get(os.path.normcase(pat)).match
+    if os.path is posixpath: # normcase is a NOP
+        return [name for name in names if match(name)]
+    return [name for name in names if match(os.path.normcase(name))]
+
+def filter_many(names,patterns):
+    """matches many patterns against the list NAMES in a single pass over it.
+    Returns a pattern:[matching names] dict. Each name is only tried against the
+    patterns whose literal prefix and suffix it has (see PatternIndex)."""
+    index = PatternIndex()
+    byregex = {} # normcase'd pattern: patterns
+    res = {}
+    for pat in patterns:
+        if pat in res: continue
+        res[pat] = []
+        normpat = os.path.normcase(pat)
+        if normpat not in byregex:
+            index.add(normpat)
+        byregex.setdefault(normpat,[]).append(pat)
+    if not byregex:
+        return res
+    regexes = dict((normpat,cache.get(normpat).match) for normpat in byregex)
+    posix = os.path is posixpath
+    for name in names:
+        normname = name if posix else os.path.normcase(name)
+        for normpat in index.candidates(normname):
+            if regexes[normpat](normname):
+                for pat in byregex[normpat]:
+                    res[pat].append(name)
+    return res
 
 
 #
@@ -66,94 +153,87 @@ def precompile(pat):
 meta_check = re.compile('[*?%[]') 
 
 def has_meta(s):
-    return magic_check.search(s) is not None
+    """quick test for any of the special characters (escaped or not). Strings
+    without them need neither has_magic nor strip_specials."""
+    return meta_check.search(s) is not None
+
+# A glob is split into tokens by _tokens: '[' followed by one character (other
+# than '!') and ']' is an escaped literal, otherwise '[' starts a set that runs
+# up to the next ']' (a leading '!' and then a leading ']' are part of the set)
+# and a '[' without a later closing bracket is a literal. The alternatives
+# don't overlap so the regex never backtracks into a different reading.
+_tokens = re.compile(r"""
+     (?P<escape>\[[^!]\])
+    |(?P<set>\[(?:!\][^\]]*|!(?!\])[^\]]*|\][^\]]*|(?![!\]])[^\]]*)\])
+    |(?P<wild>[*?%])
+    |(?P<literal>[^[*?%]+|\[)""",re.VERBOSE|re.DOTALL)
+# count_patterns has always skipped from a '[' to the next ']' (no escapes or
+# leading ']' in sets) so it keeps its own tokens.
+_pattern_tokens = re.compile(r'\[[^\]]*\]|%',re.DOTALL)
+
+PathClass = collections.namedtuple('PathClass','magic patterns literal prefix suffix')
+_classified = {} # path: PathClass
+
+def classify(s):
+    """classifies a glob in a single pass. Returns a PathClass of:
+        magic - whether it has unescaped metacharacters (see has_magic)
+        patterns - the number of pattern (%) wildcards (see count_patterns)
+        literal - the glob with the special characters stripped (see strip_specials)
+        prefix, suffix - the literal text before the first and after the last
+            wildcard or set (the whole literal if there are none)
+    The results are memoized for each distinct string."""
+    try:
+        return _classified[s]
+    except KeyError:
+        pass
+    parts = [] # literal text
+    magic = False
+    prefix = None
+    suffix = []
+    for token in _tokens.finditer(s):
+        kind = token.lastgroup
+        if kind == 'literal':
+            text = token.group()
+        elif kind == 'escape':
+            text = s[token.start()+1]
+        else:
+            if prefix is None: prefix = ''.join(parts)
+            magic = True
+            suffix = []
+            continue
+        parts.append(text)
+        suffix.append(text)
+    literal = ''.join(parts)
+    patterns = _pattern_tokens.findall(s).count('%') if '%' in s else 0
+    res = _classified[s] = PathClass(magic,patterns,literal,literal if prefix is None else prefix,''.join(suffix))
+    return res
 
 def has_magic(s):
     """tests whether a string contains unescaped metacharacters. This tests for the
     presence of *?% characters and any sets [...] or [!...] with the exception of
     sets that contain only a single entry (which is the only way of escaping the
     metacharacters)."""
-    i, n = 0, len(s)
-    res = False
-    while i < n:
-        c = s[i]
-        i = i+1
-        if c in ('*','?','%'):
-            res = True
-        elif c == '[':
-            j = i
-            if j+1 < n and s[j+1] == ']' and s[j] != '!': #special case to escape (a set with only one item)
-                i = i+2
-                continue
-            if j < n and s[j] == '!':
-                j = j+1
-            if j < n and s[j] == ']':
-                j = j+1
-            #corner cases:
-            #[] or [!] treated as literals if no later closing bracket found, 
-            #otherwise ']' is included in the set of choices.
-            while j < n and s[j] != ']':
-                j = j+1
-            if j >= n:
-                pass #corner case for when no close bracket is found.
-            else:
-                i = j+1
-                res = True
-    return res
+    return classify(s).magic
 
 def strip_specials(pat):
     """Strip all the special characters from a pattern. This will be used to 
     find the best match when there are multiple matching patterns.
     """
-    i, n = 0, len(pat)
-    res = ''
-    while i < n:
-        c = pat[i]
-        i = i+1
-        if c in ('*','?','%'):
-            pass
-        elif c == '[':
-            j = i
-            if j+1 < n and pat[j+1] == ']' and pat[j] != '!': #special case to escape (a set with only one item)
-                res = res + pat[j]
-                i = i+2
-                continue
-            if j < n and pat[j] == '!':
-                j = j+1
-            if j < n and pat[j] == ']':
-                j = j+1
-            #corner cases:
-              #[] or [!] treated as literals if no later closing bracket found, 
-              #otherwise ']' is included in the set of choices.
-            while j < n and pat[j] != ']':
-                j = j+1
-            if j >= n:
-                res = res + '[' #another corner case for when no close bracket is found.
-            else:
-                i = j+1
-        else:
-            res += c
-    return res
+    return classify(pat).literal
+
+def literal_prefix(pat):
+    """the literal text before the first wildcard or set in a pattern"""
+    return classify(pat).prefix
+
+def literal_suffix(pat):
+    """the literal text after the last wildcard or set in a pattern (this is
+    used for indexing patterns by the endings of the paths they can match)."""
+    return classify(pat).suffix
 
 def count_patterns(s):
     """count number of pattern (%) wildcards in glob.
     """
-    i, n = 0, len(s)
-    res = 0
-    while i < n:
-        c = s[i]
-        i = i+1
-        if c == '%':
-            res += 1
-        elif c == '[':
-            j = i
-            while j < n and s[j] != ']':
-                j = j+1
-            if j >= n:
-                pass #bracket never closed so treating [ as a literal
-            else:
-                i = j+1
-    return res
+    return classify(s).patterns
 
 def has_pattern(s):
     """find if glob contains a pattern (%) wildcard."""
@@ -164,3 +244,44 @@ def only_explicit_paths(seq):
 
 def only_wild_paths(seq):
     return [path for path in seq if has_magic(path)]
+
+
+class PatternIndex(object):
+    """An index of glob patterns by their literal prefixes and suffixes, for
+    quickly narrowing down the patterns that could match a path. The candidates
+    still have to be matched properly."""
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.index = {} # prefix: {suffix: [patterns]}
+        self.count = 0
+        self._lengths = None # (prefix lengths, {prefix: suffix lengths})
+
+    def __len__(self):
+        return self.count
+
+    def add(self,pattern):
+        suffixes = self.index.setdefault(literal_prefix(pattern),{})
+        suffix = literal_suffix(pattern) if has_magic(pattern) else '' #else the prefix is the whole pattern
+        suffixes.setdefault(suffix,[]).append(pattern)
+        self.count += 1
+        self._lengths = None
+
+    def candidates(self,path):
+        """the patterns that path starts with the prefix and ends with the suffix of"""
+        if self._lengths is None:
+            self._lengths = (sorted(set(len(prefix) for prefix in self.index)),
+                             dict((prefix,sorted(set(len(suffix) for suffix in suffixes)))
+                                  for prefix,suffixes in self.index.iteritems()))
+        prefix_lengths,suffix_lengths = self._lengths
+        res = []
+        for n in prefix_lengths:
+            prefix = path[:n]
+            suffixes = self.index.get(prefix)
+            if suffixes is None: continue
+            for m in suffix_lengths[prefix]:
+                if n + m > len(path): break
+                patterns = suffixes.get(path[len(path)-m:])
+                if patterns: res += patterns
+        return res
@@ -0,0 +1,126 @@
+"""The GNU make jobserver protocol. Part of the Buildbit package.
+
+A jobserver is a pipe (or with make 4.4, a named fifo) holding one byte, a
+token, for each job slot except the one that every process implicitly owns.
+A process takes a token before starting each extra job and writes it back
+once the job has finished, so the whole tree of nested makes and buildbits
+never runs more jobs than the top level -j option allows. Its location is
+passed down to subprocesses in the MAKEFLAGS environment variable:
+    MAKEFLAGS=' -j8 --jobserver-auth=3,4'
+    MAKEFLAGS=' -j8 --jobserver-auth=fifo:/tmp/GMfifo1234'
+(older makes used --jobserver-fds). Only POSIX systems are supported.
+"""
+import os
+import re
+import errno
+import warnings
+
+_auth = re.compile(r'--jobserver-(?:auth|fds)=(?:fifo:(\S+)|(\d+),(\d+))')
+_jobs = re.compile(r'(?:^|\s)-j(\d+)')
+
+
+class JobServer(object):
+    def __init__(self,rfd,wfd,fifo=None,jobs=None):
+        """rfd, wfd - file descriptors of the token pipe
+        fifo - path of the token fifo (rfd and wfd are ignored)
+        jobs - the -j value of the top level build if known"""
+        self.jobs = jobs
+        self.fifo = fifo
+        self.owner = False
+        if fifo:
+            self.rfd = os.open(fifo,os.O_RDONLY|os.O_NONBLOCK) #first, so opening for writing doesn't block
+            self.wfd = os.open(fifo,os.O_WRONLY)
+            self.rfd_inherited = None
+        else:
+            self.wfd = wfd
+            self.rfd_inherited = rfd
+            self.rfd = self._open_nonblocking(rfd)
+
+    @staticmethod
+    def _open_nonblocking(rfd):
+        """a non-blocking file descriptor for reading tokens. The pipe is reopened
+        (on linux) rather than changing the shared file's flags, which would also
+        change them for make and the other processes using the jobserver."""
+        try:
+            return os.open('/proc/self/fd/%d' %rfd,os.O_RDONLY|os.O_NONBLOCK)
+        except OSError:
+            return None #fall back to select() before blocking reads
+
+    @classmethod
+    def from_environ(cls,environ=None):
+        """the parent's jobserver or None if there isn't one (or its pipe wasn't
+        passed on to this process, i.e. the make rule wasn't marked with '+')"""
+        environ = os.environ if environ is None else environ
+        flags = environ.get('MAKEFLAGS','')
+        res = _auth.search(flags)
+        if not res:
+            return None
+        jobs = _jobs.search(flags)
+        jobs = int(jobs.group(1)) if jobs else None
+        fifo,rfd,wfd = res.group(1),res.group(2),res.group(3)
+        try:
+            if fifo:
+                return cls(None,None,fifo=fifo,jobs=jobs)
+            rfd,wfd = int(rfd),int(wfd)
+            if rfd < 0 or wfd < 0: #make -j1 passes -2,-2
+                return None
+            os.fstat(rfd),os.fstat(wfd)
+            return cls(rfd,wfd,jobs=jobs)
+        except OSError:
+            warnings.warn('jobserver in MAKEFLAGS is not available (prefix the make recipe line with +)',stacklevel=2)
+            return None
+
+    @classmethod
+    def create(cls,jobs):
+        """a new jobserver with jobs slots for when buildbit is the top level build"""
+        rfd,wfd = os.pipe()
+        server = cls(rfd,wfd,jobs=jobs)
+        server.owner = True
+        os.write(wfd,'+'*(jobs-1))
+        return server
+
+    def makeflags(self):
+        """the MAKEFLAGS value that passes this jobserver on to subprocesses"""
+        if self.fifo:
+            auth = '--jobserver-auth=fifo:%s' %self.fifo
+        else:
+            auth = '--jobserver-auth=%d,%d --jobserver-fds=%d,%d' %((self.rfd_inherited,self.wfd)*2)
+        return ' -j%d %s' %(self.jobs,auth) if self.jobs else ' '+auth
+
+    def export(self,environ=None):
+        """sets MAKEFLAGS so that recipes (and nested makes) use this jobserver"""
+        environ = os.environ if environ is None else environ
+        flags = _auth.sub('',_jobs.sub('',environ.get('MAKEFLAGS',''))).strip()
+        environ['MAKEFLAGS'] = self.makeflags() + (' '+flags if flags else '')
+
+    def try_acquire(self):
+        """takes a token without waiting. Returns it or None if none are free."""
+        try:
+            if self.rfd is None:
+                import select
+                if not select.select([self.rfd_inherited],[],[],0)[0]:
+                    return None
+                token = os.read(self.rfd_inherited,1) #may block if another process wins the token
+            else:
+                token = os.read(self.rfd,1)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN,errno.EINTR):
+                return None
+            raise
+        return token or None
+
+    def release(self,token):
+        """gives a token back"""
+        os.write(self.wfd,token)
+
+    def close(self):
+        """closes the file descriptors that this object opened"""
+        owned = [self.rfd]
+        if self.owner or self.fifo: owned += [self.wfd,self.rfd_inherited]
+        for fd in set(owned):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self.rfd = self.wfd = self.rfd_inherited = None
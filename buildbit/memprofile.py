@@ -0,0 +1,143 @@
+"""Memory profiling of rule definition and graph resolution. Part of the
+Buildbit package.
+
+A MemoryProfile measures the phases of a build run (see Rule.main's
+--mem-profile option) and after each phase sizes the structures that grow
+with the graph:
+    registries - the explicit and meta rule registries and their indexes
+    rules - the rules defined by the build script
+    individuated rules - the explicit rules created from the meta rules
+    cached_property <name> - the per-rule caches of allreqs, reqs etc.
+    glob results - the cached allreqs/order_only of rules with wildcard reqs
+    memoize caches - the stat cache and fpmatch's pattern caches
+    build sequence - the OrderedSet of rules to build
+Each object is counted once, under the first of these that holds it (so a
+target's name is counted with the registry that holds it rather than with
+the rule). The OrderedSet's internal nodes can't be measured directly and are
+estimated.
+
+Each phase also has the process's peak RSS at its end and how much it grew
+during the phase.
+"""
+import sys
+import time
+import types
+import resource
+from contextlib import contextmanager
+
+from orderedset import OrderedSet
+
+_opaque = (type,types.ModuleType,types.FunctionType,types.BuiltinFunctionType,types.MethodType)
+_entry_size = sys.getsizeof([None,None,None]) # an estimate of an OrderedSet node (key, prev, next)
+
+
+def deep_size(roots,seen,stop=()):
+    """bytes used by the roots and the objects that they hold, skipping those in
+    seen (a set of ids, which is updated) and those that are instances of stop
+    (other than the roots themselves)"""
+    total = 0
+    stack = list(reversed(roots))
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj,OrderedSet):
+            total += len(obj)*_entry_size + sys.getsizeof(set(obj)) - sys.getsizeof(set())
+        stack.extend(item for item in _contents(obj) if item is not None and not isinstance(item,stop))
+    return total
+
+def _contents(obj):
+    if isinstance(obj,dict):
+        return obj.keys() + obj.values()
+    if isinstance(obj,(list,tuple,set,frozenset,OrderedSet)):
+        return list(obj)
+    if isinstance(obj,_opaque) or not hasattr(obj,'__dict__'):
+        return []
+    return [vars(obj)]
+
+
+def structures(buildseq=None):
+    """list of (name, bytes) of the structures that grow with the graph (see the
+    module docstring). buildseq - the build sequence, if there is one."""
+    import bob
+    from utils import cached_property
+    import fpmatch
+
+    metaclasses = [cls for cls in bob.Rule.searchorder if issubclass(cls,bob.MetaRule)]
+    individuated = [rule for cls in metaclasses for rule in cls._instantiated_rules.itervalues()]
+    seen = set()
+    sizes = []
+    def add(name,roots,stop=bob.BaseRule):
+        sizes.append((name,deep_size(roots,seen,stop)))
+
+    add('registries',[bob.ExplicitRule.rules,bob.ExplicitRule._unindexed,bob.MetaRule._regexes]
+        +[getattr(cls,attr) for cls in metaclasses for attr in 'rules','_pattern_rankings','_index','_unregistered'])
+    for rule in individuated: seen.add(id(rule)) #so that they aren't counted as defined rules
+    defined = [rule for rule in bob.ExplicitRule.rules.itervalues() if id(rule) not in seen]
+    metarules = [rule for cls in metaclasses for rule in cls.rules.itervalues()]
+    add('rules',defined+metarules)
+    for rule in individuated: seen.discard(id(rule))
+    add('individuated rules',[cls._instantiated_rules for cls in metaclasses]+individuated)
+
+    #the cached values of the rules that expand wildcards in their reqs are glob results
+    props = []
+    for cls in bob.ExplicitRule,bob.ExplicitTargetRule:
+        for name,prop in sorted(vars(cls).iteritems()):
+            if isinstance(prop,cached_property):
+                props.append((name,prop.cache))
+    globbed = []
+    for name,cache in props:
+        if name in ('allreqs','order_only'):
+            raw = '_allreqs' if name == 'allreqs' else '_order_only'
+            globbed += [value for rule,value in cache.iteritems() if any(fpmatch.has_magic(req) for req in getattr(rule,raw,()))]
+    add('glob results',globbed)
+    for name,cache in props:
+        add('cached_property %s' %name,[cache])
+    add('memoize caches',[bob.BaseRule.get_mtime.cache,bob.Rule._dir_mtimes,fpmatch.cache.regexes,fpmatch._classified])
+    add('build sequence',[buildseq] if buildseq is not None else [])
+    return sizes
+
+
+class MemoryProfile(object):
+    """measures the memory used by the phases of a build run (see phase) and
+    reports on them"""
+    def __init__(self):
+        self.phases = [] # (name, seconds, {'peak rss','peak rss growth'}, [(structure,bytes)])
+        self.rss = 0
+
+    @staticmethod
+    def _maxrss():
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss<<10
+
+    @contextmanager
+    def phase(self,name,buildseq=lambda: None):
+        """measures the with block. buildseq - returns the build sequence afterwards
+        (so that it can be sized)"""
+        start = time.time()
+        yield
+        self.measure(name,time.time()-start,buildseq())
+
+    def measure(self,name,seconds=0.0,buildseq=None):
+        """records a phase which has already happened (i.e. the rule definitions
+        from before the profile was started)"""
+        rss = self._maxrss()
+        memory = {'peak rss':rss,'peak rss growth':rss - self.rss}
+        self.rss = rss
+        self.phases.append((name,seconds,memory,structures(buildseq)))
+
+    def report(self):
+        lines = ['Memory profile:']
+        for name,seconds,memory,sizes in self.phases:
+            lines.append('  %s (%.2fs): %s' %(name,seconds,', '.join('%s %s' %(key,_mb(value)) for key,value in sorted(memory.items()))))
+            for structure,size in sizes:
+                if size: lines.append('    %-32s %10s' %(structure,_mb(size)))
+        return '\n'.join(lines)
+
+
+def _mb(size):
+    if abs(size) < 1<<20:
+        return '%.1fKB' %(size/1024.0)
+    return '%.1fMB' %(size/1048576.0)
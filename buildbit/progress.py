@@ -0,0 +1,190 @@
+"""Progress reports for long builds. Part of the Buildbit package.
+
+Progress keeps running totals of the rules that have been queued, started and
+finished, so each event costs the same however big the build is. The ETA is
+the expected time of the unfinished rules, taken from how long each one took
+the last time that it was built (see Timings), divided between the job slots.
+Rules without a recorded time are expected to take the mean of the recorded
+times. Without any recorded times the ETA comes from the build's throughput
+so far.
+
+Progress is either a status line that is rewritten in place (on a terminal,
+otherwise a line is printed at most every interval seconds) or a json line
+for each event:
+    {"event": "finished", "target": "a.o", "done": 12, "total": 40, ...}
+"""
+import sys
+import json
+import time
+import threading
+
+from utils import TargetLog
+
+
+class Timings(TargetLog):
+    """the durations of the rules' last runs, kept in a log file of
+    "seconds<TAB>target" lines (see utils.TargetLog)"""
+    description = 'build timings'
+    parse = staticmethod(float)
+
+    def __init__(self,path):
+        super(Timings,self).__init__(path)
+        self.durations = self.values # target: seconds
+
+    @staticmethod
+    def format(seconds):
+        return '%.3f' %seconds
+
+    def get(self,rule):
+        """how long the rule took last time (or None)"""
+        return self.durations.get(rule.targets[0])
+
+    def record(self,rule,seconds):
+        self.write([(rule.targets[0],seconds)])
+
+
+class Progress(object):
+    """counts the rules of a build as Rule.build runs them and reports on them
+    timings - a Timings instance for the expected durations (recorded as rules finish)
+    jobs - number of job slots that the remaining time is divided between
+    mode - 'line' for a status line or 'json' for a json line per event
+    stream - where to write to (default: stderr)
+    interval - minimum number of seconds between status lines"""
+    def __init__(self,timings=None,jobs=1,mode='line',stream=None,interval=0.1):
+        if mode not in ('line','json'):
+            raise ValueError('unknown progress mode %r' %mode)
+        self.timings = timings
+        self.jobs = jobs
+        self.mode = mode
+        self.stream = sys.stderr if stream is None else stream
+        self.interval = interval
+        self.tty = mode == 'line' and hasattr(self.stream,'isatty') and self.stream.isatty()
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.last_render = 0
+        self.known = {} # rule: expected seconds (or None) of the rules added so far
+        self.started_at = {} # rule: start time of the running rules
+        self.total = self.done = self.skipped = 0
+        self.resolving = True # more rules may still be added
+        #expected times of the unfinished rules: the sum of those that are known
+        #and the count of those that aren't (which get the mean of the known times)
+        self.remaining = 0.0
+        self.unknown = 0
+        self.timed = 0.0 # sum and number of the known times (for the mean)
+        self.ntimed = 0
+
+    def add(self,task):
+        """adds a rule (or the rules of a batch, see bob.RuleBatch) to the total.
+        Rules that are already known are ignored."""
+        with self.lock:
+            for rule in _members(task):
+                if rule in self.known:
+                    continue
+                expected = self.timings.get(rule) if self.timings else None
+                self.known[rule] = expected
+                self.total += 1
+                if expected is None:
+                    self.unknown += 1
+                else:
+                    self.remaining += expected
+                    self.timed += expected
+                    self.ntimed += 1
+
+    def resolved(self):
+        """no more rules will be added"""
+        with self.lock:
+            self.resolving = False
+            if self.tty and self.done: #drop the '+' from the status line
+                self.stream.write('\r%s\x1b[K' %self.render())
+                self.stream.flush()
+
+    def started(self,task):
+        self.add(task)
+        with self.lock:
+            self.started_at[task] = time.time()
+            self._report('started',task)
+
+    def finished(self,task,ran=True):
+        """the rule (or batch) has finished (ran is False if it was skipped without
+        running its recipe, i.e. see the restat option). A batch's time is shared
+        equally between its rules."""
+        now = time.time()
+        with self.lock:
+            rules = _members(task)
+            seconds = (now - self.started_at.pop(task,now))/len(rules)
+            for rule in rules:
+                expected = self.known[rule]
+                if expected is None:
+                    self.unknown -= 1
+                else:
+                    self.remaining -= expected
+                self.done += 1
+                if ran:
+                    if self.timings: self.timings.record(rule,seconds)
+                    if expected is None: #it helps the estimate for the other unknown rules
+                        self.timed += seconds
+                        self.ntimed += 1
+                else:
+                    self.skipped += 1
+            self._report('finished',task)
+
+    def status(self):
+        """dict of done, total, resolving, running, elapsed, rate (rules per second)
+        and eta (seconds, or None when there's nothing to go on yet)"""
+        elapsed = time.time() - self.start
+        rate = self.done/elapsed if elapsed > 0 else 0.0
+        left = self.total - self.done
+        if self.ntimed:
+            eta = (self.remaining + self.unknown*self.timed/self.ntimed)/max(self.jobs,1)
+        elif rate:
+            eta = left/rate
+        else:
+            eta = None
+        return {'done':self.done,'total':self.total,'resolving':self.resolving,'running':len(self.started_at),
+                'elapsed':elapsed,'rate':rate,'eta':eta}
+
+    def _report(self,event,rule):
+        if self.mode == 'json':
+            status = self.status()
+            status['event'] = event
+            status['target'] = rule.targets[0]
+            self.stream.write(json.dumps(status) + '\n')
+            self.stream.flush()
+            return
+        now = time.time()
+        if now - self.last_render < self.interval and self.done < self.total:
+            return
+        self.last_render = now
+        self.stream.write(('\r%s\x1b[K' if self.tty else '%s\n') %self.render(rule))
+        self.stream.flush()
+
+    def render(self,rule=None):
+        """the status line"""
+        status = self.status()
+        eta = status['eta']
+        line = '[%d/%d%s] %.1f rules/s, eta %s' %(status['done'],status['total'],'+' if status['resolving'] else '',
+                                                  status['rate'],_duration(eta) if eta is not None else '?')
+        if rule is not None:
+            line += ' ' + rule.targets[0]
+        return line
+
+    def close(self):
+        """finishes the status line"""
+        with self.lock:
+            if self.tty:
+                self.stream.write('\n')
+                self.stream.flush()
+            if self.timings: self.timings.close()
+
+
+def _members(task):
+    return getattr(task,'members',None) or (task,)
+
+
+def _duration(seconds):
+    seconds = int(seconds + 0.5)
+    if seconds < 60:
+        return '%ds' %seconds
+    if seconds < 3600:
+        return '%dm%02ds' %divmod(seconds,60)
+    return '%dh%02dm' %(seconds//3600,seconds%3600//60)
@@ -0,0 +1,149 @@
+"""Client for a remote artifact cache served over HTTP. Part of the Buildbit package.
+
+The protocol is a small subset of the one used by other content-addressed build
+caches:
+    GET/HEAD/PUT /cas/<sha1>  - file contents, addressed by their sha1 digest
+    GET/PUT      /ac/<key>    - action results (json manifest of a rule's outputs)
+A missing entry is reported with a 404 status. See cacheserver.py for a
+reference server.
+
+Connections are kept alive and reused (one per worker thread), and blobs are
+transferred in parallel.
+"""
+import os
+import os.path
+import json
+import hashlib
+import socket
+import tempfile
+import threading
+import httplib
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+
+class RemoteCacheError(IOError):
+    pass
+
+
+class RemoteCache(object):
+    """An HTTP artifact cache backend.
+    url - base url of the cache server i.e. http://cachehost:8080/
+    jobs - number of parallel uploads/downloads
+    timeout - socket timeout in seconds
+    """
+    def __init__(self,url,jobs=4,timeout=30):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http','https'):
+            raise AssertionError("unsupported remote cache url %r" %url)
+        self.url = url
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.jobs = jobs
+        self.timeout = timeout
+        self._local = threading.local()
+        self._conns = [] #every connection opened, so that they can be closed
+        self._pool = None
+
+    def _connection(self,new=False):
+        conn = getattr(self._local,'conn',None)
+        if conn is None or new:
+            if conn is not None: conn.close()
+            cls = httplib.HTTPSConnection if self.scheme == 'https' else httplib.HTTPConnection
+            conn = self._local.conn = cls(self.netloc,timeout=self.timeout)
+            self._conns.append(conn)
+        return conn
+
+    def _request(self,method,path,body=None):
+        """returns (status, data). The request is retried once on a fresh
+        connection since the server may have closed an idle one."""
+        url = self.prefix + path
+        for attempt in (0,1):
+            conn = self._connection(new=attempt>0)
+            try:
+                conn.request(method,url,body)
+                response = conn.getresponse()
+                data = response.read()
+            except (socket.error,httplib.HTTPException) as e:
+                if attempt: raise RemoteCacheError('%s %s failed: %s' %(method,path,e))
+                continue
+            return response.status,data
+
+    def _check(self,status,method,path):
+        if status >= 400 and status != 404:
+            raise RemoteCacheError('%s %s failed with status %d' %(method,path,status))
+        return status != 404
+
+    def has_blob(self,digest):
+        path = '/cas/' + digest
+        status,data = self._request('HEAD',path)
+        return self._check(status,'HEAD',path)
+
+    def get_blob(self,digest,dest):
+        """downloads the blob into the file dest (atomically). Returns False if
+        the server doesn't have it or sends contents that don't match the digest."""
+        path = '/cas/' + digest
+        status,data = self._request('GET',path)
+        if not self._check(status,'GET',path):
+            return False
+        if hashlib.sha1(data).hexdigest() != digest:
+            return False
+        dirname = os.path.dirname(dest)
+        if not os.path.isdir(dirname):
+            try: os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname): raise
+        fd,tmp = tempfile.mkstemp(dir=dirname,prefix='.tmp')
+        with os.fdopen(fd,'wb') as fobj:
+            fobj.write(data)
+        os.rename(tmp,dest)
+        return True
+
+    def put_blob(self,digest,src):
+        """uploads the file src unless the server already has it"""
+        if self.has_blob(digest):
+            return
+        path = '/cas/' + digest
+        with open(src,'rb') as fobj:
+            status,data = self._request('PUT',path,fobj.read())
+        self._check(status,'PUT',path)
+
+    def get_action(self,key):
+        """returns the manifest stored for key or None"""
+        path = '/ac/' + key
+        status,data = self._request('GET',path)
+        if not self._check(status,'GET',path):
+            return None
+        return json.loads(data)
+
+    def put_action(self,key,manifest):
+        path = '/ac/' + key
+        status,data = self._request('PUT',path,json.dumps(manifest))
+        self._check(status,'PUT',path)
+
+    def _map(self,func,items):
+        if len(items) <= 1 or self.jobs <= 1:
+            return map(func,items)
+        if self._pool is None:
+            self._pool = ThreadPool(self.jobs)
+        return self._pool.map(func,items)
+
+    def get_blobs(self,items):
+        """downloads many blobs in parallel. items - sequence of (digest, dest).
+        Returns True if all of them were found."""
+        return all(self._map(lambda item: self.get_blob(*item),list(items)))
+
+    def put_blobs(self,items):
+        """uploads many blobs in parallel. items - sequence of (digest, src)."""
+        self._map(lambda item: self.put_blob(*item),list(items))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        for conn in self._conns:
+            conn.close()
+        self._conns = []
+        self._local = threading.local()
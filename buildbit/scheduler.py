@@ -0,0 +1,150 @@
+"""Running tasks in parallel while respecting their dependencies and resource
+limits. Part of the Buildbit package.
+
+Each running task holds some units of the named resource pools (i.e. 'link': 1
+for a link step that needs lots of memory) as well as the job slots, which are
+the pool named None. A task is only started once all of its dependencies have
+finished and its resources fit into what is left of each pool's capacity.
+Starting new tasks can also be held back while the system's load average is
+too high (like make's -l option).
+
+When there is a jobserver (see the jobserver module) every running task after
+the first also needs one of its tokens, which keeps the number of jobs in a
+tree of nested builds within the top level build's limit.
+"""
+import os
+import threading
+import collections
+
+
+class Scheduler(object):
+    poll = 0.5 # seconds between checks of the load average (and for KeyboardInterrupts)
+    token_poll = 0.02 # seconds between attempts to take a jobserver token
+    
+    def __init__(self,jobs=1,pools=None,max_load=None,jobserver=None):
+        """jobs - number of tasks that can run at once
+        pools - name:capacity dict of resource pools
+        max_load - don't start new tasks while the 1 minute load average is
+            above this (unless nothing else is running).
+        jobserver - a jobserver.JobServer shared with the parent/child builds"""
+        self.capacity = dict(pools or {})
+        self.capacity[None] = jobs
+        self.max_load = max_load
+        self.jobserver = jobserver
+        self.tokens = [] # jobserver tokens held for the running tasks
+        self.cond = threading.Condition()
+
+    def fit(self,resources):
+        """limits each resource to its pool's capacity so that a task that asks for
+        more than a whole pool can still run (on its own)"""
+        fitted = {}
+        for name,units in resources.iteritems():
+            if name not in self.capacity:
+                raise KeyError('unknown resource pool %r' %name)
+            fitted[name] = min(units,self.capacity[name])
+        return fitted
+
+    def overloaded(self):
+        if self.max_load is None or not self.running:
+            return False
+        try:
+            return os.getloadavg()[0] > self.max_load
+        except (AttributeError,OSError): #not available on this platform
+            return False
+
+    def token(self):
+        """makes sure there is a jobserver token for one more running task"""
+        if self.jobserver is None or self.running <= len(self.tokens):
+            return True #the first task uses the token that this process implicitly holds
+        token = self.jobserver.try_acquire()
+        if token is None:
+            return False
+        self.tokens.append(token)
+        return True
+    
+    def release_tokens(self):
+        while len(self.tokens) > max(self.running-1,0):
+            self.jobserver.release(self.tokens.pop())
+    
+    def run(self,tasks,deps,func,resources):
+        """runs func(task) for each task. tasks can be an iterator (i.e. a streaming
+        build order), its items are only taken as they are needed.
+        deps(task) - the tasks (from earlier in tasks) that must finish first
+        resources(task) - resource pool name:units dict for the task (including
+            the job slots that it takes as the pool named None)
+        Returns a task:result dict. The first error raised by func (or the KeyError
+        for a task in an unknown pool) is re-raised once the running tasks have
+        finished (and no new tasks are started)."""
+        tasks = iter(tasks)
+        exhausted = False
+        waiting = collections.deque() # [(task, deps, resources)]
+        results = {}
+        self.running = 0
+        self.errors = []
+        free = dict(self.capacity)
+
+        def worker(task,needs):
+            try:
+                result = func(task)
+            except BaseException as e:
+                result = None
+                self.errors.append(e)
+            with self.cond:
+                results[task] = result
+                for name,units in needs.iteritems():
+                    free[name] += units
+                self.running -= 1
+                self.release_tokens()
+                self.cond.notify()
+
+        while True:
+            with self.cond:
+                started = True
+                starved = False # a task is ready but there isn't a jobserver token for it
+                while started and not self.errors and not self.overloaded():
+                    started = False
+                    for entry in waiting:
+                        task,taskdeps,needs = entry
+                        if all(dep in results for dep in taskdeps) and all(free[name] >= units for name,units in needs.iteritems()):
+                            if not self.token():
+                                starved = True
+                                break
+                            waiting.remove(entry)
+                            for name,units in needs.iteritems():
+                                free[name] -= units
+                            self.running += 1
+                            thread = threading.Thread(target=worker,args=(task,needs))
+                            thread.daemon = True
+                            thread.start()
+                            started = True
+                            break
+                if self.errors or (exhausted and not waiting):
+                    if not self.running:
+                        break
+                    self.cond.wait(self.poll)
+                    continue
+                if starved:
+                    self.cond.wait(self.token_poll)
+                    continue
+                if exhausted or free[None] == 0 or (waiting and self.overloaded()):
+                    self.cond.wait(self.poll)
+                    continue
+            #there is a free job slot so look further ahead in the tasks (outside the lock so
+            #that the running tasks can finish while the next task is being resolved)
+            try:
+                task = next(tasks)
+            except StopIteration:
+                exhausted = True
+                continue
+            try:
+                needs = self.fit(resources(task))
+            except KeyError as e: #stop as if the task had failed so that the running tasks finish
+                with self.cond:
+                    self.errors.append(e)
+                continue
+            with self.cond:
+                waiting.append((task,list(deps(task)),needs))
+
+        if self.errors:
+            raise self.errors[0]
+        return results
@@ -0,0 +1,59 @@
+"""Persistent recipe signatures. Part of the Buildbit package.
+
+A rule's signature is a digest of its recipe (the command as written or a
+python function's code, see cache.recipe_identity) together with the names of
+its targets and prerequisites, i.e. everything that the expanded command line
+is made from. The signature that each target was last built with is kept in a
+log file, so a rule whose recipe has been edited since (a compiler flag, say)
+is rebuilt even though its targets are newer than its prerequisites.
+
+The log has a line of "signature<TAB>target" for each target that was built
+(see utils.TargetLog). A signature is only recorded once the rule's recipe has
+run successfully, so a dry run or a failed build leaves the log alone. Targets
+without a recorded signature are taken to be up to date, so that starting to
+use a log doesn't rebuild everything.
+"""
+import hashlib
+
+from cache import recipe_identity
+from utils import TargetLog
+
+
+def rule_signature(rule):
+    """digest of the rule's recipe, targets and prerequisites (None for rules
+    without a recipe)"""
+    func = getattr(rule,'func',None)
+    if func is None:
+        return None
+    h = hashlib.sha1(recipe_identity(func))
+    for label,paths in ('targets',rule.targets),('reqs',rule.allreqs),('order_only',rule.order_only):
+        h.update('\0%s\0%s' %(label,'\0'.join(paths)))
+    return h.hexdigest()
+
+
+class SignatureLog(TargetLog):
+    """the signatures that the targets were last built with, kept in the file at
+    path (see utils.TargetLog)"""
+    description = 'recipe signatures'
+
+    def __init__(self,path):
+        super(SignatureLog,self).__init__(path)
+        self.signatures = self.values # target: signature
+
+    def changed(self,rule):
+        """has the rule's recipe changed since its targets were built? Targets that
+        haven't been recorded yet don't count as changed."""
+        signature = rule_signature(rule)
+        if signature is None:
+            return False
+        recorded = self.signatures.get
+        return any(recorded(target,signature) != signature for target in rule.targets)
+
+    def record(self,rule):
+        """remembers the signature that the rule's targets have just been built with"""
+        signature = rule_signature(rule)
+        if signature is None:
+            return
+        targets = [target for target in rule.targets if self.signatures.get(target) != signature]
+        if targets:
+            self.write((target,signature) for target in targets)
@@ -0,0 +1,140 @@
+"""Saving and loading snapshots of the resolved rule graph. Part of the Buildbit package.
+
+A snapshot file holds two marshalled objects: a small header used to check that
+the snapshot is still valid and a zlib compressed body with the rule records.
+The header contains digests of the build scripts and of the directory listings
+that the wildcard expansions depended upon, so a snapshot is discarded as soon
+as a script is edited or a file is added to or removed from one of those
+directories.
+
+The body is built by bob.Rule.save_snapshot. Paths are stored once in a string
+table and referred to by index.
+"""
+import os
+import os.path
+import sys
+import glob
+import marshal
+import zlib
+import hashlib
+from types import StringTypes
+
+VERSION = 2
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class StringTable(object):
+    """assigns an index to each distinct string"""
+    def __init__(self,strings=None):
+        self.strings = list(strings or [])
+        self.index = dict((s,i) for i,s in enumerate(self.strings))
+
+    def add(self,s):
+        i = self.index.get(s)
+        if i is None:
+            i = self.index[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+    def addseq(self,seq):
+        """indexes of a sequence of strings (tuples are kept as tuples)"""
+        res = [self.add(s) for s in seq]
+        return tuple(res) if isinstance(seq,tuple) else res
+
+    def getseq(self,seq):
+        strings = self.strings
+        res = [strings[i] for i in seq]
+        return tuple(res) if isinstance(seq,tuple) else res
+
+
+def file_digest(fpath):
+    with open(fpath,'rb') as fobj:
+        return hashlib.sha1(fobj.read()).hexdigest()
+
+def listing_digest(dirname):
+    try:
+        names = sorted(os.listdir(dirname))
+    except OSError:
+        return None
+    return hashlib.sha1('\0'.join(names)).hexdigest()
+
+def pattern_dirs(pattern):
+    """the directories whose listings glob.glob(pattern) depends upon"""
+    dirname = os.path.dirname(pattern)
+    if not glob.has_magic(dirname):
+        return [dirname or os.curdir]
+    return pattern_dirs(dirname) + [d for d in glob.glob(dirname) if os.path.isdir(d)]
+
+def default_scripts():
+    """the build script that is being run"""
+    main = sys.modules.get('__main__')
+    fpath = getattr(main,'__file__',None)
+    return [fpath] if fpath else []
+
+
+def func_ref(func):
+    """a marshallable reference to a recipe. Python functions must be reachable
+    as a module level attribute with the function's name."""
+    if func is None:
+        return None
+    if isinstance(func,StringTypes):
+        return ('cmd',func)
+    if isinstance(func,list):
+        return ('cmdseq',list(func))
+    modname = getattr(func,'__module__',None)
+    name = getattr(func,'__name__',None)
+    if getattr(sys.modules.get(modname),name,None) is not func:
+        raise SnapshotError("recipe %r can't be referenced by name" %func)
+    return ('func',modname,name)
+
+def resolve_func(ref):
+    if ref is None:
+        return None
+    if ref[0] in ('cmd','cmdseq'):
+        return ref[1]
+    modname,name = ref[1:]
+    try:
+        return getattr(sys.modules[modname],name)
+    except (KeyError,AttributeError):
+        raise SnapshotError("recipe %s.%s not found" %(modname,name))
+
+
+def make_header(scripts,patterns):
+    dirs = set()
+    for pattern in patterns:
+        dirs.update(pattern_dirs(pattern))
+    return {'version':VERSION,
+            'scripts':dict((fpath,file_digest(fpath)) for fpath in scripts),
+            'dirs':dict((d,listing_digest(d)) for d in dirs)}
+
+def header_is_valid(header,scripts):
+    if header.get('version') != VERSION or sorted(header['scripts']) != sorted(scripts):
+        return False
+    try:
+        if any(file_digest(fpath) != digest for fpath,digest in header['scripts'].iteritems()):
+            return False
+    except IOError:
+        return False
+    return all(listing_digest(d) == digest for d,digest in header['dirs'].iteritems())
+
+
+def save(path,header,body):
+    tmp = path + '.tmp'
+    with open(tmp,'wb') as fobj:
+        marshal.dump(header,fobj)
+        marshal.dump(zlib.compress(marshal.dumps(body)),fobj)
+    os.rename(tmp,path)
+
+def load(path,scripts):
+    """returns the body of the snapshot or None if it is missing or out of date"""
+    try:
+        with open(path,'rb') as fobj:
+            header = marshal.load(fobj)
+            if not header_is_valid(header,scripts):
+                return None
+            return marshal.loads(zlib.decompress(marshal.load(fobj)))
+    except (IOError,EOFError,ValueError,TypeError,zlib.error):
+        return None
@@ -135,6 +135,16 @@ class TestCleanBuilds(BaseTestBuilds):
         rw1 = tf.r11.explicit_rules[0]
         self.assertEqual(set(bseq),set([tf.r0,tf.r1,tf.r2,tf.r3,tf.r4,tf.r6,tf.r7,rw1,tf.r9]+tf.r8))
         
+    def test_multiple_goals(self):
+        tf = self.tf
+        goals = [self.outpath+'A/ex1.txt',self.outpath+'A/foo3',self.outpath+'A/test5.c']
+        bseq = bob.Rule.calc_build(goals)
+        merged = []
+        for goal in goals:
+            merged += [rule for rule in bob.Rule.calc_build(goal) if rule not in merged]
+        self.assertEqual(list(bseq),merged)
+        self.assertEqual(list(bseq),[tf.r0,tf.r1,tf.r4,tf.r2,tf.r11.explicit_rules[0],tf.r7,tf.r8[3],tf.r6])
+        
     def test_phony(self):
         tf = self.tf
         pass # a difficult one to test
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""module of unit tests for the build server and its client"""
+
+import unittest2 as unittest
+import os, sys, time, shutil, subprocess, tempfile, threading, StringIO
+import buildserver
+
+
+class TestBuildServer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir,'build.sock')
+        self.builds = []
+        self.refreshes = []
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def serve(self,build,scripts=()):
+        def record(argv):
+            self.builds.append(argv)
+            build(argv)
+        self.server = buildserver.BuildServer(self.path,record,lambda: self.refreshes.append(1),scripts)
+        submit = self.server.submit
+        self.submitted = []
+        def counted(argv):
+            self.submitted.append(argv)
+            return submit(argv)
+        self.server.submit = counted
+        def serve(): #like BuildServer.serve but without restarting the test process
+            self.server.serve_forever()
+            self.server.server_close()
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+
+    def request(self,argv):
+        out = StringIO.StringIO()
+        status = buildserver.request(self.path,argv,out,timeout=5)
+        return status,out.getvalue()
+
+    def test_output_and_status(self):
+        def build(argv):
+            print 'building', ' '.join(argv)
+            os.system('echo from a recipe')
+            if argv == ['bad']:
+                raise RuntimeError('recipe failed')
+            if argv == ['usage']:
+                sys.exit(2)
+        self.serve(build)
+        self.assertEqual(self.request(['a','b']),(0,'building a b\nfrom a recipe\n'))
+        status,output = self.request(['bad'])
+        self.assertEqual(status,1)
+        self.assertIn('RuntimeError: recipe failed',output)
+        self.assertEqual(self.request(['usage'])[0],2)
+        deadline = time.time() + 5
+        while len(self.refreshes) < 6 and time.time() < deadline: #the last one runs after the reply
+            time.sleep(0.01)
+        self.assertEqual(len(self.refreshes),6) #before and after each build
+
+    def test_coalesced(self):
+        started,release = threading.Event(),threading.Event()
+        def build(argv):
+            print 'build', argv[0]
+            started.set()
+            release.wait(5)
+        self.serve(build)
+        results = []
+        def client(argv):
+            results.append(self.request(argv))
+        first = threading.Thread(target=client,args=(['x'],))
+        first.start()
+        started.wait(5)
+        clients = [threading.Thread(target=client,args=(argv,)) for argv in (['x'],['x'],['y'])]
+        for thread in clients: thread.start()
+        while len(self.submitted) < 4:
+            time.sleep(0.01)
+        release.set()
+        for thread in [first]+clients: thread.join(5)
+        self.assertEqual(self.builds,[['x'],['y']])
+        self.assertEqual(sorted(results),[(0,'build x\n')]*3+[(0,'build y\n')])
+
+    def test_bad_request(self):
+        self.serve(lambda argv: None)
+        import socket
+        sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.sendall('not json\n')
+        fobj = sock.makefile('rb',0)
+        self.assertEqual(buildserver.recv_frame(fobj),('o','bad build request\n'))
+        self.assertEqual(buildserver.recv_frame(fobj),('x','2'))
+        sock.close()
+        self.assertEqual(self.builds,[])
+
+    def test_already_running(self):
+        self.serve(lambda argv: None)
+        with self.assertRaises(Exception):
+            buildserver.BuildServer(self.path,None,None)
+        self.assertEqual(self.request([])[0],0)
+
+    def test_stale_socket(self):
+        import socket
+        sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.close() #leaves the socket file behind
+        self.serve(lambda argv: None)
+        self.assertEqual(self.request([])[0],0)
+
+    def test_scripts_changed(self):
+        script = os.path.join(self.tmpdir,'build.py')
+        open(script,'w').close()
+        self.serve(lambda argv: None,scripts=[script])
+        os.utime(script,(0,0))
+        with self.assertRaises(Exception): #the server stops to restart but nothing restarts it here
+            buildserver.request(self.path,[],StringIO.StringIO(),timeout=0.5)
+        self.assertTrue(self.server.restart_requested)
+        self.assertEqual(self.builds,[])
+        self.server = None
+
+
+class TestServeBuildScript(unittest.TestCase):
+    script = """
+import sys
+sys.path.insert(0,%r)
+from bob import Rule as rule
+rule('All',['out.txt','dep.o'],PHONY=True)
+rule('out.txt','in.txt',func='echo building; cp in.txt out.txt')
+rule('dep.o','in.txt',func='echo compiling; touch dep.o; echo "dep.o: in.txt" > dep.d',depfile='dep.d')
+rule.main()
+"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir,'build.sock')
+        with open(os.path.join(self.tmpdir,'build.py'),'w') as fobj:
+            fobj.write(self.script %os.path.dirname(os.path.abspath(buildserver.__file__)))
+        with open(os.path.join(self.tmpdir,'in.txt'),'w') as fobj:
+            fobj.write('1')
+        self.server = subprocess.Popen([sys.executable,'build.py','--serve','build.sock'],cwd=self.tmpdir,
+                                       stdout=open(os.devnull,'w'),stderr=subprocess.STDOUT)
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.wait()
+        shutil.rmtree(self.tmpdir)
+
+    def request(self,argv):
+        out = StringIO.StringIO()
+        deadline = time.time() + 10
+        while not os.path.exists(self.path) and time.time() < deadline:
+            time.sleep(0.05)
+        status = buildserver.request(self.path,argv,out)
+        return status,out.getvalue()
+
+    def test_rebuilds_after_changes(self):
+        status,output = self.request([])
+        self.assertEqual(status,0)
+        self.assertIn('building\n',output)
+        self.assertIn('compiling\n',output)
+        output = self.request(['All'])[1]
+        self.assertNotIn('building',output) #up to date
+        self.assertNotIn('compiling',output) #its depfile has been written since the last build
+        os.utime(os.path.join(self.tmpdir,'in.txt'),(time.time()+10,)*2)
+        self.assertIn('building\n',self.request([])[1])
+        status,output = self.request(['--no-such-option'])
+        self.assertEqual(status,2)
+        self.assertIn('unrecognized arguments',output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+"""module of unit tests for the artifact cache module"""
+
+import unittest2 as unittest
+import os, json, shutil, tempfile, threading
+import bob
+import cache
+import cacheserver
+import remotecache
+
+
+class TestArtifactCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tmpdir,'cache')
+        self.src = self.path('src.txt')
+        self.write(self.src,'source')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self,name):
+        return os.path.join(self.tmpdir,name)
+
+    def write(self,fpath,text):
+        with open(fpath,'w') as fobj:
+            fobj.write(text)
+
+    def read(self,fpath):
+        with open(fpath) as fobj:
+            return fobj.read()
+
+    def make_rule(self,target,func):
+        return bob.ExplicitRule(target,self.src,func=func,register=False)
+
+    def test_store_and_fetch(self):
+        ac = cache.ArtifactCache(self.cachedir)
+        target = self.path('out.txt')
+        self.write(target,'output')
+        key = ac.key(self.make_rule(target,'cp {reqs} {targets}'))
+        self.assertFalse(ac.fetch(key,[target]))
+        self.assertTrue(ac.store(key,[target]))
+        os.remove(target)
+        self.assertTrue(ac.fetch(key,[target]))
+        self.assertEqual(self.read(target),'output')
+        self.assertEqual(ac.stats['hits'],1)
+        self.assertEqual(ac.stats['misses'],1)
+        self.assertEqual(ac.hit_rate(),0.5)
+
+    def test_key_depends_on_reqs_contents(self):
+        ac = cache.ArtifactCache(self.cachedir)
+        rule = self.make_rule(self.path('out.txt'),'cp {reqs} {targets}')
+        key1 = ac.key(rule)
+        self.write(self.src,'changed source')
+        os.utime(self.src,(0,0))
+        self.assertNotEqual(key1,ac.key(rule))
+
+    def test_key_depends_on_recipe(self):
+        ac = cache.ArtifactCache(self.cachedir)
+        target = self.path('out.txt')
+        key1 = ac.key(self.make_rule(target,'cp {reqs} {targets}'))
+        key2 = ac.key(self.make_rule(target,'cat {reqs} > {targets}'))
+        self.assertNotEqual(key1,key2)
+
+    def test_hardlink_restore(self):
+        ac = cache.ArtifactCache(self.cachedir,restore=('hardlink','copy'))
+        target = self.path('out.txt')
+        self.write(target,'output')
+        ac.store('k'*40,[target])
+        os.remove(target)
+        self.assertTrue(ac.fetch('k'*40,[target]))
+        self.assertEqual(self.read(target),'output')
+
+    def test_lru_eviction(self):
+        ac = cache.ArtifactCache(self.cachedir,maxsize=250)
+        for i in range(4):
+            target = self.path('out%d.txt' %i)
+            self.write(target,str(i)*100)
+            key = ('%d' %i)*40
+            ac.store(key,[target])
+            #make the objects' access times distinct
+            os.utime(ac._path(ac.objdir,cache.file_digest(target)),(i,i))
+            os.utime(ac._path(ac.actiondir,key),(i,i))
+        self.assertTrue(ac.size() <= 250)
+        self.assertEqual(ac.stats['evictions'],2)
+        self.assertFalse(ac.fetch('0'*40,[self.path('out0.txt')]))
+        self.assertTrue(ac.fetch('3'*40,[self.path('out3.txt')]))
+
+    def test_rule_build_uses_cache(self):
+        calls = []
+        def recipe(self):
+            calls.append(self.targets)
+            with open(self.targets[0],'w') as fobj:
+                fobj.write('built')
+        target = self.path('out.txt')
+        rule = self.make_rule(target,recipe)
+        bob.ExplicitRule.artifact_cache = cache.ArtifactCache(self.cachedir)
+        try:
+            rule.build()
+            os.remove(target)
+            rule.build()
+        finally:
+            bob.ExplicitRule.artifact_cache = None
+        self.assertEqual(len(calls),1)
+        self.assertEqual(self.read(target),'built')
+
+    def compile_rule(self,calls=None):
+        """a rule for out.o whose recipe concatenates src.txt and a.h, and lists
+        them in its depfile out.d"""
+        header = self.path('a.h')
+        def compile(rule):
+            if calls is not None: calls.append(rule.targets[0])
+            with open(rule.targets[0],'w') as fobj:
+                fobj.write(self.read(self.src) + self.read(header))
+            with open(rule.depfile,'w') as fobj:
+                fobj.write('%s: %s %s\n' %(rule.targets[0],self.src,header))
+        return bob.ExplicitRule(self.path('out.o'),self.src,func=compile,depfile=self.path('out.d'),register=False)
+
+    def test_depfile_reqs_in_key(self):
+        self.write(self.path('a.h'),'H1;')
+        target,dep = self.path('out.o'),self.path('out.d')
+        bob.ExplicitRule.artifact_cache = ac = cache.ArtifactCache(self.cachedir)
+        try:
+            rule = self.compile_rule()
+            rule.build()
+            self.assertEqual(ac.stats['stores'],1)
+            os.remove(target)
+            os.utime(dep,(0,0))
+            bob.ExplicitRule.reset_cache()
+            rule.build()
+            self.assertEqual(ac.stats['hits'],1)
+            self.assertGreater(os.path.getmtime(dep),0) #restored with the target
+            self.write(self.path('a.h'),'H2;')
+            bob.ExplicitRule.reset_cache()
+            rule.build()
+        finally:
+            bob.ExplicitRule.artifact_cache = None
+        self.assertEqual(ac.stats['hits'],1)
+        self.assertEqual(self.read(target),'sourceH2;')
+
+    def test_depfile_rule_restored_into_clean_tree(self):
+        self.write(self.path('a.h'),'H1;')
+        calls = []
+        bob.ExplicitRule.artifact_cache = ac = cache.ArtifactCache(self.cachedir)
+        try:
+            self.compile_rule(calls).build()
+            for name in 'out.o','out.d': #a clean checkout has neither
+                os.remove(self.path(name))
+            bob.ExplicitRule.reset_cache()
+            rule = self.compile_rule(calls)
+            self.assertIsNone(rule.depfile_reqs)
+            rule.build()
+            self.assertEqual(ac.stats['hits'],1)
+            self.assertEqual(len(calls),1)
+            self.assertEqual(self.read(self.path('out.o')),'sourceH1;')
+            self.assertTrue(os.path.isfile(self.path('out.d')))
+            #the stored list of the depfile's prerequisites still checks their contents
+            for name in 'out.o','out.d':
+                os.remove(self.path(name))
+            self.write(self.path('a.h'),'H2;')
+            bob.ExplicitRule.reset_cache()
+            self.compile_rule(calls).build()
+        finally:
+            bob.ExplicitRule.artifact_cache = None
+        self.assertEqual(len(calls),2)
+        self.assertEqual(self.read(self.path('out.o')),'sourceH2;')
+
+    def test_parallel_build(self):
+        def recipe(rule):
+            with open(rule.targets[0],'w') as fobj:
+                fobj.write(rule.targets[0]*10)
+        rules = [self.make_rule(self.path('out%d.txt' %i),recipe) for i in range(200)]
+        bob.ExplicitRule.artifact_cache = ac = cache.ArtifactCache(self.cachedir,maxsize=5000)
+        try:
+            bob.Rule.build(rules,jobs=16)
+        finally:
+            bob.ExplicitRule.artifact_cache = None
+        self.assertEqual(ac.stats['stores'],200)
+        self.assertGreater(ac.stats['evictions'],0)
+        self.assertTrue(ac.size() <= 5000)
+
+
+class TestRemoteCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = cacheserver.CacheServer(os.path.join(self.tmpdir,'server'))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.remote = remotecache.RemoteCache(self.server.url,jobs=2)
+
+    def tearDown(self):
+        self.remote.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def path(self,name):
+        return os.path.join(self.tmpdir,name)
+
+    def test_blob_roundtrip(self):
+        src = self.path('blob')
+        with open(src,'w') as fobj:
+            fobj.write('contents')
+        digest = cache.file_digest(src)
+        self.assertFalse(self.remote.has_blob(digest))
+        self.remote.put_blobs([(digest,src)])
+        self.assertTrue(self.remote.has_blob(digest))
+        self.assertTrue(self.remote.get_blobs([(digest,self.path('copy'))]))
+        with open(self.path('copy')) as fobj:
+            self.assertEqual(fobj.read(),'contents')
+
+    def test_digest_mismatch_rejected(self):
+        src = self.path('blob')
+        with open(src,'w') as fobj:
+            fobj.write('contents')
+        with self.assertRaises(remotecache.RemoteCacheError):
+            self.remote.put_blob('0'*40,src)
+
+    def test_shared_between_local_caches(self):
+        target = self.path('out.txt')
+        manifest_targets = [target]
+        cache1 = cache.ArtifactCache(self.path('cache1'),remote=self.remote)
+        cache2 = cache.ArtifactCache(self.path('cache2'),remote=self.remote)
+        with open(target,'w') as fobj:
+            fobj.write('output')
+        cache1.store('a'*40,manifest_targets)
+        os.remove(target)
+        self.assertTrue(cache2.fetch('a'*40,manifest_targets))
+        self.assertEqual(cache2.stats['remote_hits'],1)
+        with open(target) as fobj:
+            self.assertEqual(fobj.read(),'output')
+        #second lookup is served locally
+        self.assertTrue(cache2.fetch('a'*40,manifest_targets))
+        self.assertEqual(cache2.stats['remote_hits'],1)
+        self.assertFalse(cache2.fetch('b'*40,manifest_targets))
+
+    def server_path(self,kind,name):
+        return os.path.join(self.server.directory,kind,name[:2],name[2:])
+
+    def test_bad_manifest_digest_rejected(self):
+        target = self.path('out.txt')
+        fpath = self.server_path('ac','a'*40)
+        os.makedirs(os.path.dirname(fpath))
+        with open(fpath,'w') as fobj:
+            json.dump([[target,'..'+self.path('secret'),420]],fobj) #a path outside of the objects
+        with open(self.path('secret'),'w') as fobj:
+            fobj.write('not in the cache')
+        local = cache.ArtifactCache(self.path('cache'),remote=self.remote)
+        self.assertFalse(local.fetch('a'*40,[target]))
+        self.assertFalse(os.path.exists(target))
+
+    def test_corrupted_blob_is_a_miss(self):
+        target = self.path('out.txt')
+        with open(target,'w') as fobj:
+            fobj.write('output')
+        cache.ArtifactCache(self.path('cache1'),remote=self.remote).store('a'*40,[target])
+        with open(self.server_path('cas',cache.file_digest(target)),'w') as fobj:
+            fobj.write('poison')
+        os.remove(target)
+        cache2 = cache.ArtifactCache(self.path('cache2'),remote=self.remote)
+        self.assertFalse(cache2.fetch('a'*40,[target]))
+        self.assertFalse(os.path.exists(target))
+        self.assertEqual(cache2.size(),0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""module of unit tests for the depfile module and rules with depfiles"""
+
+import unittest2 as unittest
+import os, shutil, tempfile, time
+import bob
+import depfile
+
+
+class TestParse(unittest.TestCase):
+    def test_simple(self):
+        self.assertEqual(depfile.parse('foo.o: foo.c foo.h\n'),[(['foo.o'],['foo.c','foo.h'])])
+
+    def test_continuation_lines(self):
+        text = 'foo.o: foo.c \\\n  foo.h \\\r\n  bar.h\n'
+        self.assertEqual(depfile.parse(text),[(['foo.o'],['foo.c','foo.h','bar.h'])])
+
+    def test_escapes(self):
+        text = 'foo.o: my\\ dir/foo.c a\\#b.h cost$$.h\n'
+        self.assertEqual(depfile.parse(text),[(['foo.o'],['my dir/foo.c','a#b.h','cost$.h'])])
+
+    def test_phony_entries(self):
+        text = 'foo.o: foo.c foo.h\n\nfoo.h:\n'
+        self.assertEqual(depfile.parse(text),[(['foo.o'],['foo.c','foo.h']),(['foo.h'],[])])
+
+    def test_multiple_targets(self):
+        self.assertEqual(depfile.parse('a.o b.o : x.h\n'),[(['a.o','b.o'],['x.h'])])
+
+    def test_windows_drive(self):
+        self.assertEqual(depfile.parse('foo.o: C:\\src\\foo.c\n'),[(['foo.o'],['C:\\src\\foo.c'])])
+
+
+class TestDepfileRules(unittest.TestCase):
+    def setUp(self):
+        reload(bob)
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = self.path('foo.c')
+        self.header = self.path('foo.h')
+        self.obj = self.path('foo.o')
+        self.dep = self.path('foo.d')
+        for fpath in self.src,self.header:
+            self.touch(fpath,-100)
+        
+        def compile(rule):
+            self.touch(rule.targets[0],-50)
+            with open(rule.depfile,'w') as fobj:
+                fobj.write('%s: %s \\\n %s\n' %(rule.targets[0],rule.reqs[0],self.header))
+        self.compile = compile
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        reload(bob)
+
+    def path(self,name):
+        return os.path.join(self.tmpdir,name)
+
+    def touch(self,fpath,offset=0):
+        open(fpath,'a').close()
+        t = time.time() + offset
+        os.utime(fpath,(t,t))
+
+    def calc_build(self,target):
+        bob.ExplicitRule.reset_cache()
+        bob.BaseRule.get_mtime.cache.clear()
+        return list(bob.Rule.calc_build(target))
+
+    def test_pattern_rule_depfile(self):
+        bob.Rule('%.o','%.c',func=self.compile,depfile='%.d')
+        rule = bob.Rule.get(self.obj)
+        self.assertEqual(rule.depfile,self.dep)
+        self.assertEqual(self.calc_build(self.obj),[rule])
+        rule.build()
+        self.assertEqual(depfile.read_deps(self.dep),[self.src,self.header])
+        self.assertEqual(self.calc_build(self.obj),[])
+        #a header change makes the object out of date
+        self.touch(self.header)
+        self.assertEqual(self.calc_build(self.obj),[rule])
+
+    def test_missing_depfile(self):
+        rule = bob.Rule(self.obj,self.src,func=self.compile,depfile=self.dep)
+        self.touch(self.obj,-50)
+        self.assertEqual(self.calc_build(self.obj),[rule])
+
+    def test_deleted_header(self):
+        rule = bob.Rule(self.obj,self.src,func=self.compile,depfile=self.dep)
+        rule.build()
+        self.assertEqual(self.calc_build(self.obj),[])
+        os.remove(self.header)
+        self.assertEqual(self.calc_build(self.obj),[rule])
+
+    def test_generated_header(self):
+        rule = bob.Rule(self.obj,self.src,func=self.compile,depfile=self.dep)
+        rule.build()
+        header_rule = bob.Rule(self.header,None,func='touch {targets}')
+        os.remove(self.header)
+        self.assertEqual(self.calc_build(self.obj),[header_rule,rule])
+
+    def test_parsed_once(self):
+        with open(self.dep,'w') as fobj:
+            fobj.write('foo.o: foo.c\n')
+        deps = depfile.read_deps(self.dep)
+        self.assertTrue(depfile.read_deps(self.dep) is deps)
+
+    def test_unknown_option(self):
+        with self.assertRaises(TypeError):
+            bob.Rule(self.obj,self.src,depfiles=self.dep)
+
+
+if __name__ == '__main__':
+    unittest.main()
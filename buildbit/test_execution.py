@@ -0,0 +1,490 @@
+#!/usr/bin/env python
+"""module of unit tests for running builds with Rule.build (rather than for
+calculating the build sequence)."""
+
+import unittest2 as unittest
+import os, sys, csv, json, subprocess, time, threading, StringIO
+import bob
+from testcase import BobTestCase
+from progress import Progress, Timings
+from signatures import SignatureLog
+
+
+class BaseTestExecution(BobTestCase):
+    def setUp(self):
+        super(BaseTestExecution,self).setUp()
+        self.ran = []
+
+    def write(self,fpath,text,age=0):
+        with open(fpath,'w') as fobj:
+            fobj.write(text)
+        t = time.time() - age
+        os.utime(fpath,(t,t))
+
+    def recipe(self,text=None):
+        """a recipe that records that it ran and writes text into its target
+        (or only records that it ran if text is None)"""
+        def func(rule):
+            self.ran.append(rule.targets[0])
+            if text is not None:
+                with open(rule.targets[0],'w') as fobj:
+                    fobj.write(text)
+        return func
+
+
+class TestRestat(BaseTestExecution):
+    def setUp(self):
+        super(TestRestat,self).setUp()
+        self.src = self.path('src.txt')
+        self.gen = self.path('gen.h')
+        self.out = self.path('out.o')
+        self.write(self.src,'source',age=10)
+        self.write(self.gen,'header',age=20)
+        self.write(self.out,'object',age=15)
+
+    def test_hash_cutoff(self):
+        rgen = bob.Rule(self.gen,self.src,func=self.recipe('header'),restat='hash')
+        rout = bob.Rule(self.out,self.gen,func=self.recipe('object'))
+        buildseq = bob.Rule.calc_build(self.out)
+        self.assertEqual(list(buildseq),[rgen,rout])
+        bob.Rule.build(buildseq)
+        self.assertEqual(self.ran,[self.gen])
+
+    def test_hash_cutoff_settles(self):
+        final = self.path('final')
+        self.write(final,'final',age=12)
+        bob.Rule(self.gen,self.src,func=self.recipe('header'),restat='hash')
+        bob.Rule(self.out,self.gen,func=self.recipe('object'))
+        bob.Rule(final,self.out,func=self.recipe('final'))
+        bob.Rule.build(bob.Rule.calc_build(final))
+        self.assertEqual(self.ran,[self.gen])
+        bob.Rule.reset_cache()
+        buildseq = bob.Rule.calc_build(final)
+        bob.Rule.build(buildseq)
+        self.assertEqual(self.ran,[self.gen]) #nothing ran the second time
+        self.assertEqual(list(buildseq),[])
+
+    def test_hash_changed_output(self):
+        bob.Rule(self.gen,self.src,func=self.recipe('new header'),restat='hash')
+        bob.Rule(self.out,self.gen,func=self.recipe('object'))
+        bob.Rule.build(bob.Rule.calc_build(self.out))
+        self.assertEqual(self.ran,[self.gen,self.out])
+
+    def test_mtime_cutoff(self):
+        bob.Rule(self.gen,self.src,func=self.recipe(),restat=True)
+        bob.Rule(self.out,self.gen,func=self.recipe('object'))
+        bob.Rule.build(bob.Rule.calc_build(self.out))
+        self.assertEqual(self.ran,[self.gen])
+
+    def test_no_restat(self):
+        bob.Rule(self.gen,self.src,func=self.recipe())
+        bob.Rule(self.out,self.gen,func=self.recipe('object'))
+        bob.Rule.build(bob.Rule.calc_build(self.out))
+        self.assertEqual(self.ran,[self.gen,self.out])
+
+    def test_cutoff_propagates(self):
+        final = self.path('final')
+        self.write(final,'final',age=12)
+        bob.Rule(self.gen,self.src,func=self.recipe(),restat=True)
+        bob.Rule(self.out,self.gen,func=self.recipe('object'))
+        bob.Rule(final,self.out,func=self.recipe('final'))
+        bob.Rule.build(bob.Rule.calc_build(final))
+        self.assertEqual(self.ran,[self.gen])
+
+    def test_stale_for_other_reasons(self):
+        other = self.path('other.h')
+        self.write(other,'other',age=1)
+        bob.Rule(self.gen,self.src,func=self.recipe(),restat=True)
+        bob.Rule(self.out,[self.gen,other],func=self.recipe('object'))
+        bob.Rule.build(bob.Rule.calc_build(self.out))
+        self.assertEqual(self.ran,[self.gen,self.out])
+
+
+class TestStreaming(BaseTestExecution):
+    def setUp(self):
+        super(TestStreaming,self).setUp()
+        for name in 'a.c','b.c':
+            self.write(self.path(name),name,age=10)
+        bob.Rule('%.o','%.c',func=self.recipe('object'))
+        self.out = self.path('out')
+        bob.Rule(self.out,[self.path('a.o'),self.path('b.o')],func=self.recipe('linked'))
+
+    def test_yields_before_resolving_the_rest(self):
+        gen = bob.Rule.iter_build(self.out)
+        first = next(gen)
+        self.assertEqual(list(first.targets),[self.path('a.o')])
+        self.assertNotIn(self.path('b.o'),bob.PatternRule._instantiated_rules)
+        self.assertEqual([list(rule.targets) for rule in gen],[[self.path('b.o')],[self.out]])
+
+    def test_same_order_as_calc_build(self):
+        self.assertEqual(list(bob.Rule.iter_build(self.out)),list(bob.Rule.calc_build(self.out)))
+
+    def test_build_while_resolving(self):
+        bob.Rule.build(bob.Rule.iter_build(self.out))
+        self.assertEqual(self.ran,[self.path('a.o'),self.path('b.o'),self.out])
+
+
+class TestParallel(BaseTestExecution):
+    def setUp(self):
+        super(TestParallel,self).setUp()
+        self.lock = threading.Lock()
+        self.active = {}
+        self.peak = {}
+
+    def recipe(self,group='all',fail=False):
+        """a slow recipe that records how many recipes of its group run at once"""
+        def func(rule):
+            with self.lock:
+                for name in set([group,'all']):
+                    self.active[name] = self.active.get(name,0) + 1
+                    self.peak[name] = max(self.peak.get(name,0),self.active[name])
+            time.sleep(0.05)
+            if fail: raise ValueError('recipe failed')
+            with open(rule.targets[0],'w') as fobj:
+                fobj.write('built')
+            with self.lock:
+                self.ran.append(rule.targets[0])
+                for name in set([group,'all']):
+                    self.active[name] -= 1
+        return func
+
+    def objects(self,n,prefix='',**options):
+        objs = [self.path('%s%d.o' %(prefix,i)) for i in range(n)]
+        for obj in objs:
+            bob.Rule(obj,None,func=self.recipe(options.get('pool','all')),**options)
+        return objs
+
+    def test_dependencies(self):
+        objs = self.objects(4)
+        lib = self.path('lib.a')
+        bob.Rule(lib,objs,func=self.recipe())
+        bob.Rule.build(bob.Rule.iter_build(lib),jobs=4)
+        self.assertEqual(self.ran[-1],lib)
+        self.assertEqual(set(self.ran[:-1]),set(objs))
+        self.assertEqual(self.peak['all'],4)
+
+    def test_pool(self):
+        links = self.objects(3,'link',pool='link')
+        others = self.objects(3)
+        bob.Rule('All',links+others,PHONY=True)
+        bob.Rule.build(bob.Rule.calc_build('All'),jobs=4,pools={'link':1})
+        self.assertEqual(len(self.ran),6)
+        self.assertEqual(self.peak['link'],1)
+        self.assertTrue(self.peak['all'] > 1)
+
+    def test_command_line_pool(self):
+        links = self.objects(3,'link',pool='link')
+        bob.Rule('All',links,PHONY=True)
+        stdout,sys.stdout = sys.stdout,StringIO.StringIO()
+        try:
+            bob.Rule._run(bob.Rule._argparser().parse_args(['-j','4','--pool','link=1','All']))
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(self.peak['link'],1)
+        self.assertEqual(bob.Rule.pools,{}) #not kept for the next request to a build server
+
+    def test_weight(self):
+        heavy = self.objects(2,weight=3)
+        light = self.path('light.o')
+        bob.Rule(light,None,func=self.recipe())
+        bob.Rule('All',heavy+[light],PHONY=True)
+        bob.Rule.build(bob.Rule.calc_build('All'),jobs=4)
+        self.assertEqual(self.peak['all'],2) #one heavy recipe and the light one
+
+    def test_weight_larger_than_pool(self):
+        self.objects(2,weight=10)
+        bob.Rule('All',[self.path('0.o'),self.path('1.o')],PHONY=True)
+        bob.Rule.build(bob.Rule.calc_build('All'),jobs=4)
+        self.assertEqual(self.peak['all'],1)
+
+    def test_failure(self):
+        objs = self.objects(2)
+        bad = self.path('bad.o')
+        bob.Rule(bad,None,func=self.recipe(fail=True))
+        lib = self.path('lib.a')
+        bob.Rule(lib,objs+[bad],func=self.recipe())
+        with self.assertRaises(ValueError):
+            bob.Rule.build(bob.Rule.calc_build(lib),jobs=4)
+        self.assertNotIn(lib,self.ran)
+
+    def test_unknown_pool(self):
+        objs = self.objects(1) + self.objects(1,'bad',pool='missing')
+        bob.Rule('All',objs,PHONY=True)
+        with self.assertRaises(KeyError):
+            bob.Rule.build(bob.Rule.calc_build('All'),jobs=2)
+        self.assertEqual(self.ran,[]) #checked before anything runs
+
+    def test_unknown_pool_streamed(self):
+        objs = self.objects(1) + self.objects(1,'bad',pool='missing') + self.objects(1,'late')
+        bob.Rule('All',objs,PHONY=True)
+        with self.assertRaises(KeyError):
+            bob.Rule.build(bob.Rule.iter_build('All'),jobs=2)
+        self.assertEqual(self.ran,[objs[0]]) #the running recipe finished, no more were started
+
+
+class TestSignatures(BaseTestExecution):
+    def setUp(self):
+        super(TestSignatures,self).setUp()
+        self.log = self.path('signatures')
+        for name in 'a.c','b.c':
+            self.write(self.path(name),name,age=20)
+        for name in 'a.o','b.o':
+            self.write(self.path(name),name,age=10)
+
+    def define(self,flags):
+        bob.Rule.use_signatures(self.log)
+        cmd = 'echo %s {reqs} > {targets}' %flags
+        self.a = bob.Rule(self.path('a.o'),self.path('a.c'),func=cmd)
+        self.b = bob.Rule(self.path('b.o'),self.path('b.c'),func='echo -O2 {reqs} > {targets}')
+
+    def restart(self,flags):
+        """a new run of the build script"""
+        bob.ExplicitRule.signature_log.close()
+        reload(bob)
+        self.define(flags)
+
+    def test_edited_recipe(self):
+        self.write(self.path('a.c'),'a.c')
+        self.define('-O2')
+        bob.Rule.build(bob.Rule.calc_build([self.path('a.o'),self.path('b.o')]))
+        self.restart('-O3')
+        buildseq = bob.Rule.calc_build([self.path('a.o'),self.path('b.o')])
+        self.assertEqual(list(buildseq),[self.a]) #b.o wasn't recorded, so it's taken to be up to date
+        bob.Rule.build(buildseq)
+        self.restart('-O3')
+        self.assertEqual(list(bob.Rule.calc_build([self.path('a.o'),self.path('b.o')])),[])
+        self.restart('-O2')
+        self.assertEqual(list(bob.Rule.calc_build([self.path('a.o'),self.path('b.o')])),[self.a])
+
+    def test_recorded_after_the_recipe_runs(self):
+        self.write(self.path('a.c'),'a.c')
+        self.define('-O2')
+        self.a.func = 'exit 1'
+        buildseq = bob.Rule.calc_build([self.path('a.o'),self.path('b.o')])
+        self.assertEqual(bob.ExplicitRule.signature_log.signatures,{}) #not by the checks
+        with self.assertRaises(subprocess.CalledProcessError):
+            bob.Rule.build(buildseq)
+        self.assertEqual(bob.ExplicitRule.signature_log.signatures,{})
+
+    def test_changed_reqs(self):
+        self.write(self.path('a.c'),'a.c')
+        self.define('-O2')
+        bob.Rule.build(bob.Rule.calc_build(self.path('a.o')))
+        bob.ExplicitRule.signature_log.close()
+        reload(bob)
+        bob.Rule.use_signatures(self.log)
+        rule = bob.Rule(self.path('a.o'),[self.path('a.c'),self.path('b.c')],func='echo -O2 {reqs} > {targets}')
+        self.assertEqual(list(bob.Rule.calc_build(self.path('a.o'))),[rule])
+
+    def test_compact(self):
+        with open(self.log,'w') as fobj:
+            fobj.write('old\tx\n'*2000 + 'new\tx\n')
+        log = SignatureLog(self.log)
+        self.assertEqual(log.signatures,{'x':'new'})
+        self.assertEqual(open(self.log).read(),'new\tx\n')
+
+
+class TestProgress(BaseTestExecution):
+    def setUp(self):
+        super(TestProgress,self).setUp()
+        self.timings = self.path('timings')
+        for name in 'a.c','b.c','c.c':
+            self.write(self.path(name),name,age=10)
+        self.rules = [bob.Rule(self.path(name[0]+'.o'),self.path(name),func=self.recipe('o')) for name in 'a.c','b.c','c.c']
+
+    def events(self,jobs):
+        out = StringIO.StringIO()
+        progress = Progress(Timings(self.timings),jobs,'json',out)
+        bob.Rule.build(bob.Rule.calc_build([rule.targets[0] for rule in self.rules]),jobs=jobs,progress=progress)
+        progress.close()
+        return [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def test_events(self):
+        for jobs in 1,2:
+            events = self.events(jobs)
+            self.assertEqual(sorted(event['event'] for event in events),['finished']*3+['started']*3)
+            self.assertEqual(sorted(event['target'] for event in events if event['event'] == 'finished'),
+                             [rule.targets[0] for rule in self.rules])
+            self.assertEqual((events[-1]['done'],events[-1]['total'],events[-1]['running']),(3,3,0))
+            self.assertEqual(events[-1]['eta'],0)
+            for name in 'a.o','b.o','c.o':
+                os.remove(self.path(name))
+        self.assertEqual(sorted(Timings(self.timings).durations),[rule.targets[0] for rule in self.rules])
+
+    def test_eta(self):
+        timings = Timings(self.timings)
+        a,b,c = self.rules
+        timings.record(a,10.0)
+        timings.record(b,30.0)
+        timings.close()
+        progress = Progress(Timings(self.timings),jobs=2,stream=StringIO.StringIO())
+        for rule in self.rules: progress.add(rule)
+        self.assertEqual(progress.status()['eta'],(10+30+20)/2.0) #c is expected to take the mean
+        progress.started(b)
+        progress.finished(b)
+        self.assertEqual(progress.status()['eta'],(10+20)/2.0)
+        self.assertTrue(progress.render().startswith('[1/3+] '))
+        self.assertTrue(progress.render().endswith('eta 15s'))
+        progress.resolved()
+        self.assertTrue(progress.render().startswith('[1/3] '))
+
+    def test_command_line_streams(self):
+        lib = bob.Rule(self.path('lib.a'),[rule.targets[0] for rule in self.rules],func=self.recipe('a'))
+        args = bob.Rule._argparser().parse_args(['--progress','json','--timings',self.timings,lib.targets[0]])
+        stdout,stderr = sys.stdout,sys.stderr
+        sys.stdout,sys.stderr = StringIO.StringIO(),StringIO.StringIO()
+        try:
+            bob.Rule._run(args)
+            out = sys.stderr.getvalue()
+        finally:
+            sys.stdout,sys.stderr = stdout,stderr
+        events = [json.loads(line) for line in out.splitlines()]
+        #the first recipe started before the rest of the graph was resolved
+        self.assertEqual((events[0]['event'],events[0]['total'],events[0]['resolving']),('started',1,True))
+        self.assertEqual((events[-1]['done'],events[-1]['total']),(4,4))
+
+
+class TestUsage(BaseTestExecution):
+    def setUp(self):
+        super(TestUsage,self).setUp()
+        self.log = self.path('usage')
+        bob.Rule.use_usage_log(self.log)
+        self.write(self.path('in.txt'),'in',age=10)
+        #a recipe that needs about 50MB
+        cmd = '%s -c "x = bytearray(50<<20)" && cp {reqs} {targets}' %sys.executable
+        self.big = bob.Rule(self.path('big'),self.path('in.txt'),func=cmd)
+        self.small = bob.Rule(self.path('small'),self.path('in.txt'),func=['cp','{reqs}','{targets}'])
+        self.func = bob.Rule(self.path('func'),self.path('in.txt'),func=self.recipe('func'))
+
+    def tearDown(self):
+        bob.ExplicitRule.usage_log.close()
+        super(TestUsage,self).tearDown()
+
+    def test_measured(self):
+        targets = [self.path(name) for name in 'big','small','func']
+        bob.Rule.build(bob.Rule.calc_build(targets),jobs=2)
+        log = bob.ExplicitRule.usage_log
+        self.assertEqual(sorted(log.usage),sorted(targets))
+        self.assertGreater(log.usage[self.path('big')].maxrss,50<<10)
+        self.assertLess(log.usage[self.path('small')].maxrss,50<<10)
+        report = log.report(1)
+        self.assertIn('Top 1 slowest recipes (of 3)',report)
+        self.assertIn('Top 1 most memory-hungry recipes (of 3)',report)
+        self.assertEqual(report.count(self.path('big')),2)
+        #the next build script run compares with these
+        log.close()
+        bob.Rule.use_usage_log(self.log)
+        os.remove(self.path('small'))
+        bob.Rule.build(bob.Rule.calc_build(self.path('small')))
+        rows = bob.ExplicitRule.usage_log.rows([self.path('small'),self.path('gone')])
+        self.assertEqual([row[0] for row in rows],[self.path('small')])
+        self.assertEqual(rows[0][2].maxrss,log.usage[self.path('small')].maxrss) #the last run's (as logged)
+
+    def test_export(self):
+        bob.Rule.build(bob.Rule.calc_build([self.path('small'),self.path('func')]))
+        log = bob.ExplicitRule.usage_log
+        log.export(self.path('report.json'))
+        with open(self.path('report.json')) as fobj:
+            self.assertEqual(sorted(row['target'] for row in json.load(fobj)),[self.path('func'),self.path('small')])
+        log.export(self.path('report.csv'),[self.path('small')])
+        with open(self.path('report.csv')) as fobj:
+            rows = list(csv.reader(fobj))
+        self.assertEqual(rows[0],['target','wall','user','sys','maxrss','inblock','oublock'])
+        self.assertEqual([row[0] for row in rows[1:]],[self.path('small')])
+        with self.assertRaises(ValueError):
+            log.export(self.path('report.txt'))
+
+    def test_failed_recipe(self):
+        rule = bob.Rule(self.path('bad'),self.path('in.txt'),func='exit 3')
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            bob.Rule.build(bob.Rule.calc_build(self.path('bad')))
+        self.assertEqual(cm.exception.returncode,3)
+        self.assertEqual(bob.ExplicitRule.usage_log.usage,{})
+
+
+class TestBatch(BaseTestExecution):
+    def setUp(self):
+        super(TestBatch,self).setUp()
+        self.calls = []
+        for i in range(10):
+            self.write(self.path('%d.y' %i),'y',age=10)
+        def compile(rule):
+            self.calls.append(('c',[os.path.basename(target) for target in rule.targets]))
+            self.stems = getattr(self,'stems',[]) + [rule.stems]
+            for target in rule.targets:
+                open(target,'w').close()
+        def generate(rule):
+            self.calls.append(('y',[os.path.basename(target) for target in rule.targets]))
+            for target in rule.targets:
+                open(target,'w').close()
+        self.objs = [self.path('%d.o' %i) for i in range(10)]
+        bob.Rule(self.path('%.c'),self.path('%.y'),func=generate,batch=3)
+        bob.Rule(self.path('%.o'),self.path('%.c'),func=compile,batch=4)
+        bob.Rule(self.path('lib'),self.objs,func=self.recipe('lib'))
+
+    def check_order(self):
+        built = set()
+        for kind,targets in self.calls:
+            if kind == 'c':
+                for target in targets:
+                    self.assertIn(target.replace('.o','.c'),built)
+            built.update(targets)
+        self.assertEqual(sorted(built),sorted(['%d.%s' %(i,ext) for i in range(10) for ext in 'co']))
+        self.assertEqual(self.ran,[self.path('lib')])
+
+    def test_batches(self):
+        bob.Rule.build(bob.Rule.calc_build(self.path('lib')))
+        self.check_order()
+        self.assertEqual([len(targets) for kind,targets in self.calls if kind == 'y'],[3,3,3,1])
+        self.assertEqual(sorted(len(targets) for kind,targets in self.calls if kind == 'c'),[2,4,4])
+        self.assertEqual(sorted(stem for stems in self.stems for stem in stems),
+                         sorted((str(i),) for i in range(10)))
+
+    def test_parallel(self):
+        bob.Rule.build(bob.Rule.iter_build(self.path('lib')),jobs=3)
+        self.check_order()
+        self.assertEqual(sum(1 for kind,targets in self.calls if kind == 'y'),4)
+
+    def test_command(self):
+        calls = self.path('calls')
+        bob.Rule(self.path('%.txt'),self.path('%.y'),func='echo {targets} >> %s; touch {targets}' %calls,batch=10)
+        targets = [self.path('%d.txt' %i) for i in range(10)]
+        bob.Rule.build(bob.Rule.calc_build(targets))
+        with open(calls) as fobj:
+            self.assertEqual(fobj.read().split(),targets)
+
+    def test_wildcard_rule(self):
+        calls = self.path('calls')
+        stamps = [self.path('%d.stamp' %i) for i in range(4)]
+        bob.Rule(stamps[:2]+[self.path('*.stamp')],None,func='echo {targets} >> %s; touch {targets}' %calls,batch=4)
+        bob.Rule.build(bob.Rule.calc_build(stamps))
+        with open(calls) as fobj:
+            self.assertEqual(fobj.read().split('\n'),[' '.join(stamps),''])
+
+    def test_cut_off(self):
+        bob.Rule.build(bob.Rule.calc_build(self.path('lib')))
+        #regenerating the .c files without changing them skips the .o files
+        bob.Rule(self.path('%.c'),self.path('%.y'),func=self.recipe(),batch=5,restat=True)
+        for i in range(10):
+            self.write(self.path('%d.y' %i),'y')
+        bob.BaseRule.reset_cache()
+        bob.ExplicitTargetRule.reset_cache()
+        bob.PatternRule.reset_cache()
+        del self.calls[:]
+        del self.ran[:]
+        buildseq = bob.Rule.calc_build(self.path('lib'))
+        self.assertEqual(len(buildseq),21)
+        bob.Rule.build(buildseq)
+        self.assertEqual(self.calls,[])
+        self.assertEqual(len(self.ran),2) #the two batches of .c files
+
+    def test_progress(self):
+        out = StringIO.StringIO()
+        progress = Progress(jobs=2,mode='json',stream=out)
+        bob.Rule.build(bob.Rule.calc_build(self.path('lib')),jobs=2,progress=progress)
+        events = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual((events[-1]['done'],events[-1]['total']),(21,21))
+
+
+if __name__ == '__main__':
+    unittest.main()
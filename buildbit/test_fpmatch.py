@@ -2,61 +2,276 @@
 """module of unit tests for fpmatch module"""
 
 import unittest2 as unittest
+import re
 import fpmatch
 
 
 class TestFilter(unittest.TestCase):
-    def setup(self):
+    def setUp(self):
         self.paths = ['tests/test1','tests/test2.txt','tests/test3',
                       'tests/test/test4.txt',
                       'test B/test5','test B/ex1.txt','test B/test5.c',
                      ]
         #self.paths += ['test*/a','test C/file*.txt','test C/file%.txt']
-    
+
     def test_direct_match(self):
         for pat in self.paths:
             res=fpmatch.filter(self.paths,pat=pat)
-            self.assertTrue(res == pat)
-        
+            self.assertEqual(res,[pat])
+
     def test_no_match(self):
-        for pat in [???]:
+        for pat in ['tests/test','test*','tests/*.c','test B/test5.*.c']:
             res=fpmatch.filter(self.paths,pat=pat)
-            self.assertTrue(res == pat)
-        
+            self.assertEqual(res,[])
+
     def test_wildcard_match(self):
-                
-    def test_wildcard_no_match(self):
-        
+        self.assertEqual(fpmatch.filter(self.paths,'tests/test[13]'),['tests/test1','tests/test3'])
+        self.assertEqual(fpmatch.filter(self.paths,'*/*.txt'),['tests/test2.txt','test B/ex1.txt'])
+        self.assertEqual(fpmatch.filter(self.paths,'test B/test5[.]c'),['test B/test5.c'])
+
     def test_wildcards_with_subdirectories(self):
-        
+        #wildcards don't match across directories (unlike fnmatch)
+        self.assertEqual(fpmatch.filter(self.paths,'tests/*.txt'),['tests/test2.txt'])
+        self.assertEqual(fpmatch.filter(self.paths,'tests/*/*.txt'),['tests/test/test4.txt'])
+
     def test_pattern_match(self):
-        
-        retrieve_stem
-        
+        regex = fpmatch.precompile('tests/%.txt')
+        self.assertEqual(regex.match('tests/test2.txt').group(1),'test2')
+        self.assertEqual(fpmatch.filter(self.paths,'%/ex%.txt'),['test B/ex1.txt'])
+
     def test_pattern_no_match(self):
-        
-        
+        self.assertEqual(fpmatch.filter(self.paths,'%/%.c.txt'),[])
+
     def test_pattern_with_subdirectories(self):
-        
-    def test_general_pattern_match(self):
-        
-    
-    def teardown(self):
-        pass
+        self.assertEqual(fpmatch.filter(self.paths,'tests/%.txt'),['tests/test2.txt'])
+        self.assertEqual(fpmatch.filter(self.paths,'%/%/%.txt'),['tests/test/test4.txt'])
+
+    def test_filter_many(self):
+        patterns = ['tests/test?','*/*.txt','%/ex%.txt','tests/test1','*/*.txt','nothing*']
+        res = fpmatch.filter_many(self.paths,patterns)
+        self.assertEqual(sorted(res),sorted(set(patterns)))
+        for pat in patterns:
+            self.assertEqual(res[pat],fpmatch.filter(self.paths,pat))
+
+
+class TestPatternCache(unittest.TestCase):
+    def test_lru(self):
+        cache = fpmatch.PatternCache(maxsize=2)
+        a = cache.get('a*')
+        cache.get('b*')
+        self.assertTrue(cache.get('a*') is a)
+        cache.get('c*') #evicts b* as a* was used more recently
+        self.assertEqual(list(cache.regexes),['a*','c*'])
+        self.assertEqual(cache.stats(),{'size':2,'maxsize':2,'hits':1,'misses':3,'evictions':1})
+        cache.resize(1)
+        self.assertEqual(list(cache.regexes),['c*'])
+
+    def test_module_cache(self):
+        fpmatch.cache.clear()
+        fpmatch.fnmatch('a.c','*.c')
+        fpmatch.fnmatchcase('b.c','*.c')
+        fpmatch.filter(['c.c'],'*.c')
+        self.assertEqual(fpmatch.cache.stats()['misses'],1)
+        self.assertEqual(fpmatch.cache.stats()['hits'],2)
+
+
+class TestCornerCases(unittest.TestCase):
+    #Rule is that can include closing bracket in char list if it is the first
+    #entry only but there is a corner case if there is no closing bracket later
+    #in the string.
+    def test_escapes(self):
+        #a set with a single entry is the only way of escaping the metacharacters
+        self.assertFalse(fpmatch.has_magic('test[*].txt'))
+        self.assertEqual(fpmatch.strip_specials('test[*].txt'),'test*.txt')
+        self.assertEqual(fpmatch.strip_specials('test[]]time'),'test]time')
+
+    def test_sets(self):
+        self.assertTrue(fpmatch.has_magic('test[abcd].txt'))
+        self.assertEqual(fpmatch.strip_specials('test[abcd].txt'),'test.txt')
+        #test[!]test[]test is test followed by any character except those in ']test['
+        self.assertTrue(fpmatch.has_magic('test[!]test[]test'))
+        self.assertEqual(fpmatch.strip_specials('test[!]test[]test'),'testtest')
+
+    def test_unclosed_brackets(self):
+        #test[!].txt is treated as a literal
+        for pat in 'test[!].txt','a[':
+            self.assertFalse(fpmatch.has_magic(pat))
+            self.assertEqual(fpmatch.strip_specials(pat),pat)
+            self.assertEqual(fpmatch.filter([pat],pat),[pat])
+
+    def test_translate_unanchored(self):
+        regex = re.compile('(?ms)(?:(.*)/)?' + fpmatch.translate_unanchored('%.[ch]') + '\Z')
+        self.assertEqual(regex.match('src/a.c').groups(),('src','a'))
+        self.assertIsNone(regex.match('src/a.cc'))
+        self.assertEqual(fpmatch.translate('%.c'),fpmatch.translate_unanchored('%.c') + '\Z(?ms)')
+
+
+class TestClassify(unittest.TestCase):
+    def test_same_as_loops(self):
+        #every string of up to 6 characters from an alphabet of the special characters
+        strings = ['']
+        for n in range(6):
+            strings = [s+c for s in strings for c in 'a[]!*%']
+            for s in strings:
+                res = fpmatch.classify(s)
+                self.assertEqual(res.magic,loop_has_magic(s),s)
+                self.assertEqual(res.literal,loop_strip_specials(s),s)
+                self.assertEqual(res.prefix,loop_literal_prefix(s),s)
+                self.assertEqual(res.suffix,loop_literal_suffix(s),s)
+                self.assertEqual(res.patterns,loop_count_patterns(s),s)
+
+    def test_paths(self):
+        res = fpmatch.classify('src/%/lib [x]/%_[!a]?.[c]')
+        self.assertEqual(res,(True,2,'src//lib x/_.c','src/','.c'))
+        self.assertTrue(fpmatch.classify('a\n[b]') is fpmatch.classify('a\n[b]')) #memoized
+
+
+#the original character by character implementations (as a reference for classify)
+
+def loop_has_magic(s):
+    """tests whether a string contains unescaped metacharacters. This tests for the
+    presence of *?% characters and any sets [...] or [!...] with the exception of
+    sets that contain only a single entry (which is the only way of escaping the
+    metacharacters)."""
+    i, n = 0, len(s)
+    res = False
+    while i < n:
+        c = s[i]
+        i = i+1
+        if c in ('*','?','%'):
+            res = True
+        elif c == '[':
+            j = i
+            if j+1 < n and s[j+1] == ']' and s[j] != '!': #special case to escape (a set with only one item)
+                i = i+2
+                continue
+            if j < n and s[j] == '!':
+                j = j+1
+            if j < n and s[j] == ']':
+                j = j+1
+            #corner cases:
+            #[] or [!] treated as literals if no later closing bracket found, 
+            #otherwise ']' is included in the set of choices.
+            while j < n and s[j] != ']':
+                j = j+1
+            if j >= n:
+                pass #corner case for when no close bracket is found.
+            else:
+                i = j+1
+                res = True
+    return res
+
+def loop_strip_specials(pat):
+    """Strip all the special characters from a pattern. This will be used to 
+    find the best match when there are multiple matching patterns.
+    """
+    i, n = 0, len(pat)
+    res = ''
+    while i < n:
+        c = pat[i]
+        i = i+1
+        if c in ('*','?','%'):
+            pass
+        elif c == '[':
+            j = i
+            if j+1 < n and pat[j+1] == ']' and pat[j] != '!': #special case to escape (a set with only one item)
+                res = res + pat[j]
+                i = i+2
+                continue
+            if j < n and pat[j] == '!':
+                j = j+1
+            if j < n and pat[j] == ']':
+                j = j+1
+            #corner cases:
+              #[] or [!] treated as literals if no later closing bracket found, 
+              #otherwise ']' is included in the set of choices.
+            while j < n and pat[j] != ']':
+                j = j+1
+            if j >= n:
+                res = res + '[' #another corner case for when no close bracket is found.
+            else:
+                i = j+1
+        else:
+            res += c
+    return res
 
+def loop_literal_prefix(pat):
+    """the literal text before the first wildcard or set in a pattern"""
+    i, n = 0, len(pat)
+    res = ''
+    while i < n:
+        c = pat[i]
+        if c in ('*','?','%'):
+            break
+        elif c == '[':
+            j = i+1
+            if j+1 < n and pat[j+1] == ']' and pat[j] != '!': #special case to escape (a set with only one item)
+                res = res + pat[j]
+                i = i+3
+                continue
+            if j < n and pat[j] == '!':
+                j = j+1
+            if j < n and pat[j] == ']':
+                j = j+1
+            while j < n and pat[j] != ']':
+                j = j+1
+            if j < n:
+                break
+        res += c
+        i = i+1
+    return res
 
+def loop_literal_suffix(pat):
+    """the literal text after the last wildcard or set in a pattern (this is
+    used for indexing patterns by the endings of the paths they can match)."""
+    i, n = 0, len(pat)
+    res = ''
+    while i < n:
+        c = pat[i]
+        i = i+1
+        if c in ('*','?','%'):
+            res = ''
+        elif c == '[':
+            j = i
+            if j+1 < n and pat[j+1] == ']' and pat[j] != '!': #special case to escape (a set with only one item)
+                res = res + pat[j]
+                i = i+2
+                continue
+            if j < n and pat[j] == '!':
+                j = j+1
+            if j < n and pat[j] == ']':
+                j = j+1
+            while j < n and pat[j] != ']':
+                j = j+1
+            if j >= n:
+                res = res + '[' #no close bracket so '[' is a literal
+            else:
+                i = j+1
+                res = ''
+        else:
+            res += c
+    return res
 
-#is this a bug?
-assert fpmatch.strip_specials('test[]]time') != 'test]time' #not sure this is a bug though
-#question
-fpmatch.strip_specials('test[abcd].txt') == 'test.txt' #this is what we want isn't it?
-#but
-fpmatch.strip_specials('test[*].txt') == 'test.txt' # is this really what we want?
+def loop_count_patterns(s):
+    """count number of pattern (%) wildcards in glob.
+    """
+    i, n = 0, len(s)
+    res = 0
+    while i < n:
+        c = s[i]
+        i = i+1
+        if c == '%':
+            res += 1
+        elif c == '[':
+            j = i
+            while j < n and s[j] != ']':
+                j = j+1
+            if j >= n:
+                pass #bracket never closed so treating [ as a literal
+            else:
+                i = j+1
+    return res
 
 
-#strange cases - test[!].txt is treated as a literal
-#test[]]test becomes test[]]test as we expect but
-#test[!]test[]test becomes test[^]test[]\\]test
-#think that it is logical but can be tricky. Rule is that can include closing bracket in
-#char list if it is the first entry only but there is a corner case if there is no closing 
-#bracket later in the string.
\ No newline at end of file
+if __name__ == '__main__':
+    unittest.main()
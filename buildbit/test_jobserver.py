@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""module of unit tests for the GNU make jobserver support"""
+
+import unittest2 as unittest
+import os, shutil, tempfile, threading, time
+from jobserver import JobServer
+from scheduler import Scheduler
+
+
+class TestJobServer(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+    def create(self,jobs):
+        server = JobServer.create(jobs)
+        self.servers.append(server)
+        return server
+
+    def drain(self,server):
+        tokens = []
+        token = server.try_acquire()
+        while token:
+            tokens.append(token)
+            token = server.try_acquire()
+        return tokens
+
+    def test_tokens(self):
+        server = self.create(4)
+        tokens = self.drain(server)
+        self.assertEqual(len(tokens),3)
+        server.release(tokens.pop())
+        self.assertEqual(len(self.drain(server)),1)
+
+    def test_from_environ(self):
+        server = self.create(3)
+        environ = {'MAKEFLAGS':'k'}
+        server.export(environ)
+        self.assertTrue(environ['MAKEFLAGS'].startswith(' -j3 --jobserver-auth=%d,%d' %(server.rfd_inherited,server.wfd)))
+        self.assertTrue(environ['MAKEFLAGS'].endswith(' k'))
+        client = JobServer.from_environ(environ)
+        self.servers.append(client)
+        self.assertEqual(client.jobs,3)
+        self.assertEqual(len(self.drain(client)),2)
+
+    def test_fifo(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fifo = os.path.join(tmpdir,'jobserver')
+            os.mkfifo(fifo)
+            client = JobServer.from_environ({'MAKEFLAGS':'-j2 --jobserver-auth=fifo:%s' %fifo})
+            self.servers.append(client)
+            self.assertEqual(client.try_acquire(),None)
+            client.release('+')
+            self.assertEqual(client.try_acquire(),'+')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_no_jobserver(self):
+        self.assertEqual(JobServer.from_environ({}),None)
+        self.assertEqual(JobServer.from_environ({'MAKEFLAGS':'-j1 --jobserver-auth=-2,-2'}),None)
+
+    def test_scheduler_limited_by_tokens(self):
+        server = self.create(3)
+        lock = threading.Lock()
+        counts = {'active':0,'peak':0}
+        def func(task):
+            with lock:
+                counts['active'] += 1
+                counts['peak'] = max(counts['peak'],counts['active'])
+            time.sleep(0.05)
+            with lock:
+                counts['active'] -= 1
+        Scheduler(jobs=8,jobserver=server).run(range(6),lambda task: [],func,lambda task: {None:1})
+        self.assertEqual(counts['peak'],3)
+        self.assertEqual(len(self.drain(server)),2) #all of the tokens were given back
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""module of unit tests for the memory profile of graph resolution"""
+
+import unittest2 as unittest
+import sys
+from orderedset import OrderedSet
+import bob
+from testcase import BobTestCase
+import memprofile
+
+
+class TestDeepSize(unittest.TestCase):
+    def test_counted_once(self):
+        shared = 'x'*1000
+        seen = set()
+        first = memprofile.deep_size([[shared,shared]],seen)
+        self.assertGreater(first,1000)
+        self.assertLess(memprofile.deep_size([[shared]],seen),1000) #only the new list
+        self.assertEqual(memprofile.deep_size([{1:[]}],set(),stop=(list,)),memprofile.deep_size([{1:None}],set()))
+
+    def test_orderedset(self):
+        small = memprofile.deep_size([OrderedSet(range(10))],set())
+        large = memprofile.deep_size([OrderedSet(range(1000))],set())
+        self.assertGreater(large-small,990*memprofile._entry_size)
+
+
+class TestProfile(BobTestCase):
+    def setUp(self):
+        super(TestProfile,self).setUp()
+        for i in range(200):
+            open(self.path('%d.c' %i),'w').close()
+        bob.Rule(self.path('%.o'),self.path('%.c'),func='touch {targets}')
+        bob.Rule(self.path('lib.a'),[self.path('*.c')],func='true')
+        bob.Rule('All',[self.path('%d.o' %i) for i in range(200)]+[self.path('lib.a')],PHONY=True)
+
+    def test_phases(self):
+        profile = memprofile.MemoryProfile()
+        profile.measure('rule definitions')
+        buildseq = None
+        with profile.phase('graph resolution',lambda: buildseq):
+            buildseq = bob.Rule.calc_build('All')
+        self.assertEqual([phase[0] for phase in profile.phases],['rule definitions','graph resolution'])
+        before,after = [dict(phase[3]) for phase in profile.phases]
+        self.assertEqual(before['build sequence'],0)
+        self.assertGreater(after['build sequence'],202*memprofile._entry_size)
+        self.assertGreater(after['individuated rules'],200*sys.getsizeof({}))
+        self.assertLess(before['individuated rules']*10,after['individuated rules'])
+        self.assertGreater(after['glob results'],200*len(self.path('0.c'))) #lib.a's reqs
+        self.assertGreater(after['cached_property reqs'],before['cached_property reqs'])
+        self.assertGreaterEqual(profile.phases[1][2]['peak rss'],profile.phases[0][2]['peak rss'])
+        report = profile.report()
+        self.assertIn('graph resolution',report)
+        self.assertIn('individuated rules',report)
+
+
+if __name__ == '__main__':
+    unittest.main()
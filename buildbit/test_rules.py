@@ -3,7 +3,9 @@
 functionality of each type of Rule class individually."""
 
 import unittest2 as unittest
+import os, sys, warnings, StringIO
 import bob
+from testcase import BobTestCase
 
 #ExplicitRule
 
@@ -25,3 +27,367 @@ import bob
 
 
 #Rule
+
+class TestSharedRules(BobTestCase):
+    def test_wild_shared_targets(self):
+        rule = bob.Rule('gen/*.py','schema.txt',shared=True)
+        erules = [bob.Rule.get('gen/m%d.py' %i) for i in range(100)]
+        self.assertTrue(all(erule is erules[0] for erule in erules))
+        bob.Rule.get('gen/m0.py')
+        self.assertEqual(list(erules[0].targets),['gen/m%d.py' %i for i in range(100)])
+
+    def test_pattern_shared_targets(self):
+        rule = bob.Rule(['%.h','%.cpp'],'%.idl',shared=True)
+        a_h,a_cpp,b_h = bob.Rule.get('a.h'),bob.Rule.get('a.cpp'),bob.Rule.get('b.h')
+        self.assertTrue(a_h is a_cpp)
+        self.assertFalse(a_h is b_h)
+        self.assertEqual(list(a_h.targets),['a.h','a.cpp'])
+        self.assertEqual(rule.explicit_rules,[a_h,b_h])
+        #same stems but a different directory
+        sub_h = bob.Rule.get('sub/a.h')
+        self.assertFalse(sub_h is a_h)
+        self.assertTrue(bob.Rule.get('sub/a.cpp') is sub_h)
+
+
+class TestStaleness(BobTestCase):
+    def setUp(self):
+        super(TestStaleness,self).setUp()
+        self.reqs = [self.path('%d.txt' %i) for i in range(5)]
+        for i,req in enumerate(self.reqs):
+            self.touch(req,i*10)
+        self.target = self.path('archive')
+        self.touch(self.target,25)
+
+    def test_get_mtimes(self):
+        mtimes = bob.BaseRule.get_mtimes(self.reqs[:2]+[self.path('missing')])
+        self.assertEqual(list(mtimes[:2]),[0.0,10.0])
+        self.assertNotEqual(mtimes[2],mtimes[2]) #NaN
+        self.assertEqual(bob.BaseRule.get_mtime(self.reqs[1]),10.0)
+
+    def test_updated_only(self):
+        rule = bob.Rule(self.target,self.reqs+[self.path('missing')])
+        self.assertEqual(rule.updated_only,self.reqs[3:]+[self.path('missing')])
+
+    def test_calc_build(self):
+        rule = bob.Rule(self.target,self.reqs[:3])
+        self.assertEqual(list(bob.Rule.calc_build(self.target)),[])
+        self.touch(self.reqs[1],30)
+        bob.Rule.reset_cache()
+        self.assertEqual(list(bob.Rule.calc_build(self.target)),[rule])
+        bob.Rule(self.path('other'),self.path('missing'))
+        with self.assertRaises(AssertionError):
+            bob.Rule.calc_build(self.path('other'))
+
+    def test_refresh_cache(self):
+        rule = bob.Rule(self.target,self.reqs[:3])
+        self.assertEqual(list(bob.Rule.calc_build(self.target)),[])
+        bob.Rule.refresh_cache() #sees the directory for the first time
+        self.assertEqual(bob.Rule.refresh_cache(),[])
+        self.touch(self.reqs[1],30)
+        self.assertEqual(bob.Rule.refresh_cache(),[self.reqs[1]])
+        self.assertEqual(list(bob.Rule.calc_build(self.target)),[rule])
+        self.assertEqual(bob.BaseRule.get_mtime(self.reqs[0]),0.0) #the unchanged files stay cached
+
+    def test_refresh_cache_wildcards(self):
+        p = self.path
+        for name in 'src','out':
+            os.mkdir(p(name))
+        self.touch(p('src','a.c'),0)
+        self.touch(p('out','a.o'),0)
+        for name in 'src','out':
+            os.utime(p(name),(0,0)) #the directories' timestamps are too coarse to see the next change
+        srcs = bob.Rule(p('srcs.txt'),p('src','*.c'))
+        objs = bob.Rule(p('objs.txt'),p('out','*.o'))
+        bob.Rule.refresh_cache() #sees the directories for the first time
+        self.assertEqual(srcs.reqs,[p('src','a.c')])
+        self.assertEqual(objs.reqs,[p('out','a.o')])
+        bob.Rule.refresh_cache()
+        self.assertEqual(len(bob.ExplicitTargetRule.allreqs.cache),2)
+        self.touch(p('out','b.o'),0) #a build writing its targets
+        bob.Rule.refresh_cache()
+        self.assertIn(srcs,bob.ExplicitTargetRule.allreqs.cache) #its directory didn't change
+        self.assertNotIn(objs,bob.ExplicitTargetRule.allreqs.cache)
+        self.assertEqual(objs.reqs,[p('out','a.o'),p('out','b.o')])
+
+    def test_refresh_cache_depfile(self):
+        dep = self.path('archive.d')
+        rule = bob.Rule(self.target,self.reqs[:3],depfile=dep)
+        self.assertEqual(rule.depfile_reqs,None)
+        bob.Rule.refresh_cache()
+        self.assertEqual(bob.Rule.refresh_cache(),[])
+        with open(dep,'w') as fobj:
+            fobj.write('archive: %s\n' %self.reqs[3])
+        self.assertEqual(bob.Rule.refresh_cache(),[dep])
+        self.assertEqual(rule.depfile_reqs,[self.reqs[3]])
+        self.assertEqual(bob.Rule.refresh_cache(),[])
+
+
+class TestDependents(BobTestCase):
+    def setUp(self):
+        super(TestDependents,self).setUp()
+        os.mkdir(self.path('src'))
+        for name in 'a.c','b.c','a.h':
+            open(self.path('src',name),'w').close()
+
+    def targets(self,rules):
+        return [rule.targets[0] for rule in rules]
+
+    def test_explicit(self):
+        p = self.path
+        bob.Rule(p('a.o'),[p('src/a.c'),p('src/a.h')])
+        bob.Rule(p('b.o'),p('src/b.c'),order_only=p('src/a.h'))
+        self.assertEqual(list(bob.Rule.dependents([p('src/a.h')])),[p('a.o')]) #not through order only prerequisites
+        self.assertEqual(list(bob.Rule.dependents([p('src/b.c')])),[p('b.o')])
+        self.assertEqual(list(bob.Rule.dependents([p('src/other.c')])),[])
+
+    def test_wildcard_reqs(self):
+        p = self.path
+        bob.Rule(p('index.txt'),p('src/*.c'))
+        #files that don't exist yet still match the wildcard
+        self.assertEqual(list(bob.Rule.dependents([p('src/new.c')])),[p('index.txt')])
+        self.assertEqual(list(bob.Rule.dependents([p('src/a.h')])),[])
+
+    def test_pattern_rule(self):
+        p = self.path
+        bob.Rule('%.o','%.c')
+        bob.Rule(p('lib/%.o'),p('lib/%.x')) #a better match for the objects in lib
+        self.assertEqual(list(bob.Rule.dependents([p('src/b.c')])),[p('src/b.o')])
+        self.assertEqual(list(bob.Rule.dependents([p('lib/b.c')])),[])
+        self.assertEqual(bob.PatternRule._instantiated_rules,{}) #the query didn't individuate any rules
+        bob.Rule.get(p('src/b.o'))
+        self.assertEqual(list(bob.Rule.dependents([p('src/b.c')])),[p('src/b.o')])
+
+    def test_wild_rule(self):
+        p = self.path
+        open(p('src/a.txt'),'w').close()
+        bob.Rule(p('src/*.txt'),p('src/a.h'))
+        bob.Rule(p('all.txt'),[p('src/a.txt'),p('src/b.txt')])
+        #the targets that other rules ask for, rather than the files that exist
+        self.assertEqual(list(bob.Rule.dependents([p('src/a.h')])),[p('src/a.txt'),p('src/b.txt'),p('all.txt')])
+        self.assertEqual(bob.WildRule._instantiated_rules,{})
+
+    def test_transitive(self):
+        p = self.path
+        bob.Rule('%.o','%.c')
+        bob.Rule(p('lib.a'),[p('src/a.o'),p('src/b.o')])
+        bob.Rule('All',p('lib.a'),PHONY=True)
+        bob.Rule('Other',p('src/b.o'),PHONY=True)
+        self.assertEqual(list(bob.Rule.dependents([p('src/a.c')])),[p('src/a.o'),p('lib.a'),'All'])
+        self.assertEqual(list(bob.Rule.dependents([p('src/a.c')],transitive=False)),[p('src/a.o')])
+
+    def test_rules_defined_after_first_query(self):
+        p = self.path
+        bob.Rule(p('a.o'),p('src/a.c'))
+        bob.Rule.dependents([p('src/a.c')])
+        bob.Rule(p('a2.o'),p('src/a.c'))
+        self.assertEqual(list(bob.Rule.dependents([p('src/a.c')])),[p('a.o'),p('a2.o')])
+
+    def test_unindexed_rules(self):
+        p = self.path
+        bob.Rule('%.o','%.c')
+        bob.Rule([p('%.x'),p('%.y')],p('src/%.c'),shared=True)
+        bob.Rule.dependents([p('src/a.c')])
+        for target in p('a.x'),p('a.y'),p('a.x'),p('src/b.o'),p('src/b.o'):
+            bob.Rule.get(target)
+        self.assertEqual(len(bob.ExplicitRule._unindexed),2) #the new rules only
+        self.assertIn(p('src/b.o'),bob.Rule.dependents([p('src/b.c')]))
+        self.assertEqual(bob.ExplicitRule._unindexed,[])
+        first = bob.Rule(p('first.o'),p('src/a.c'))
+        bob.Rule.get(p('src/c.o'))
+        bob.Rule.reset_cache() #the individuated rules are dropped
+        self.assertEqual(bob.ExplicitRule._unindexed,[first])
+
+    def test_changed_build(self):
+        p = self.path
+        bob.Rule('%.o','%.c')
+        bob.Rule(p('lib.a'),[p('src/a.o'),p('src/b.o')])
+        bob.Rule(p('other.a'),p('src/b.o'))
+        bob.Rule('All',p('lib.a'),PHONY=True)
+        bob.BaseRule.get_mtime.cache.clear()
+        buildseq = bob.Rule.calc_build('All',changed=[p('src/b.c')])
+        self.assertEqual(self.targets(buildseq),[p('src/b.o'),p('lib.a'),'All'])
+        self.assertEqual(bob.BaseRule.get_mtime.cache,{}) #nothing was stat'ed
+        self.assertEqual(list(bob.Rule.calc_build(p('lib.a'),changed=[p('src/other.c')])),[])
+
+    def test_changed_order_only(self):
+        p = self.path
+        gen = bob.Rule(p('gen.h'),p('src/a.h'))
+        obj = bob.Rule(p('b.o'),p('src/b.c'),order_only=p('gen.h'))
+        self.assertEqual(list(bob.Rule.calc_build(p('b.o'),changed=[p('src/a.h')])),[])
+        self.assertEqual(list(bob.Rule.calc_build(p('b.o'),changed=[p('src/a.h'),p('src/b.c')])),[gen,obj])
+
+
+class TestShard(BobTestCase):
+    def setUp(self):
+        super(TestShard,self).setUp()
+        p = self.path
+        for name in 'a.c','b.c','c.c','d.c','common.h':
+            open(p(name),'w').close()
+        bob.Rule(p('gen.h'),p('common.h'),func='touch {targets}')
+        for name in 'abcd':
+            bob.Rule(p(name+'.o'),[p(name+'.c'),p('gen.h')],func='touch {targets}')
+        bob.Rule(p('lib1.a'),[p('a.o'),p('b.o')],func='touch {targets}')
+        bob.Rule(p('lib2.a'),p('c.o'),func='touch {targets}')
+        bob.Rule(p('lib3.a'),p('d.o'),func='touch {targets}')
+        bob.Rule('All',[p('lib1.a'),p('lib2.a'),p('lib3.a')],PHONY=True)
+        self.buildseq = bob.Rule.calc_build('All')
+
+    def names(self,rules):
+        return [os.path.basename(rule.targets[0]) for rule in rules]
+
+    def test_partition(self):
+        shards = [bob.Rule.shard(self.buildseq,i,2) for i in range(2)]
+        self.assertEqual(self.names(shards[0]),['gen.h','a.o','b.o','lib1.a'])
+        self.assertEqual(self.names(shards[1]),['gen.h','c.o','lib2.a','d.o','lib3.a'])
+
+    def test_respects_dependencies(self):
+        for count in 1,2,3,5:
+            built = set()
+            for i in range(count):
+                shard = bob.Rule.shard(self.buildseq,i,count)
+                self.assertEqual(list(shard),[rule for rule in self.buildseq if rule in shard])
+                for rule in shard:
+                    for req in rule.reqs:
+                        reqrule = bob.Rule.get(req)
+                        if reqrule in self.buildseq:
+                            self.assertIn(reqrule,shard)
+                built.update(shard)
+            self.assertEqual(built,set(self.buildseq) - set([bob.Rule.get('All')]))
+
+    def test_costs(self):
+        costs = dict((self.path(name),1) for name in ['gen.h','a.o','b.o','lib1.a','lib2.a','lib3.a'])
+        costs.update({self.path('c.o'):10,self.path('d.o'):10})
+        shards = [bob.Rule.shard(self.buildseq,i,2,costs) for i in range(2)]
+        self.assertEqual(self.names(shards[0]),['gen.h','a.o','b.o','lib1.a','c.o','lib2.a'])
+        self.assertEqual(self.names(shards[1]),['gen.h','d.o','lib3.a'])
+
+    def test_stable(self):
+        first = bob.Rule.shard(self.buildseq,1,3)
+        self.assertEqual(list(bob.Rule.shard(list(self.buildseq),1,3)),list(first))
+
+    def test_command_line_costs(self):
+        timings = self.path('timings')
+        with open(timings,'w') as fobj:
+            for name in 'gen.h','a.o','b.o','c.o','d.o','lib1.a','lib2.a','lib3.a':
+                fobj.write('%d\t%s\n' %(10 if name in ('c.o','d.o') else 1,self.path(name)))
+        announced = []
+        stdout,sys.stdout = sys.stdout,StringIO.StringIO()
+        try:
+            bob.Rule._run(bob.Rule._argparser().parse_args(['--shard','2/2','--timings',timings,'-n']),announced)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(self.names(announced),['gen.h','d.o','lib3.a'])
+
+
+class TestPatternRegistry(BobTestCase):
+    def test_lazy_registration(self):
+        for i in range(100):
+            bob.Rule('gen%d/%%.o' %i,'gen%d/%%.c' %i)
+        self.assertEqual(bob.PatternRule.rules,{}) #not registered until the first lookup
+        erule = bob.Rule.get('gen42/a.o')
+        self.assertEqual(list(erule.reqs),['gen42/a.c'])
+        self.assertEqual(len(bob.PatternRule.rules),100)
+        self.assertEqual(bob.MetaRule._regexes.keys(),['gen42/%.o']) #only the candidate was compiled
+        self.assertEqual(bob.Rule.get('gen100/a.o',None),None)
+
+    def test_most_specific_pattern(self):
+        bob.Rule('%.o','%.c')
+        bob.Rule('src/%.o','src/%.cpp')
+        self.assertEqual(list(bob.Rule.get('src/a.o').reqs),['src/a.cpp'])
+        self.assertEqual(list(bob.Rule.get('lib/a.o').reqs),['lib/a.c'])
+        bob.Rule('out/*.txt','data.csv')
+        self.assertEqual(list(bob.Rule.get('out/a.txt').reqs),['data.csv'])
+
+
+class TestFromTable(BobTestCase):
+    def test_columns(self):
+        rules = bob.Rule.from_table(['a.o',['b.o','c.o'],'%.x','d[.]o','e.o'],
+                                    [['a.c','common.h'],'bc.c','%.y','d.c','*.c'],
+                                    funcs=['touch a.o',None,None,None,None])
+        self.assertEqual(type(rules[0]),bob.ExplicitRule)
+        self.assertEqual(rules[0].func,'touch a.o')
+        self.assertEqual(type(rules[1]),bob.ManyRules)
+        self.assertEqual(type(rules[2]),bob.PatternRule)
+        self.assertEqual(list(rules[3].targets),['d.o'])
+        self.assertEqual(type(rules[4]),bob.ExplicitTargetRule)
+        self.assertTrue(bob.Rule.get('c.o') is rules[1][1])
+        self.assertEqual(list(bob.Rule.get('z.x').reqs),['z.y'])
+        self.assertEqual(list(bob.Rule.dependents(['bc.c'])),['b.o','c.o','e.o'])
+
+    def test_same_as_rule(self):
+        bob.Rule.from_table(['a.o','b.o'],['a.c','b.c'],shared=True,PHONY=True,restat=True)
+        rule = bob.Rule.get('b.o')
+        self.assertTrue(rule.PHONY)
+        self.assertTrue(rule.restat)
+        self.assertEqual(list(rule.reqs),['b.c'])
+
+    def test_conflicts_reported_once(self):
+        bob.Rule('a.o','old.c')
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            bob.Rule.from_table(['a.o','b.o','b.o'],['a.c','b1.c','b2.c'])
+        self.assertEqual(len(caught),1)
+        self.assertIn("2 targets: 'a.o', 'b.o'",str(caught[0].message))
+        self.assertEqual(list(bob.Rule.get('b.o').reqs),['b2.c'])
+
+    def test_mismatched_columns(self):
+        with self.assertRaises(ValueError):
+            bob.Rule.from_table(['a.o','b.o'],['a.c'])
+
+
+class TestInvalidate(BobTestCase):
+    def setUp(self):
+        super(TestInvalidate,self).setUp()
+        p = self.path
+        for name,t in ('a.c',10),('b.c',10),('a.o',20),('b.o',20),('lib.a',30),('x.txt',10):
+            self.touch(p(name),t)
+        self.a = bob.Rule(p('a.o'),p('a.c'),depfile=p('a.d'))
+        self.b = bob.Rule(p('b.o'),p('b.c'))
+        self.lib = bob.Rule(p('lib.a'),[p('a.o'),p('b.o')])
+        self.docs = bob.Rule(p('docs'),p('*.txt'),PHONY=True)
+        with open(p('a.d'),'w') as fobj:
+            fobj.write('%s: %s\n' %(p('a.o'),p('a.h')))
+        self.touch(p('a.h'),10)
+        bob.Rule.calc_build(p('lib.a'))
+        bob.Rule.calc_build(p('docs'))
+
+    def test_only_dependent_values_dropped(self):
+        p = self.path
+        self.touch(p('a.c'),25)
+        bob.Rule.invalidate([p('a.c')])
+        updated_only = bob.ExplicitRule.updated_only.cache
+        self.assertNotIn(self.a,updated_only)
+        self.assertIn(self.b,updated_only)
+        self.assertIn(self.lib,updated_only) #lib.a only depends upon a.o, which hasn't changed yet
+        self.assertIn(p('b.c'),bob.BaseRule.get_mtime.cache)
+        self.assertEqual(list(bob.Rule.calc_build(p('lib.a'))),[self.a,self.lib])
+
+    def test_target_changed(self):
+        p = self.path
+        self.touch(p('a.o'),40)
+        bob.Rule.invalidate([p('a.o')])
+        self.assertNotIn(self.a,bob.ExplicitRule._oldest_target.cache)
+        self.assertNotIn(self.lib,bob.ExplicitRule.updated_only.cache)
+        self.assertEqual(list(bob.Rule.calc_build(p('lib.a'))),[self.lib])
+
+    def test_wildcard_expansion(self):
+        p = self.path
+        self.assertEqual(list(self.docs.reqs),[p('x.txt')])
+        self.touch(p('y.txt'),10)
+        bob.Rule.invalidate(p('y.txt'))
+        self.assertEqual(sorted(self.docs.reqs),[p('x.txt'),p('y.txt')])
+
+    def test_depfile(self):
+        p = self.path
+        self.assertEqual(self.a.depfile_reqs,[p('a.h')])
+        self.assertEqual(list(bob.Rule.dependents(p('a.h'),transitive=False)),[p('a.o')])
+        with open(p('a.d'),'w') as fobj:
+            fobj.write('%s: %s\n' %(p('a.o'),p('b.h')))
+        bob.Rule.invalidate([p('a.d')])
+        self.assertEqual(self.a.depfile_reqs,[p('b.h')])
+        self.assertEqual(list(bob.Rule.dependents(p('a.h'),transitive=False)),[])
+        self.assertEqual(list(bob.Rule.dependents(p('b.h'),transitive=False)),[p('a.o')])
+
+
+if __name__ == '__main__':
+    unittest.main()
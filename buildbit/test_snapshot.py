@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""module of unit tests for saving and loading snapshots of the rule graph"""
+
+import unittest2 as unittest
+import os, warnings
+import bob
+from testcase import BobTestCase
+
+
+def mytouch(self):
+    for target in self.targets:
+        open(target,'a').close()
+
+
+class TestSnapshot(BobTestCase):
+    def setUp(self):
+        super(TestSnapshot,self).setUp()
+        os.mkdir(self.path('src'))
+        for name in 'a.c','b.c':
+            open(self.path('src',name),'w').close()
+        self.script = self.path('build.py')
+        self.snap = self.path('snap')
+        with open(self.script,'w') as fobj:
+            fobj.write('#rule definitions\n')
+        self.define_rules()
+
+    def define_rules(self):
+        rule = bob.Rule
+        p = self.path
+        rule('%.o','%.c',func=mytouch)
+        rule(p('lib.a'),[p('src/a.o'),p('src/b.o')],func='touch {targets}')
+        rule(p('index.txt'),p('src/*.c'),func='ls {reqs} > {targets}')
+        rule('All',[p('lib.a'),p('index.txt')],PHONY=True)
+
+    def names(self,buildseq):
+        return [rule.targets for rule in buildseq]
+
+    def test_roundtrip(self):
+        expected = self.names(bob.Rule.calc_build('All'))
+        self.assertTrue(bob.Rule.save_snapshot(self.snap,scripts=[self.script]))
+        reload(bob) #no rules defined
+        self.assertTrue(bob.Rule.load_snapshot(self.snap,scripts=[self.script]))
+        self.assertEqual(self.names(bob.Rule.calc_build('All')),expected)
+        rule = bob.Rule.get(self.path('src/a.o'))
+        self.assertEqual(rule.func,mytouch)
+        self.assertEqual(rule.stems,('a',))
+        self.assertEqual(rule.extratargetpath,self.path('src'))
+        #pattern rules that weren't individuated before the snapshot still work
+        self.assertEqual(bob.Rule.get(self.path('src/z.o')).reqs,[self.path('src/z.c')])
+
+    def test_batches(self):
+        bob.Rule('%.d','%.c',func=mytouch,batch=10)
+        bob.Rule('deps',[self.path('src/a.d'),self.path('src/b.d')],PHONY=True)
+        bob.Rule.calc_build('deps')
+        self.assertTrue(bob.Rule.save_snapshot(self.snap,scripts=[self.script]))
+        reload(bob)
+        self.assertTrue(bob.Rule.load_snapshot(self.snap,scripts=[self.script]))
+        buildseq = list(bob.Rule._batched(bob.Rule.calc_build('deps')))
+        self.assertEqual(len(buildseq),2)
+        self.assertEqual(buildseq[0].targets,[self.path('src/a.d'),self.path('src/b.d')])
+        self.assertEqual(buildseq[0].stems,[('a',),('b',)])
+
+    def test_invalidated_by_script_change(self):
+        bob.Rule.calc_build('All')
+        bob.Rule.save_snapshot(self.snap,scripts=[self.script])
+        with open(self.script,'a') as fobj:
+            fobj.write('#new rule\n')
+        self.assertFalse(bob.Rule.load_snapshot(self.snap,scripts=[self.script]))
+
+    def test_invalidated_by_directory_change(self):
+        bob.Rule.calc_build('All')
+        bob.Rule.save_snapshot(self.snap,scripts=[self.script])
+        open(self.path('src','c.c'),'w').close()
+        self.assertFalse(bob.Rule.load_snapshot(self.snap,scripts=[self.script]))
+
+    def test_use_snapshot(self):
+        reload(bob)
+        self.assertFalse(bob.Rule.use_snapshot(self.snap,scripts=[self.script]))
+        self.define_rules()
+        bob.Rule.main(['-n','All'])
+        expected = self.names(bob.Rule.calc_build('All'))
+        reload(bob) #the rule definitions are skipped
+        self.assertTrue(bob.Rule.use_snapshot(self.snap,scripts=[self.script]))
+        self.assertEqual(self.names(bob.Rule.calc_build('All')),expected)
+
+    def test_unreferencable_recipe(self):
+        bob.Rule(self.path('other.txt'),None,func=lambda self: None)
+        with warnings.catch_warnings(record=True) as caught:
+            self.assertFalse(bob.Rule.save_snapshot(self.snap,scripts=[self.script]))
+        self.assertEqual(len(caught),1)
+        self.assertFalse(os.path.exists(self.snap))
+
+
+if __name__ == '__main__':
+    unittest.main()
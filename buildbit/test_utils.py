@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""module of unit tests for the utils module"""
+
+import unittest2 as unittest
+import os, shutil, tempfile, warnings
+from array import array
+import utils
+
+nan = float('nan')
+
+
+class TestNewerIndices(unittest.TestCase):
+    def test_newer_and_missing(self):
+        mtimes = array('d',[5.0,20.0,nan,10.0,11.0])
+        self.assertEqual(utils.newer_indices(mtimes,10.0),[1,2,4])
+
+    def test_long_array(self):
+        mtimes = array('d',[1.0]*5000)
+        mtimes[7],mtimes[4000] = 3.0,nan
+        self.assertEqual(utils.newer_indices(mtimes,2.0),[7,4000])
+
+    def test_empty(self):
+        self.assertEqual(utils.newer_indices(array('d'),0.0),[])
+
+    @unittest.skipIf(utils.numpy is None,'needs numpy')
+    def test_numpy_same_as_loop(self):
+        mtimes = array('d',[float(i%7) for i in range(5000)])
+        mtimes[10],mtimes[4999] = nan,nan
+        expected = [i for i in range(5000) if i in (10,4999) or i%7 > 3]
+        self.assertEqual(utils.newer_indices(mtimes,3.0),expected)
+        numpy,utils.numpy = utils.numpy,None
+        try:
+            self.assertEqual(utils.newer_indices(mtimes,3.0),expected)
+        finally:
+            utils.numpy = numpy
+
+
+class IntLog(utils.TargetLog):
+    parse = staticmethod(int)
+    format = staticmethod(str)
+
+
+class TestTargetLog(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir,'log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_later_lines_replace_earlier(self):
+        log = IntLog(self.path)
+        log.write([('a',1),('b',2)])
+        log.write([('a',3)])
+        log.close()
+        with open(self.path,'a') as fobj:
+            fobj.write('bad\ta\nno target\n')
+        self.assertEqual(IntLog(self.path).values,{'a':3,'b':2})
+
+    def test_compact(self):
+        with open(self.path,'w') as fobj:
+            fobj.write('1\tx\n'*2000 + '2\tx\n')
+        self.assertEqual(IntLog(self.path).values,{'x':2})
+        self.assertEqual(open(self.path).read(),'2\tx\n')
+
+    def test_unwritable(self):
+        log = IntLog(os.path.join(self.tmpdir,'missing','log'))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            log.write([('a',1)])
+        self.assertEqual(len(caught),1)
+        self.assertEqual(log.values,{'a':1})
+
+
+if __name__ == '__main__':
+    unittest.main()
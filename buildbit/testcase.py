@@ -0,0 +1,25 @@
+"""shared fixture for the unit tests of the bob module"""
+
+import unittest2 as unittest
+import os, shutil, tempfile
+import bob
+
+
+class BobTestCase(unittest.TestCase):
+    """starts each test with a fresh bob module (so that no rules are defined)
+    and a temporary directory for its files"""
+    def setUp(self):
+        reload(bob)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        reload(bob)
+
+    def path(self,*names):
+        return os.path.join(self.tmpdir,*names)
+
+    def touch(self,fpath,t):
+        """creates the file if needed and sets its modification time to t"""
+        open(fpath,'a').close()
+        os.utime(fpath,(t,t))
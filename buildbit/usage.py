@@ -0,0 +1,125 @@
+"""Resource accounting for recipes. Part of the Buildbit package.
+
+With a UsageLog in use (see Rule.use_usage_log) every recipe that runs is
+measured: wall time, user and system CPU time, max RSS and block I/O. Shell
+and list recipes are waited for with os.wait4, so their figures cover the
+command and everything it waited for, and are right even when recipes run
+in parallel. Python function recipes run in the build process, so theirs are
+for the thread that ran them (their max RSS is the build process's).
+
+The log keeps the latest usage of each target in a file with a line of
+"wall user sys maxrss inblock oublock<TAB>target" (maxrss in KB) per run, so
+the report can show how the targets that were built this time compare with
+the last time that they were built.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import errno
+import resource
+import subprocess
+from collections import namedtuple
+
+from utils import dedup, TargetLog
+
+#getrusage for the calling thread (the constant is missing from python 2)
+RUSAGE_THREAD = getattr(resource,'RUSAGE_THREAD',1 if sys.platform.startswith('linux') else resource.RUSAGE_SELF)
+
+Usage = namedtuple('Usage','wall user sys maxrss inblock oublock')
+
+
+def _maxrss(rusage):
+    """max RSS in KB (macOS reports it in bytes)"""
+    return rusage.ru_maxrss//1024 if sys.platform == 'darwin' else rusage.ru_maxrss
+
+
+def check_call(cmd,shell=False):
+    """like subprocess.check_call but returns the Usage of the command"""
+    start = time.time()
+    proc = subprocess.Popen(cmd,shell=shell)
+    while True:
+        try:
+            pid,status,rusage = os.wait4(proc.pid,0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR: raise
+    wall = time.time() - start
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode,cmd)
+    return Usage(wall,rusage.ru_utime,rusage.ru_stime,_maxrss(rusage),rusage.ru_inblock,rusage.ru_oublock)
+
+
+def call(func,*args):
+    """calls func in this thread and returns the Usage of the call"""
+    start,before = time.time(),resource.getrusage(RUSAGE_THREAD)
+    func(*args)
+    after = resource.getrusage(RUSAGE_THREAD)
+    return Usage(time.time()-start,after.ru_utime-before.ru_utime,after.ru_stime-before.ru_stime,_maxrss(after),
+                 after.ru_inblock-before.ru_inblock,after.ru_oublock-before.ru_oublock)
+
+
+class UsageLog(TargetLog):
+    """the resource usage of the targets' recipes, kept in the file at path (see
+    utils.TargetLog)"""
+    description = 'recipe usage'
+
+    def __init__(self,path):
+        super(UsageLog,self).__init__(path)
+        self.usage = self.values # target: Usage of its latest run
+        self.previous = {} # target: Usage of the run before its latest (for the targets built since loading)
+
+    @staticmethod
+    def parse(text):
+        wall,user,sys_,maxrss,inblock,oublock = text.split()
+        return Usage(float(wall),float(user),float(sys_),int(maxrss),int(inblock),int(oublock))
+
+    @staticmethod
+    def format(usage):
+        return '%.3f %.3f %.3f %d %d %d' %usage
+
+    def record(self,rule,usage):
+        """remembers the usage of the rule's recipe (against its first target)"""
+        target = rule.targets[0]
+        if target in self.usage: #only the thread that built the target records it
+            self.previous[target] = self.usage[target]
+        self.write([(target,usage)])
+
+    def rows(self,targets=None):
+        """(target, Usage, previous Usage or None) for the targets (default: all of
+        those in the log)"""
+        targets = self.usage if targets is None else targets
+        return [(target,self.usage[target],self.previous.get(target)) for target in dedup(targets) if target in self.usage]
+
+    def report(self,n=10,targets=None):
+        """the top n slowest and most memory-hungry of the targets' recipes"""
+        rows = self.rows(targets)
+        if not rows:
+            return 'No recipes were measured'
+        lines = []
+        for title,key in ('slowest recipes',lambda row: row[1].wall),('most memory-hungry recipes',lambda row: row[1].maxrss):
+            lines.append('Top %d %s (of %d):' %(min(n,len(rows)),title,len(rows)))
+            lines.append('%9s %9s %9s %10s %9s %9s %10s  %s' %('wall','user','sys','max rss','in blk','out blk','last wall','target'))
+            for target,usage,previous in sorted(rows,key=key,reverse=True)[:n]:
+                was = '%8.2fs' %previous.wall if previous else '-'
+                lines.append('%8.2fs %8.2fs %8.2fs %8.1fMB %9d %9d %10s  %s' %(usage.wall,usage.user,usage.sys,usage.maxrss/1024.0,
+                                                                              usage.inblock,usage.oublock,was,target))
+        return '\n'.join(lines)
+
+    def export(self,path,targets=None):
+        """writes the usage of the targets to a .csv or .json file"""
+        rows = self.rows(targets)
+        if path.endswith('.json'):
+            with open(path,'w') as fobj:
+                json.dump([dict(zip(('target',)+Usage._fields,(target,)+usage)) for target,usage,previous in rows],fobj,indent=1)
+        elif path.endswith('.csv'):
+            with open(path,'wb') as fobj:
+                writer = csv.writer(fobj)
+                writer.writerow(('target',)+Usage._fields)
+                for target,usage,previous in rows:
+                    writer.writerow((target,)+usage)
+        else:
+            raise ValueError('expected a .csv or .json report file, not %r' %path)
+
@@ -2,7 +2,15 @@
 """
 from collections import Iterable
 from types import StringTypes
+import os
 import functools
+import itertools
+import threading
+import warnings
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 def checksingleinput(val):
     """checks that input is not a sequence"""
@@ -14,6 +22,7 @@ def checkseq(val):
     """replaces None with an empty tuple and wraps
     non-iterable values into a tuple too."""
     if not val: val = tuple()
+    elif type(val) in (list,tuple): pass #skips the slow abc isinstance check
     elif isinstance(val,StringTypes): val = (val,)
     elif not isinstance(val,Iterable): val = (val,)
     return val
@@ -24,6 +33,86 @@ def dedup(seq):
     seen_add = seen.add
     return [ x for x in seq if not (x in seen or seen_add(x))]
 
+def newer_indices(mtimes,threshold):
+    """indices of the modification times (an array('d') with NaN for missing
+    files) that are later than threshold or missing. Long arrays are compared
+    in one operation with NumPy when it is available."""
+    if numpy is not None and len(mtimes) >= 1000:
+        times = numpy.frombuffer(mtimes,dtype=numpy.float64)
+        return numpy.flatnonzero(~(times <= threshold)).tolist()
+    return [i for i,mtime in itertools.izip(itertools.count(),mtimes) if not mtime <= threshold]
+
+class TargetLog(object):
+    """a dict (values) of target: value kept in an append only log file at path,
+    with a line of "value<TAB>target" for each record. Later lines replace
+    earlier ones and the file is rewritten once it holds too many stale lines.
+    Subclasses convert the values to (format) and from (parse, raising ValueError
+    for a bad line) their text. Values can be written from the build's threads."""
+    description = 'values' # what the log holds (for the warnings)
+
+    def __init__(self,path):
+        self.path = path
+        self.values = {}
+        self.lock = threading.Lock()
+        self._fobj = None
+        lines = 0
+        try:
+            with open(path) as fobj:
+                for line in fobj:
+                    text,sep,target = line.rstrip('\n').partition('\t')
+                    if not (sep and target):
+                        continue
+                    try:
+                        self.values[target] = self.parse(text)
+                    except ValueError:
+                        continue
+                    lines += 1
+        except IOError:
+            pass
+        if lines > 2*len(self.values) + 1000:
+            self.compact()
+
+    @staticmethod
+    def parse(text):
+        return text
+
+    @staticmethod
+    def format(value):
+        return value
+
+    def write(self,items):
+        """records the (target, value) items. They are kept in values even if the
+        log can't be written."""
+        items = list(items)
+        try:
+            with self.lock:
+                self.values.update(items)
+                if self._fobj is None:
+                    self._fobj = open(self.path,'a')
+                for target,value in items:
+                    self._fobj.write('%s\t%s\n' %(self.format(value),target))
+                self._fobj.flush()
+        except IOError as e:
+            warnings.warn('Unable to record the %s in %r: %s' %(self.description,self.path,e),stacklevel=3)
+
+    def compact(self):
+        """rewrites the log with just the current values"""
+        self.close()
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp,'w') as fobj:
+                for target,value in self.values.iteritems():
+                    fobj.write('%s\t%s\n' %(self.format(value),target))
+            os.rename(tmp,self.path)
+        except (IOError,OSError) as e:
+            warnings.warn('Unable to compact the %s in %r: %s' %(self.description,self.path,e),stacklevel=2)
+
+    def close(self):
+        if self._fobj is not None:
+            self._fobj.close()
+            self._fobj = None
+
+
 def argmax(lst):
   return lst.index(max(lst))
 